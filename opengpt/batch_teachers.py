@@ -0,0 +1,275 @@
+r'''
+Batch mode for teachers: instead of one request per prompt, the work items from `create_dataset` are written into JSONL
+files, submitted as offline batch jobs, polled until done, and the results are routed back to the work items (and from
+there through the parser of each prompt). Set `teacher.batch` in the config to `openai` (OpenAI Batch API) or `local`
+(a file based stand-in that runs the normal teacher, used for testing).
+
+The request/response files follow the OpenAI Batch API format:
+    request: {"custom_id": ..., "method": "POST", "url": "/v1/chat/completions", "body": {"model": ..., "messages": [...]}}
+    response: {"custom_id": ..., "response": {"status_code": 200, "body": <chat completion>}, "error": null}
+'''
+
+import os
+import json
+import time
+import uuid
+import hashlib
+import logging
+import threading
+
+from opengpt.lazy import lazy_import
+
+openai = lazy_import('openai')
+
+
+def make_batch_request(work_item, config):
+    return {
+        'custom_id': work_item['prompt_text_hash'],
+        'method': 'POST',
+        'url': '/v1/chat/completions',
+        'body': {
+            'model': config.teacher.model,
+            'messages': [{'role': 'user', 'content': work_item['prompt_text']}],
+            },
+        }
+
+
+def get_message(response):
+    r''' Same as `ask_openai`, the message is returned only if the generation finished properly.
+    '''
+    choice = response['choices'][0]
+    if choice['finish_reason'] == 'stop':
+        return choice['message']['content']
+    return None
+
+
+def make_batch_response(custom_id, message=None, error=None):
+    if error is not None:
+        return {'custom_id': custom_id, 'response': None, 'error': {'message': str(error)}}
+    body = {'choices': [{'index': 0, 'finish_reason': 'stop' if message is not None else 'length',
+                         'message': {'role': 'assistant', 'content': message}}]}
+    return {'custom_id': custom_id, 'response': {'status_code': 200, 'body': body}, 'error': None}
+
+
+class OpenAIBatchClient(object):
+    r''' Submits and polls jobs with the OpenAI Batch API.
+    '''
+    def __init__(self, completion_window='24h'):
+        self.completion_window = completion_window
+
+    def _request(self, method, url, params=None):
+        response, _, _ = openai.api_requestor.APIRequestor().request(method, url, params)
+        return response.data
+
+    def submit(self, input_path):
+        with open(input_path, 'rb') as f:
+            input_file = openai.File.create(file=f, purpose='batch')
+        job = self._request('post', '/batches', {'input_file_id': input_file['id'], 'endpoint': '/v1/chat/completions',
+                                                 'completion_window': self.completion_window})
+        return job['id']
+
+    def poll(self, job_id):
+        r''' One of: in_progress, completed, failed
+        '''
+        status = self._request('get', f'/batches/{job_id}')['status']
+        if status in ('failed', 'expired', 'cancelled'):
+            return 'failed'
+        return 'completed' if status == 'completed' else 'in_progress'
+
+    def download(self, job_id, output_path):
+        job = self._request('get', f'/batches/{job_id}')
+        with open(output_path, 'wb') as f:
+            if job.get('output_file_id'):
+                f.write(openai.File.download(job['output_file_id']))
+            if job.get('error_file_id'):
+                f.write(openai.File.download(job['error_file_id']))
+
+
+class LocalBatchClient(object):
+    r''' File based stand-in for a batch service. Every job is a directory with `input.jsonl`, it is processed in a
+    background thread by calling `teacher(prompt, config)` for every request and `output.jsonl` appears when it is done.
+    A job without output that no thread of this process is working on (the process was restarted) is started again
+    when it is polled, and a job whose thread crashed is reported as failed (so it is submitted again).
+
+    Args:
+        teacher (`Callable`):
+            The teacher used to process the requests.
+        config:
+            Passed to the teacher.
+        directory (`str`):
+            Where the jobs are kept.
+        latency (`float`):
+            Extra time (seconds) before a job is completed, to simulate a real batch service.
+    '''
+    def __init__(self, teacher, config, directory, latency=0):
+        self.teacher = teacher
+        self.config = config
+        self.directory = directory
+        self.latency = latency
+        self._running = set()
+        self._lock = threading.Lock()
+
+    def _job_path(self, job_id, name):
+        return os.path.join(self.directory, job_id, name)
+
+    def submit(self, input_path):
+        job_id = f'local_batch_{uuid.uuid4().hex}'
+        os.makedirs(os.path.join(self.directory, job_id))
+        with open(input_path, 'rb') as f_in, open(self._job_path(job_id, 'input.jsonl'), 'wb') as f_out:
+            f_out.write(f_in.read())
+        self._start(job_id)
+        return job_id
+
+    def _start(self, job_id):
+        with self._lock:
+            if job_id in self._running:
+                return
+            self._running.add(job_id)
+        threading.Thread(target=self._run, args=(job_id,), daemon=True).start()
+
+    def _run(self, job_id):
+        try:
+            self._process(job_id)
+        except Exception as e:
+            logging.exception(e)
+            open(self._job_path(job_id, 'failed'), 'w').close()
+
+    def _process(self, job_id):
+        time.sleep(self.latency)
+        responses = []
+        with open(self._job_path(job_id, 'input.jsonl'), encoding='utf-8') as f:
+            requests = [json.loads(line) for line in f]
+        prompts = [request['body']['messages'][-1]['content'] for request in requests]
+        if hasattr(self.teacher, 'generate_batch'):
+            # Local teachers (e.g. HFTeacher) can do the whole job in batches
+            try:
+                messages = self.teacher.generate_batch(prompts)
+                responses = [make_batch_response(request['custom_id'], message=message) for request, message in zip(requests, messages)]
+            except Exception as e:
+                responses = [make_batch_response(request['custom_id'], error=e) for request in requests]
+        else:
+            for request, prompt in zip(requests, prompts):
+                try:
+                    message = self.teacher(prompt, self.config)
+                    responses.append(make_batch_response(request['custom_id'], message=message))
+                except Exception as e:
+                    responses.append(make_batch_response(request['custom_id'], error=e))
+        tmp_path = self._job_path(job_id, 'output.jsonl.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for response in responses:
+                f.write(json.dumps(response) + '\n')
+        os.rename(tmp_path, self._job_path(job_id, 'output.jsonl'))
+
+    def poll(self, job_id):
+        if not os.path.exists(self._job_path(job_id, 'input.jsonl')) or os.path.exists(self._job_path(job_id, 'failed')):
+            return 'failed'
+        if os.path.exists(self._job_path(job_id, 'output.jsonl')):
+            return 'completed'
+        if job_id not in self._running:
+            # Submitted before a restart, nothing is working on it anymore
+            logging.warning(f"Restarting the orphaned batch job: {job_id}")
+            self._start(job_id)
+        return 'in_progress'
+
+    def download(self, job_id, output_path):
+        with open(self._job_path(job_id, 'output.jsonl'), 'rb') as f_in, open(output_path, 'wb') as f_out:
+            f_out.write(f_in.read())
+
+
+def get_batch_client(config, teacher):
+    r''' The batch client based on `config.teacher.batch` (openai/local).
+    '''
+    if config.teacher.batch == 'openai':
+        return OpenAIBatchClient()
+    elif config.teacher.batch == 'local':
+        return LocalBatchClient(teacher, config, os.path.join(config.base_path, config.name, 'batches', 'local_service'),
+                                latency=config.teacher.get('batch_latency', 0))
+    raise ValueError(f"Unknown batch client: {config.teacher.batch}, use one of: openai, local")
+
+
+def dispatch_batch(work_items, client, config, batch_dir, batch_size=50000, poll_interval=30, cache=None):
+    r''' Same as `dispatch_to_teacher`, but the work items are sent as batch jobs. All jobs are submitted first and then
+    polled, the results are yielded in the same order as `work_items`.
+
+    The job id of every submitted batch file is saved in `batch_dir`, so if the generation is restarted with the same work
+    items the running (or finished) jobs are reused instead of being submitted again.
+
+    Yields:
+        (work_item, output, exception):
+            Exception is None if the request was successful, otherwise output is None.
+    '''
+    os.makedirs(batch_dir, exist_ok=True)
+    work_items = list(work_items)
+
+    # Cache hits are not sent
+    outputs = {}
+    if cache is not None:
+        for work_item in work_items:
+            work_item['cache_key'] = cache.get_key(config, work_item['prompt_text'], work_item.get('run', 0))
+            out = cache.get(work_item['cache_key'])
+            if out is not None:
+                outputs[work_item['prompt_text_hash']] = out
+    to_send = [work_item for work_item in work_items if work_item['prompt_text_hash'] not in outputs]
+
+    jobs = []
+    for i in range(0, len(to_send), batch_size):
+        requests = [make_batch_request(work_item, config) for work_item in to_send[i:i + batch_size]]
+        lines = [json.dumps(request) for request in requests]
+        name = hashlib.sha256('\n'.join(lines).encode('utf-8')).hexdigest()[:16]
+        input_path = os.path.join(batch_dir, f'batch_{name}_input.jsonl')
+        state_path = os.path.join(batch_dir, f'batch_{name}_job.json')
+        if os.path.exists(state_path):
+            job_id = json.load(open(state_path))['job_id']
+            logging.warning(f"Reusing the batch job: {job_id}")
+        else:
+            with open(input_path, 'w', encoding='utf-8') as f:
+                f.write('\n'.join(lines) + '\n')
+            job_id = client.submit(input_path)
+            json.dump({'job_id': job_id}, open(state_path, 'w'))
+            logging.warning(f"Submitted the batch job: {job_id} with {len(requests)} requests")
+        jobs.append({'name': name, 'job_id': job_id, 'state_path': state_path, 'work_items': to_send[i:i + batch_size]})
+
+    errors = {}
+    position = 0
+    by_hash = {work_item['prompt_text_hash']: work_item for work_item in to_send}
+    positions = {work_item['prompt_text_hash']: i for i, work_item in enumerate(work_items)}
+    for job in jobs:
+        while True:
+            status = client.poll(job['job_id'])
+            if status != 'in_progress':
+                break
+            time.sleep(poll_interval)
+
+        if status == 'completed':
+            output_path = os.path.join(batch_dir, f"batch_{job['name']}_output.jsonl")
+            client.download(job['job_id'], output_path)
+            with open(output_path, encoding='utf-8') as f:
+                for line in f:
+                    response = json.loads(line)
+                    if response.get('error') or not response.get('response') or response['response']['status_code'] != 200:
+                        errors[response['custom_id']] = RuntimeError(f"Batch request failed: {response.get('error') or response.get('response')}")
+                    else:
+                        outputs[response['custom_id']] = get_message(response['response']['body'])
+                        if cache is not None and response['custom_id'] in by_hash:
+                            cache.put(by_hash[response['custom_id']]['cache_key'], outputs[response['custom_id']])
+        else:
+            for work_item in job['work_items']:
+                errors[work_item['prompt_text_hash']] = RuntimeError(f"The batch job: {job['job_id']} failed")
+            # A restart should submit the failed requests again
+            os.remove(job['state_path'])
+
+        # Yield everything we can, in order
+        last = positions[job['work_items'][-1]['prompt_text_hash']] + 1
+        for work_item in work_items[position:last]:
+            yield _batch_result(work_item, outputs, errors)
+        position = last
+
+    for work_item in work_items[position:]:
+        yield _batch_result(work_item, outputs, errors)
+
+
+def _batch_result(work_item, outputs, errors):
+    h = work_item['prompt_text_hash']
+    if h in outputs:
+        return work_item, outputs[h], None
+    return work_item, None, errors.get(h, RuntimeError("No response in the batch output"))
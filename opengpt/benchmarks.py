@@ -0,0 +1,329 @@
+r'''
+Small CPU benchmarks for the data preparation/training utilities. They use synthetic data, so they can be run
+anywhere, e.g.:
+
+    from opengpt.benchmarks import benchmark_create_labels
+    benchmark_create_labels(config, tokenizer)
+'''
+
+import time
+import logging
+import numpy as np
+
+
+def _time(f, repeats):
+    r''' Best wall time of `repeats` runs, and the output of the last run.
+    '''
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        out = f()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, out
+
+
+def synthetic_conversations(config, tokenizer, n, min_len=32, max_len=512, seed=11):
+    r''' Random token ids organised as conversations: <|user|> ... <|ai|> ... <|eos|> <|eod|>
+    '''
+    rng = np.random.default_rng(seed)
+    st = config.special_tokens
+    user, ai = tokenizer.vocab[st.user], tokenizer.vocab[st.ai]
+    eos, eod = tokenizer.vocab[st.eos], tokenizer.vocab[st.eod]
+    special = {user, ai, eos, eod}
+    vocab_size = min(len(tokenizer.vocab), 30000)
+
+    examples = []
+    for length in rng.integers(min_len, max_len, size=n):
+        ids = []
+        while len(ids) < length - 2:
+            turn = rng.integers(1, max(2, length // 4))
+            ids.append(user)
+            ids.extend(int(t) for t in rng.integers(0, vocab_size, size=turn) if t not in special)
+            ids.extend([eos, ai])
+            ids.extend(int(t) for t in rng.integers(0, vocab_size, size=turn) if t not in special)
+            ids.append(eos)
+        examples.append(ids[:length - 2] + [eos, eod])
+    return examples
+
+
+def benchmark_create_labels(config, tokenizer, batch_sizes=(1, 16, 256, 1000), max_len=512, repeats=3):
+    r''' Compares `create_labels` with the token by token implementation, checks that the output is identical.
+
+    Returns:
+        results (`List[dict]`):
+            batch_size, tokens and the time for both implementations.
+    '''
+    from opengpt.dataset_utils import create_labels, _create_labels_python
+
+    examples = synthetic_conversations(config, tokenizer, max(batch_sizes), max_len=max_len)
+    results = []
+    for batch_size in batch_sizes:
+        batch = examples[:batch_size]
+        t_python, out_python = _time(lambda: _create_labels_python({'input_ids': batch}, config, tokenizer), repeats)
+        t_numpy, out_numpy = _time(lambda: create_labels({'input_ids': batch}, config, tokenizer), repeats)
+        assert out_python['labels'] == out_numpy['labels'], "The outputs of the two implementations are not the same"
+
+        ntokens = sum(len(ids) for ids in batch)
+        results.append({'batch_size': batch_size, 'tokens': ntokens, 'python_s': t_python, 'numpy_s': t_numpy,
+                        'speedup': t_python / max(t_numpy, 1e-12)})
+        logging.warning(f"create_labels, batch_size: {batch_size}, tokens: {ntokens}, python: {t_python*1000:.2f}ms, " +
+                        f"numpy: {t_numpy*1000:.2f}ms, speedup: {results[-1]['speedup']:.1f}x")
+    return results
+
+
+def _collate_pad_sequence(instances, pad_token_id, ignore_index, max_seq_len):
+    r''' The previous DataCollatorWithPadding (a tensor per instance + pad_sequence), used as the baseline.
+    '''
+    import torch
+    input_ids, labels = tuple([torch.tensor(instance[key][0:max_seq_len]) for instance in instances] for key in ("input_ids", "labels"))
+    batch = {}
+    batch['input_ids'] = torch.nn.utils.rnn.pad_sequence(input_ids, batch_first=True, padding_value=pad_token_id)
+    batch['labels'] = torch.nn.utils.rnn.pad_sequence(labels, batch_first=True, padding_value=ignore_index)
+    batch['attention_mask'] = batch['input_ids'].ne(pad_token_id)
+    return batch
+
+
+def benchmark_collator(lengths=None, batch_size=16, max_seq_len=512, pad_to_multiple_of=8, nexamples=20000, max_batches=200, seed=11):
+    r''' Pad-token fraction and collate time per batch for: random batches with the old collator, random batches,
+    `LengthGroupedSampler` and `TokenBudgetBatchSampler` (budget of twice the average number of tokens in a random batch)
+    with the current collator.
+
+    Args:
+        lengths (`List[int]`, optional):
+            Lengths of the examples, e.g. `[len(x) for x in train_dataset['input_ids']]`. If None, lengths
+            are sampled from a log-normal distribution (many short QA pairs, some long conversations).
+    '''
+    from opengpt.data_collator import DataCollatorWithPadding
+    from opengpt.samplers import LengthGroupedSampler, TokenBudgetBatchSampler
+
+    rng = np.random.default_rng(seed)
+    if lengths is None:
+        lengths = np.clip(rng.lognormal(mean=4.5, sigma=0.8, size=nexamples), 8, max_seq_len).astype(int)
+    lengths = np.minimum(np.asarray(lengths), max_seq_len)
+    instances = [{'input_ids': rng.integers(1, 30000, size=length).tolist()} for length in lengths]
+    for instance in instances:
+        instance['labels'] = instance['input_ids']
+
+    def random_batches():
+        indices = rng.permutation(len(lengths)).tolist()
+        return [indices[i:i + batch_size] for i in range(0, len(indices), batch_size)]
+    def grouped_batches():
+        indices = list(LengthGroupedSampler(lengths, batch_size, seed=seed))
+        return [indices[i:i + batch_size] for i in range(0, len(indices), batch_size)]
+    def budget_batches():
+        max_tokens = max(batch_size * int(np.mean(lengths)) * 2, max_seq_len)
+        return list(TokenBudgetBatchSampler(lengths, max_tokens=max_tokens, max_seq_len=max_seq_len, pad_to_multiple_of=pad_to_multiple_of, seed=seed))
+
+    dc = DataCollatorWithPadding(0, -100, max_seq_len, pad_to_multiple_of=pad_to_multiple_of)
+    old_collator = lambda b: _collate_pad_sequence(b, 0, -100, max_seq_len)
+    setups = [('random + old collator', random_batches, old_collator),
+              ('random', random_batches, dc),
+              ('length grouped', grouped_batches, dc),
+              ('token budget', budget_batches, dc)]
+    results = []
+    for name, get_batches, collator in setups:
+        batches = get_batches()[:max_batches]
+        pad = total = 0
+        start = time.perf_counter()
+        for batch in batches:
+            out = collator([instances[ind] for ind in batch])
+            total += out['input_ids'].numel()
+            pad += int((~out['attention_mask']).sum())
+        elapsed = time.perf_counter() - start
+        results.append({'setup': name, 'batches': len(batches), 'pad_fraction': pad / max(total, 1),
+                        'collate_ms_per_batch': elapsed * 1000 / max(len(batches), 1),
+                        'examples_per_batch': sum(len(b) for b in batches) / max(len(batches), 1)})
+        logging.warning(f"{name}: pad fraction: {results[-1]['pad_fraction']:.3f}, collate time: {results[-1]['collate_ms_per_batch']:.3f}ms/batch, " + 
+                        f"examples per batch: {results[-1]['examples_per_batch']:.1f}")
+    return results
+
+
+def benchmark_teacher(teacher, prompts, config, concurrency=1):
+    r''' Runs the prompts through a teacher (e.g. `ask_openai` or `HFTeacher`) the same way `create_dataset` does and
+    reports prompts/s and tokens/s, the tokens are counted with the tokenizer of the teacher if it has one, otherwise
+    as whitespace separated words.
+    '''
+    from opengpt.dataset_utils import dispatch_to_teacher
+
+    tokenizer = getattr(teacher, 'tokenizer', None)
+    count = (lambda text: len(tokenizer.encode(text))) if tokenizer is not None else (lambda text: len(text.split()))
+    work_items = [{'prompt_text': prompt, 'prompt_text_hash': str(i), 'run': 0} for i, prompt in enumerate(prompts)]
+
+    start = time.perf_counter()
+    outputs = [(work_item, output, e) for work_item, output, e in dispatch_to_teacher(work_items, teacher, config, max_in_flight=concurrency)]
+    elapsed = time.perf_counter() - start
+
+    ntokens = sum(count(work_item['prompt_text']) + (count(output) if output else 0) for work_item, output, _ in outputs)
+    result = {'prompts': len(prompts), 'concurrency': concurrency, 'seconds': elapsed, 'failures': sum(e is not None for _, _, e in outputs),
+              'prompts_per_s': len(prompts) / elapsed, 'tokens_per_s': ntokens / elapsed}
+    logging.warning(f"Teacher: {len(prompts)} prompts in {elapsed:.2f}s, concurrency: {concurrency}, " +
+                    f"{result['prompts_per_s']:.2f} prompts/s, {result['tokens_per_s']:.1f} tokens/s")
+    return result
+
+
+def _legacy_parsers():
+    r''' The previous parsers (a DataFrame per call, several regex passes, string concatenation), used as the baseline.
+    '''
+    import re
+    import pandas as pd
+    from io import StringIO
+
+    def csv_qa_parser(data, prompt_config, config, row, raw_data_id, prompt_text):
+        df = pd.read_csv(StringIO(data), sep=';')
+        df = df.applymap(lambda x: x.strip() if isinstance(x, str) else x)
+        ref_col = prompt_config.get('reference_column_to_append', None)
+        if ref_col and row is not None and ref_col in row and row[ref_col]:
+            df['Answer'] = df['Answer'] + f"\nReferences:\n- {row[ref_col]}"
+        df['Question'] += f' {config.special_tokens.eos}'
+        df['Answer'] += f' {config.special_tokens.eos} {config.special_tokens.eod}'
+        qa_pairs = [f'{config.special_tokens.user} {q.strip()} {config.special_tokens.ai} {a.strip()}' for q,a in df[['Question', 'Answer']].values]
+        return [{'text': text, 'raw_data_id': raw_data_id} for text in qa_pairs]
+
+    def task_parser(data, prompt_config, config, row, raw_data_id, prompt_text):
+        st = config.special_tokens
+        new_data = []
+        for task in re.split(r'[1-9 \.]*Task[:\s]*', str(data)):
+            task = task.strip()
+            if not task:
+                continue
+            ins = re.search(r'Instruction:?(.*?)Input:', task, re.DOTALL).group(1).strip()
+            inp = re.search(r'Input:?(.*?)Output:?', task, re.DOTALL).group(1).strip()
+            out = re.search(r'Output:?(.*?)$', task, re.DOTALL).group(1).strip()
+            if inp:
+                if inp.startswith('"'):
+                    inp = inp[1:]
+                if inp.endswith('"'):
+                    inp = inp[:-1]
+                inp = '' if inp == '<noinput>' else '\n' + str(inp)
+            if ins and out:
+                inp = '' if inp in ins else inp
+                new_data.append({'text': f'{st.user} {ins}{inp} {st.eos} {st.ai} {out} {st.eos} {st.eod}', 'raw_data_id': raw_data_id})
+        return new_data
+
+    def medical_conversation_parser(data, prompt_config, config, row, raw_data_id, prompt_text):
+        conversation = None
+        data = re.split(r'\s*(Patient\s*:|AI-Assistant\s*:)\s*', data)[1:]
+        if len(data) > 0:
+            conversation = ""
+            to_append = None
+            ref_col = prompt_config.get('reference_column_to_append', None)
+            if ref_col and ref_col in row and row[ref_col]:
+                to_append = f"\nReferences:\n- {row[ref_col]}"
+            actor = None
+            for message in data:
+                message = message.strip()
+                if message in ['Patient:', 'AI-Assistant:', 'Patient', 'AI-Assistant', 'Patient :', 'AI-Assistant :']:
+                    actor = message
+                elif actor is not None:
+                    if actor in ['Patient:', 'Patient :', 'Patient']:
+                        conversation += f'{config.special_tokens.user} {message} {config.special_tokens.eos} '
+                    elif actor in ['AI-Assistant:', 'AI-Assistant :', 'AI-Assistant']:
+                        conversation += f'{config.special_tokens.ai} {message}'
+                        if to_append is not None and to_append:
+                            conversation += to_append
+                        conversation += f" {config.special_tokens.eos} "
+            if conversation:
+                conversation = conversation.strip() + f" {config.special_tokens.eod}"
+        return [{'text': conversation, 'raw_data_id': raw_data_id}]
+
+    return {'csv_qa_parser': csv_qa_parser, 'task_parser': task_parser, 'medical_conversation_parser': medical_conversation_parser}
+
+
+def benchmark_parsers(config, raw_data_path, prompt_db_path=None, repeats=3):
+    r''' Parses every raw teacher output in `raw_data_path` (e.g. `raw_generated_data_for_example_project.csv`) with the
+    parser of its prompt, using the previous parsers and the current ones. Reports outputs/s and MB/s per parser, the
+    number of parse failures and checks that the output is the same wherever the previous parser did not crash.
+    '''
+    import pandas as pd
+    from opengpt import parsers
+    from opengpt.prompt_utils import PromptStore
+
+    raw_data = pd.read_csv(raw_data_path)
+    prompt_db = PromptStore.load(prompt_db_path or config.path.prompt_db)
+    prompt_configs = {h: prompt_config for prompt_config in getattr(config, 'prompts', []) for h in prompt_config['hashes']}
+    legacy = _legacy_parsers()
+
+    examples = {}
+    for raw_output, prompt_hash in raw_data[['raw_output', 'prompt_hash']].values:
+        if prompt_hash in prompt_db and isinstance(raw_output, str):
+            examples.setdefault(prompt_db[prompt_hash]['parser'], []).append((raw_output, dict(prompt_configs.get(prompt_hash, {}))))
+
+    results = []
+    for name, batch in examples.items():
+        nbytes = sum(len(raw_output.encode('utf-8')) for raw_output, _ in batch)
+        def run_current():
+            out, failures = [], []
+            for raw_output, prompt_config in batch:
+                try:
+                    out.append(parsers.run_parser(getattr(parsers, name), raw_output, prompt_config, config, {}, 0, '', failures=failures))
+                except parsers.ParseError as e:
+                    out.append(None)
+                    failures.append({'reason': str(e)})
+            return out, failures
+        def run_legacy():
+            out = []
+            for raw_output, prompt_config in batch:
+                try:
+                    out.append(legacy[name](raw_output, prompt_config, config, {}, 0, ''))
+                except Exception:
+                    out.append(None)
+            return out
+
+        t_current, (out_current, failures) = _time(run_current, repeats)
+        result = {'parser': name, 'outputs': len(batch), 'MB': nbytes / 2**20, 'failures': len(failures)}
+        if name in legacy:
+            t_legacy, out_legacy = _time(run_legacy, repeats)
+            result['legacy_crashes'] = sum(x is None for x in out_legacy)
+            result['mismatches'] = sum(o is not None and o != n for o, n in zip(out_legacy, out_current))
+            result['legacy_outputs_per_s'] = len(batch) / t_legacy
+            result['speedup'] = t_legacy / max(t_current, 1e-12)
+        result['outputs_per_s'] = len(batch) / t_current
+        result['MB_per_s'] = result['MB'] / t_current
+        results.append(result)
+        logging.warning(f"{name}: {len(batch)} outputs, {result['outputs_per_s']:.0f} outputs/s, {result['MB_per_s']:.2f} MB/s, " +
+                        f"failures: {len(failures)}" + (f", speedup over the previous parser: {result['speedup']:.1f}x, " +
+                        f"mismatches: {result['mismatches']}" if name in legacy else ''))
+    return results
+
+
+STARTUP_MODULES = ('opengpt.config', 'opengpt.parsers', 'opengpt.prompt_utils', 'opengpt.teachers', 'opengpt.dataset_utils', 'opengpt.sharding')
+def benchmark_startup(yaml_path=None, modules=STARTUP_MODULES, repeats=3):
+    r''' Import time of the modules (and the time to load the config at `yaml_path`, with `Config(yaml_path)` and
+    with `Config.load_compiled(yaml_path)`, with and without Box), every measurement is done in a new python process.
+    Also lists the heavy dependencies that were imported. The compiled config is kept in a temporary directory.
+    '''
+    import os
+    import sys
+    import json
+    import tempfile
+    import subprocess
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    heavy = ['pandas', 'numpy', 'torch', 'openai', 'transformers', 'tqdm', 'box', 'yaml', 'jsonpickle']
+    def run(code):
+        script = (f"import sys, time, json; sys.path.insert(0, {root!r}); start = time.perf_counter()\n{code}\n" +
+                  f"print(json.dumps([time.perf_counter() - start, [m for m in {heavy!r} if m in sys.modules]]))")
+        best = None
+        for _ in range(repeats):
+            out = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, check=True).stdout
+            seconds, imported = json.loads(out.strip().splitlines()[-1])
+            best = (seconds, imported) if best is None or seconds < best[0] else best
+        return best
+
+    cases = [(f'import {module}', f'import {module}') for module in modules]
+    if yaml_path is not None:
+        yaml_path = os.path.abspath(yaml_path)
+        compiled_path = os.path.join(tempfile.mkdtemp(), 'config.compiled.json')
+        load = f"from opengpt.config import Config; Config.load_compiled({yaml_path!r}, compiled_path={compiled_path!r}"
+        cases.append(('Config(yaml_path)', f"from opengpt.config import Config; Config({yaml_path!r})"))
+        # The first call compiles, the measured ones read the compiled json
+        run(load + ")")
+        cases.append(('Config.load_compiled(yaml_path)', load + ")"))
+        cases.append(('Config.load_compiled(yaml_path, to_box=False)', load + ", to_box=False)"))
+    results = []
+    for name, code in cases:
+        seconds, imported = run(code)
+        results.append({'case': name, 'seconds': seconds, 'imported': imported})
+        logging.warning(f"{name}: {seconds * 1000:.0f}ms, imported: {imported}")
+    return results
@@ -1,7 +1,22 @@
-from box import Box
-import jsonpickle
 import os
-import yaml
+import json
+import hashlib
+import logging
+from opengpt.lazy import lazy_import
+
+# Only needed when a yaml/jsonpickle file is read, or the config is converted to Box
+box = lazy_import('box')
+yaml = lazy_import('yaml')
+jsonpickle = lazy_import('jsonpickle')
+
+def get_compiled_path(yaml_path):
+    r''' Where `Config.load_compiled` keeps the compiled json of a yaml, in `$OPENGPT_CACHE` (by default
+    `~/.cache/opengpt`) and not next to the yaml, so that nothing is written into the repository.
+    '''
+    cache_dir = os.environ.get('OPENGPT_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'opengpt'))
+    name = hashlib.sha256(os.path.abspath(yaml_path).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(cache_dir, 'configs', f'{os.path.basename(yaml_path)}.{name}.compiled.json')
+
 
 class BaseConfig(object):
     def __init__(self, to_box=False):
@@ -11,14 +26,29 @@ class BaseConfig(object):
         # Convert all dicts to boxes
         for key, val in self.__dict__.items():
             if isinstance(val, dict):
-                self.__setattr__(key, Box(val))
+                self.__setattr__(key, box.Box(val))
 
     def _from_box(self):
         # Convert all dicts to boxes
         for key, val in self.__dict__.items():
-            if isinstance(val, Box):
+            if isinstance(val, dict) and hasattr(val, 'to_dict'):
                 self.__setattr__(key, val.to_dict())
 
+    def to_dict(self):
+        r''' The config as a dict of plain python objects (no Box), i.e. everything that can be saved as json.
+        '''
+        return {k: v.to_dict() if isinstance(v, dict) and hasattr(v, 'to_dict') else v for k, v in self.__dict__.items()}
+
+    @classmethod
+    def from_dict(cls, config_dict, to_box=True):
+        r''' A config from `to_dict`, nothing is parsed or validated and no directories are created.
+        '''
+        config = cls.__new__(cls)
+        config.__dict__.update(json.loads(json.dumps(config_dict))) # A copy, so that the dict can be reused
+        if to_box:
+            config._to_box()
+        return config
+
     def save(self, save_path=None):
         r''' Save the config into a .json file
         Args:
@@ -28,20 +58,18 @@ class BaseConfig(object):
         if save_path is None:
             save_path = self.path.self
 
-        # We want to save the dict here, not the whole class
-        self._from_box()
-        json_string = jsonpickle.encode({k:v for k,v in self.__dict__.items() if k != 'path'})
-
+        # We want to save the dict here, not the whole class, as plain json
         with open(save_path, 'w') as f:
-            f.write(json_string)
-        self._to_box()
+            json.dump({k:v for k,v in self.to_dict().items() if k != 'path'}, f)
 
     @classmethod
     def load(cls, save_path):
-        config = cls(to_box=False)
-        # Read the jsonpickle string
+        # Config.__init__ needs a yaml
+        config = cls.__new__(cls)
         with open(save_path) as f:
-            config_dict = jsonpickle.decode(f.read())
+            json_string = f.read()
+        # Configs saved with older versions are jsonpickle strings
+        config_dict = jsonpickle.decode(json_string) if '"py/' in json_string else json.loads(json_string)
         config.merge_config(config_dict)
         config._to_box()
         return config
@@ -69,6 +97,88 @@ class Config(BaseConfig):
     def reload_yaml(self):
         self.load_yaml(self.yaml_path)
 
+    @classmethod
+    def load_compiled(cls, yaml_path, compiled_path=None, to_box=None):
+        r''' Loads the config from a compiled json (see `get_compiled_path`). The yaml is parsed, validated and compiled
+        only when it changed, so this is much faster than `Config(yaml_path)` in short lived processes (workers,
+        scripts). Directories are created only when the config is compiled.
+
+        Args:
+            yaml_path (`str`):
+                Path to the yaml config.
+            compiled_path (`str`, optional):
+                Where to keep the compiled json, by default in the cache directory.
+            to_box (`bool`, optional):
+                Convert the dicts to Box, by default `to_box` of the yaml. Without Box the `box` package is not
+                imported at all, but the config has to be used as dicts (config.teacher['model']).
+        '''
+        compiled_path = compiled_path or get_compiled_path(yaml_path)
+        stat = os.stat(yaml_path)
+        stamp = [stat.st_mtime_ns, stat.st_size]
+        if os.path.exists(compiled_path):
+            try:
+                with open(compiled_path) as f:
+                    compiled = json.load(f)
+                if compiled['stamp'] == stamp and compiled['yaml_path'] == os.path.abspath(yaml_path):
+                    return cls.from_dict(compiled['config'], to_box=compiled['config'].get('to_box', True) if to_box is None else to_box)
+            except (ValueError, KeyError):
+                logging.warning(f"The compiled config: {compiled_path} is broken, it will be recreated.")
+
+        config = cls(yaml_path)
+        config.validate()
+        os.makedirs(os.path.dirname(os.path.abspath(compiled_path)), exist_ok=True)
+        tmp_path = f'{compiled_path}.tmp{os.getpid()}'
+        with open(tmp_path, 'w') as f:
+            json.dump({'yaml_path': os.path.abspath(yaml_path), 'stamp': stamp, 'config': config.to_dict()}, f)
+        os.replace(tmp_path, compiled_path)
+        if to_box is False:
+            config._from_box()
+        return config
+
+    def validate(self):
+        r''' Raises a ValueError that lists everything wrong with the config, only the parts that are set are checked.
+        '''
+        problems = []
+        if not isinstance(getattr(self, 'name', None), str):
+            problems.append("`name` has to be a string")
+        dataset_names = set()
+        for i, ds in enumerate(getattr(self, 'datasets', None) or []):
+            if not isinstance(ds, dict) or not ds.get('name') or not ds.get('path'):
+                problems.append(f"datasets[{i}] needs a `name` and a `path`")
+            else:
+                dataset_names.add(ds['name'])
+        for i, prompt_config in enumerate(getattr(self, 'prompts', None) or []):
+            if not isinstance(prompt_config, dict) or not prompt_config.get('hashes'):
+                problems.append(f"prompts[{i}] needs `hashes`")
+                continue
+            # Prompts without input (e.g. create_dataset_no_input) have no datasets
+            if 'datasets' not in prompt_config:
+                continue
+            datasets = prompt_config['datasets']
+            if not isinstance(datasets, list) or not all(isinstance(name, str) for name in datasets):
+                problems.append(f"prompts[{i}].datasets has to be a list of dataset names")
+                continue
+            base_path = getattr(self, 'base_path', './')
+            # Can be fine, if the datasets were split with another config
+            unknown = [name for name in datasets if name not in dataset_names and
+                       not os.path.exists(os.path.join(base_path, name, 'data_split_by_length.csv'))]
+            if unknown:
+                logging.warning(f"prompts[{i}] uses datasets that are not in `datasets` and were not split: {unknown}")
+        teacher = getattr(self, 'teacher', None)
+        if teacher is not None and (not isinstance(teacher, dict) or not teacher.get('name')):
+            problems.append("`teacher` needs a `name`")
+        train = getattr(self, 'train', None)
+        if train is not None and (not isinstance(train, dict) or not isinstance(train.get('datasets', []), list)):
+            problems.append("`train.datasets` has to be a list of paths")
+        elif train is not None and train.get('dataset_weights') is not None and len(train['dataset_weights']) != len(train.get('datasets', [])):
+            problems.append("`train.dataset_weights` needs one weight for every dataset in `train.datasets`")
+        try:
+            json.dumps(self.to_dict())
+        except (TypeError, ValueError) as e:
+            problems.append(f"The config can not be saved as json: {e}")
+        if problems:
+            raise ValueError("Problems in the config:\n- " + "\n- ".join(problems))
+
     def load_yaml(self, yaml_path):
         _config = yaml.safe_load(open(yaml_path, 'r'))
         self.to_box = True
@@ -0,0 +1,166 @@
+r'''
+Pre-tokenized training corpus. The CSVs from `config.train.datasets` are tokenized, labeled and packed once, and saved as
+flat memory-mapped arrays:
+    - input_ids.bin: all token ids (uint16 if the vocab allows, otherwise uint32)
+    - label_mask.bin: uint8, 1 where the token is trained on (labels are either the token itself or ignore_index)
+    - position_ids.bin: only if `config.train.add_position_ids` is set
+    - offsets.npy: int64, example i is input_ids[offsets[i]:offsets[i+1]]
+
+The directory name is a hash of the input files, the tokenizer and the relevant parts of the config, so the corpus is
+rebuilt only when something changes. Loading is zero-copy and the memory is shared between dataloader workers:
+
+    path = build_corpus(config, tokenizer)
+    train_dataset = PretokenizedDataset(path, ignore_index=config.train.ignore_index)
+'''
+
+import os
+import json
+import shutil
+import hashlib
+import logging
+import numpy as np
+import pandas as pd
+import torch
+from functools import partial
+from tqdm.auto import tqdm
+from opengpt.dataset_utils import create_labels, pack_examples, imap_ordered
+
+
+def _file_hash(path, block_size=2**20):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def get_corpus_key(config, tokenizer):
+    r''' Content hash of everything that changes the pre-tokenized corpus.
+    '''
+    h = hashlib.sha256()
+    for path in config.train.datasets:
+        h.update(_file_hash(path).encode('utf-8'))
+    vocab = tokenizer.get_vocab() if hasattr(tokenizer, 'get_vocab') else tokenizer.vocab
+    h.update(type(tokenizer).__name__.encode('utf-8'))
+    h.update(json.dumps(sorted(vocab.items())).encode('utf-8'))
+    params = {
+        'special_tokens': dict(config.special_tokens),
+        'ignore_index': config.train.ignore_index,
+        'max_seq_len': config.train.max_seq_len,
+        'packing_type': config.train.packing_type,
+        'add_position_ids': config.train.get('add_position_ids', False),
+        }
+    h.update(json.dumps(params, sort_keys=True).encode('utf-8'))
+    return h.hexdigest()[:16]
+
+
+def _process_chunk(texts, config, tokenizer):
+    r''' Tokenize, label and pack one chunk of texts, the same as the map steps in the training notebook.
+    '''
+    examples = {'input_ids': tokenizer(texts, add_special_tokens=False)['input_ids']}
+    examples = create_labels(examples, config, tokenizer)
+    examples = pack_examples(examples, config.train.max_seq_len, packing_type=config.train.packing_type,
+                             add_position_ids=config.train.get('add_position_ids', False))
+    out = {'input_ids': examples['input_ids'],
+           'label_mask': [[label != config.train.ignore_index for label in labels] for labels in examples['labels']]}
+    if 'position_ids' in examples:
+        out['position_ids'] = examples['position_ids']
+    return out
+
+
+def build_corpus(config, tokenizer, output_dir=None, chunksize=1000, num_proc=1, force=False):
+    r''' Builds the pre-tokenized corpus (if it does not exist already) and returns the path to it.
+
+    Args:
+        config:
+            The train config, uses `train.datasets`, `train.max_seq_len`, `train.packing_type` and the special tokens.
+        tokenizer:
+            HF tokenizer with the special tokens already added.
+        output_dir (`str`, optional):
+            Where to save the corpora, by default `<base_path>/pretokenized/`.
+        chunksize (`int`):
+            Rows read from the CSVs at a time, packing is done within a chunk (like `batch_size` in `datasets.map`).
+        num_proc (`int`):
+            Number of processes used for tokenization.
+        force (`bool`):
+            Rebuild even if the corpus exists.
+    '''
+    if output_dir is None:
+        output_dir = os.path.join(config.base_path, 'pretokenized')
+    path = os.path.join(output_dir, get_corpus_key(config, tokenizer))
+    if os.path.exists(os.path.join(path, 'meta.json')) and not force:
+        logging.warning(f"Using the existing pre-tokenized corpus at: {path}")
+        return path
+
+    dtype = np.uint16 if len(tokenizer) <= np.iinfo(np.uint16).max + 1 else np.uint32
+    tmp_path = path + '.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    add_position_ids = config.train.get('add_position_ids', False)
+    names = ['input_ids', 'label_mask'] + (['position_ids'] if add_position_ids else [])
+    dtypes = {'input_ids': dtype, 'label_mask': np.uint8, 'position_ids': np.uint32}
+    files = {name: open(os.path.join(tmp_path, f'{name}.bin'), 'wb') for name in names}
+    offsets = [0]
+    try:
+        def chunks():
+            for csv_path in config.train.datasets:
+                for df in pd.read_csv(csv_path, usecols=['text'], chunksize=chunksize):
+                    yield df['text'].fillna('').astype(str).tolist()
+
+        process = partial(_process_chunk, config=config, tokenizer=tokenizer)
+        for _, out in tqdm(imap_ordered(process, chunks(), num_proc), desc='Chunks'):
+            for name in names:
+                if out[name]:
+                    files[name].write(np.concatenate([np.asarray(x, dtype=dtypes[name]) for x in out[name]]).tobytes())
+            for ids in out['input_ids']:
+                offsets.append(offsets[-1] + len(ids))
+    finally:
+        for f in files.values():
+            f.close()
+
+    np.save(os.path.join(tmp_path, 'offsets.npy'), np.asarray(offsets, dtype=np.int64))
+    meta = {'dtype': np.dtype(dtype).name, 'nexamples': len(offsets) - 1, 'ntokens': offsets[-1], 'datasets': list(config.train.datasets),
+            'packing_type': config.train.packing_type, 'max_seq_len': config.train.max_seq_len, 'position_ids': add_position_ids}
+    json.dump(meta, open(os.path.join(tmp_path, 'meta.json'), 'w'), indent=2)
+    shutil.rmtree(path, ignore_errors=True)
+    os.rename(tmp_path, path)
+    logging.warning(f"Pre-tokenized corpus with {meta['nexamples']} examples and {meta['ntokens']} tokens saved to: {path}")
+    return path
+
+
+class PretokenizedDataset(torch.utils.data.Dataset):
+    r''' Reads a corpus created with `build_corpus`, nothing is loaded into memory except the offsets. Every item
+    is a dict with `input_ids`, `labels` (and `position_ids`) that can be used with the `DataCollatorWithPadding`.
+    '''
+    def __init__(self, path, ignore_index=-100):
+        self.path = path
+        self.ignore_index = ignore_index
+        self.meta = json.load(open(os.path.join(path, 'meta.json')))
+        self.offsets = np.load(os.path.join(path, 'offsets.npy'), mmap_mode='r')
+        self.input_ids = self._memmap('input_ids', self.meta['dtype'])
+        self.label_mask = self._memmap('label_mask', np.uint8)
+        self.position_ids = self._memmap('position_ids', np.uint32) if self.meta['position_ids'] else None
+
+    def _memmap(self, name, dtype):
+        file_path = os.path.join(self.path, f'{name}.bin')
+        if os.path.getsize(file_path) == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(file_path, dtype=dtype, mode='r')
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def lengths(self):
+        r''' Length of every example, can be used with the samplers from `opengpt.samplers`.
+        '''
+        return np.diff(self.offsets)
+
+    def __getitem__(self, ind):
+        start, end = self.offsets[ind], self.offsets[ind + 1]
+        input_ids = self.input_ids[start:end].astype(np.int64)
+        item = {'input_ids': input_ids,
+                'labels': np.where(self.label_mask[start:end].astype(bool), input_ids, self.ignore_index)}
+        if self.position_ids is not None:
+            item['position_ids'] = self.position_ids[start:end].astype(np.int64)
+        return item
@@ -1,19 +1,89 @@
 import torch
+import numpy as np
 
 class DataCollatorWithPadding(object):
     r''' Will pad or trim examples to the appropriate length.
+
+    If the examples have `position_ids` (see `pack_examples(..., add_position_ids=True)`) they are padded and passed
+    to the model. With `packed_attention_mask` the attention_mask becomes a 4D (batch, 1, seq_len, seq_len) causal mask
+    where tokens only attend to tokens of the same packed example (a new example starts wherever position_ids is 0),
+    this requires a model that accepts custom 4D attention masks. The mask is bool (True means attend), which works with
+    sdpa attention; for eager attention set `attention_mask_dtype` to the dtype of the model to get an additive float
+    mask (0 / finfo.min).
+
+    With `return_segment_ids` the batch also has `segment_ids` (1, 2, 3... for the packed examples in a row, 0 for
+    padding) and `cu_seqlens` (boundaries of all packed examples, see `get_cu_seqlens`). HF models do not take these,
+    they are for custom training loops or models with varlen attention.
+
+    With `pad_to_multiple_of` (e.g. 8 or 64) the batch is padded to a multiple of that length, which is faster on
+    tensor cores. Use it together with one of the samplers from `opengpt.samplers` to minimize padding.
     '''
-    def __init__(self, pad_token_id, ignore_index, max_seq_len):
+    def __init__(self, pad_token_id, ignore_index, max_seq_len, packed_attention_mask=False, pad_to_multiple_of=None,
+                 attention_mask_dtype=None, return_segment_ids=False):
         self.pad_token_id = pad_token_id
         self.ignore_index = ignore_index
         self.max_seq_len = max_seq_len
+        self.packed_attention_mask = packed_attention_mask
+        self.pad_to_multiple_of = pad_to_multiple_of
+        self.attention_mask_dtype = attention_mask_dtype
+        self.return_segment_ids = return_segment_ids
+
+    def _pad(self, sequences, padding_value, seq_len):
+        # One array for the whole batch, instead of a tensor per instance
+        out = np.full((len(sequences), seq_len), padding_value, dtype=np.int64)
+        for i, sequence in enumerate(sequences):
+            out[i, :len(sequence)] = sequence
+        return torch.from_numpy(out)
 
     def __call__(self, instances):
-        input_ids, labels = tuple([torch.tensor(instance[key][0:self.max_seq_len]) for instance in instances] for key in ("input_ids", "labels"))
+        input_ids = [instance['input_ids'][0:self.max_seq_len] for instance in instances]
+        seq_len = max(len(x) for x in input_ids)
+        if self.pad_to_multiple_of:
+            seq_len = -(-seq_len // self.pad_to_multiple_of) * self.pad_to_multiple_of
         batch = {}
-        
-        batch['input_ids'] = torch.nn.utils.rnn.pad_sequence(input_ids, batch_first=True, padding_value=self.pad_token_id) 
-        batch['labels'] = torch.nn.utils.rnn.pad_sequence(labels, batch_first=True, padding_value=self.ignore_index)
+
+        batch['input_ids'] = self._pad(input_ids, self.pad_token_id, seq_len)
+        batch['labels'] = self._pad([instance['labels'][0:self.max_seq_len] for instance in instances], self.ignore_index, seq_len)
         batch['attention_mask'] = batch['input_ids'].ne(self.pad_token_id)
-    
-        return batch
\ No newline at end of file
+
+        if 'position_ids' in instances[0]:
+            batch['position_ids'] = self._pad([instance['position_ids'][0:self.max_seq_len] for instance in instances], 0, seq_len)
+            if self.return_segment_ids:
+                batch['segment_ids'] = get_segment_ids(batch['position_ids'], batch['attention_mask'])
+                batch['cu_seqlens'] = get_cu_seqlens(batch['position_ids'], batch['attention_mask'])
+            if self.packed_attention_mask:
+                batch['attention_mask'] = get_packed_attention_mask(batch['position_ids'], batch['attention_mask'], dtype=self.attention_mask_dtype)
+
+        return batch
+
+
+def get_segment_ids(position_ids, attention_mask):
+    r''' 1, 2, 3.. for every packed example in a row (a new one starts wherever position_ids is 0), 0 for padding.
+    '''
+    return torch.cumsum(position_ids.eq(0), dim=1) * attention_mask
+
+
+def get_cu_seqlens(position_ids, attention_mask):
+    r''' Cumulative sequence lengths of all packed examples in the batch (flattened), as used by varlen attention kernels.
+    '''
+    segment_ids = get_segment_ids(position_ids, attention_mask)
+    # Unique (row, segment) pairs, in order
+    keys = (torch.arange(segment_ids.shape[0], device=segment_ids.device)[:, None] * (segment_ids.shape[1] + 1) + segment_ids)[segment_ids > 0]
+    _, lengths = torch.unique_consecutive(keys, return_counts=True)
+    return torch.nn.functional.pad(torch.cumsum(lengths, dim=0, dtype=torch.int32), (1, 0))
+
+
+def get_packed_attention_mask(position_ids, attention_mask, dtype=None):
+    r''' Block diagonal causal mask (batch, 1, seq_len, seq_len), True means attend. Padding tokens attend only to
+    themselves, so that no row is fully masked. With a float `dtype` the mask is additive instead: 0 where tokens
+    attend and the smallest value of the dtype elsewhere.
+    '''
+    segment_ids = get_segment_ids(position_ids, attention_mask)
+    seq_len = segment_ids.shape[1]
+    causal = torch.ones(seq_len, seq_len, dtype=torch.bool, device=segment_ids.device).tril()
+    same_segment = segment_ids[:, :, None].eq(segment_ids[:, None, :]) & segment_ids[:, :, None].gt(0)
+    eye = torch.eye(seq_len, dtype=torch.bool, device=segment_ids.device)
+    mask = ((same_segment & causal) | eye)[:, None, :, :]
+    if dtype is None or dtype == torch.bool:
+        return mask
+    return torch.zeros(mask.shape, dtype=dtype, device=mask.device).masked_fill(~mask, torch.finfo(dtype).min)
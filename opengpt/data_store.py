@@ -0,0 +1,106 @@
+import os
+import logging
+from opengpt.lazy import lazy_import
+
+pd = lazy_import('pandas')
+
+
+class CSVAppendStore(object):
+    r''' Append-only CSV writer used for the raw and prepared data. New rows are kept in a buffer and appended to the
+    end of the CSV on `flush`, followed by an fsync. The cost of a checkpoint is proportional to the number of new rows,
+    and if something crashes only the rows that were not flushed yet are lost.
+
+    Rows can have keys that are not in the columns yet (e.g. parsers with different outputs), the new columns are then
+    added at the end and the existing CSV is rewritten once with them (empty for the old rows), as pd.concat would do.
+
+    Args:
+        path (`str`):
+            Where the CSV is, if it exists already new rows are appended to it.
+        columns (`List[str]`, optional):
+            Columns of the CSV, if not provided they are taken from the existing CSV or from the first appended rows.
+        fsync (`bool`):
+            Call fsync after every flush, disable only if speed is more important than durability.
+    '''
+    def __init__(self, path, columns=None, fsync=True):
+        self.path = path
+        self.fsync = fsync
+        self.columns = list(columns) if columns is not None else None
+        self.buffer = []
+        self.nrows = 0
+        self._header_written = False
+
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            existing_columns = list(pd.read_csv(path, nrows=0).columns)
+            if self.columns is not None and self.columns != existing_columns:
+                logging.warning(f"The columns of {path} are: {existing_columns}, and not: {self.columns}. The existing ones will be used.")
+            self.columns = existing_columns
+            self._header_written = True
+
+    def __len__(self):
+        r''' Number of rows appended with this store (flushed or not), does not include rows that existed before.
+        '''
+        return self.nrows + len(self.buffer)
+
+    def append(self, rows):
+        r''' Append rows, either a DataFrame or a list of dicts.
+        '''
+        if isinstance(rows, pd.DataFrame):
+            if self.columns is None:
+                self.columns = list(rows.columns)
+            rows = rows.to_dict('records')
+        elif self.columns is None and len(rows) > 0:
+            self.columns = list(rows[0].keys())
+        self.buffer.extend(rows)
+
+    def _add_columns(self, new_columns):
+        r''' Adds columns to the store, the CSV (if it was written already) is rewritten in chunks with the new header.
+        '''
+        logging.warning(f"New columns: {new_columns} in: {self.path}, the existing rows will have them empty.")
+        self.columns = self.columns + new_columns
+        if not self._header_written:
+            return
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            header = True
+            for df in pd.read_csv(self.path, chunksize=100000, dtype=str, keep_default_na=False):
+                df.reindex(columns=self.columns).to_csv(f, index=False, header=header)
+                header = False
+            if header:
+                pd.DataFrame(None, columns=self.columns).to_csv(f, index=False)
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def flush(self):
+        r''' Write everything from the buffer to disk. The CSV is created even if there is nothing to write (only the
+        header, or an empty file if the columns are not known yet), so that a run without rows can be continued.
+        '''
+        if not self.buffer:
+            if not os.path.exists(self.path):
+                with open(self.path, 'w', encoding='utf-8') as f:
+                    if self.columns is not None:
+                        pd.DataFrame(None, columns=self.columns).to_csv(f, index=False)
+                self._header_written = self.columns is not None
+            return
+        known = set(self.columns)
+        new_columns = list(dict.fromkeys(k for row in self.buffer for k in row if k not in known))
+        if new_columns:
+            self._add_columns(new_columns)
+        df = pd.DataFrame(self.buffer, columns=self.columns)
+        with open(self.path, 'a', encoding='utf-8') as f:
+            df.to_csv(f, index=False, header=not self._header_written)
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        self._header_written = True
+        self.nrows += len(self.buffer)
+        self.buffer = []
+
+    def read(self):
+        r''' Load the whole CSV as a DataFrame (flushing first).
+        '''
+        self.flush()
+        if not os.path.exists(self.path) or os.path.getsize(self.path) == 0:
+            return pd.DataFrame(None, columns=self.columns)
+        return pd.read_csv(self.path)
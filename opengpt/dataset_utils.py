@@ -1,17 +1,109 @@
-import pandas as pd
 import math
 import os
-import json
 import hashlib
-from tqdm.auto import tqdm
-from opengpt import parsers, teachers
+from opengpt import parsers
+from opengpt.lazy import lazy_import, lazy_callable
+from opengpt.hash_index import HashIndex
+from opengpt.data_store import CSVAppendStore
+from opengpt.teacher_cache import TeacherCache
+from opengpt.prompt_utils import PromptStore, DEFAULT_FIELDS
+from opengpt.metrics import metrics, MetricsReporter, InstrumentedTeacher
+from opengpt.splitting import get_token_offsets, split_text_by_max_len, token_length_histogram
 import logging
 import random
+import time
+import itertools
+import bisect
+from functools import partial
+from collections import deque, Counter
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+# Imported when first used, most of the time only a part of this module is needed
+pd = lazy_import('pandas')
+np = lazy_import('numpy')
+tqdm = lazy_callable('tqdm.auto', 'tqdm')
+teachers = lazy_import('opengpt.teachers') # openai
+batch_teachers = lazy_import('opengpt.batch_teachers')
+dedup = lazy_import('opengpt.dedup')
+
+
+def encode_batch(tokenizer, texts):
+    r''' Encode many texts at once, works with tiktoken (`encode_batch`) and HF tokenizers (fast tokenizers encode batches in parallel).
+    '''
+    if hasattr(tokenizer, 'encode_batch'):
+        return tokenizer.encode_batch(texts)
+    elif callable(tokenizer):
+        return tokenizer(texts)['input_ids']
+    return [tokenizer.encode(text) for text in texts]
+
+
+def decode_batch(tokenizer, batch):
+    if hasattr(tokenizer, 'decode_batch'):
+        return tokenizer.decode_batch(batch)
+    elif hasattr(tokenizer, 'batch_decode'):
+        return tokenizer.batch_decode(batch)
+    return [tokenizer.decode(tokens) for tokens in batch]
 
 
-def split_csv_by_max_len(datasets, max_len, tokenizer, base_path):
-    r''' Given a tokenizer it will split the dataset (based on the `text` column) into max_len sequencse 
+def split_df_by_max_len(df, max_len, tokenizer, overlap=0, sentence_boundaries=False):
+    r''' Splits the `text` column of one dataframe (or a chunk of one) into max_len sequences, every new row
+    keeps all other columns and gets the `len` (in tokens) and `part` columns.
+
+    If `overlap` or `sentence_boundaries` are used the splitting is done with `split_text_by_max_len` (cuts at sentence
+    boundaries and slices the original text), otherwise the tokens are cut every max_len tokens and decoded.
+    '''
+    texts = df['text'].fillna('').astype(str).tolist()
+    if overlap or sentence_boundaries:
+        new_texts = []
+        lens = []
+        row_positions = []
+        part_ids = []
+        for position, (text, (tokens, starts)) in enumerate(zip(texts, get_token_offsets(tokenizer, texts))):
+            chunks = split_text_by_max_len(text, tokens, starts, max_len, overlap=overlap, sentence_boundaries=sentence_boundaries)
+            for i, (chunk, ntokens) in enumerate(chunks):
+                new_texts.append(chunk)
+                lens.append(ntokens)
+                row_positions.append(position)
+                part_ids.append(f'part_{i}')
+
+        new_df = df.iloc[row_positions].reset_index(drop=True)
+        new_df['text'] = new_texts
+        new_df['len'] = lens
+        new_df['part'] = part_ids
+        return new_df
+
+    all_tokens = encode_batch(tokenizer, texts)
+
+    parts = []
+    row_positions = []
+    part_ids = []
+    for position, tokens in enumerate(all_tokens):
+        for i in range(math.ceil(len(tokens) / max_len)):
+            parts.append(tokens[i*max_len:(i+1)*max_len])
+            row_positions.append(position)
+            part_ids.append(f'part_{i}')
+
+    new_df = df.iloc[row_positions].reset_index(drop=True)
+    new_df['text'] = decode_batch(tokenizer, parts)
+    new_df['len'] = [len(part) for part in parts]
+    new_df['part'] = part_ids
+    return new_df
+
+
+def split_csv_by_max_len(datasets, max_len, tokenizer, base_path, chunksize=10000, num_proc=1, overlap=0, sentence_boundaries=False):
+    r''' Given a tokenizer it will split the dataset (based on the `text` column) into max_len sequencse.
+
+    The CSVs are read in chunks of `chunksize` rows, every chunk is tokenized in one batch (optionally in `num_proc` processes,
+    the tokenizer has to be picklable in that case) and the output is streamed into `data_split_by_length.csv` chunk by chunk.
+
+    With `sentence_boundaries` the texts are cut at the last paragraph/sentence boundary under max_len, and `overlap` tokens
+    are repeated between consecutive parts (see `opengpt.splitting`).
+
+    Returns:
+        stats (`dict`):
+            For every dataset the number of rows before/after and a histogram of tokens per part.
     '''
+    stats = {}
     for dataset in tqdm(datasets, desc='Datasets', total=len(datasets)):
         csv_path = dataset['path']
         name = dataset['name']
@@ -20,45 +112,157 @@ def split_csv_by_max_len(datasets, max_len, tokenizer, base_path):
         if dataset.get('nrows', -1) > 0:
             nrows = dataset['nrows']
 
-        df = pd.read_csv(csv_path, nrows=nrows)
-        cols = df.columns
-        assert 'text' in cols, f'The CSV for dataset {name} has no "text" column.'
+        # Only the header, before any work is sent to the pool
+        columns = list(pd.read_csv(csv_path, nrows=0).columns)
+        assert 'text' in columns, f'The CSV for dataset {name} has no "text" column.'
+        chunks = pd.read_csv(csv_path, nrows=nrows, chunksize=chunksize)
+        out_path = os.path.join(base_path, name, 'data_split_by_length.csv')
+        len_before = 0
+        lens = []
+        split_kwargs = {'overlap': overlap, 'sentence_boundaries': sentence_boundaries}
+        with open(out_path, 'w', encoding='utf-8') as f:
+            start = time.perf_counter()
+            ind = -1
+            for ind, (df, new_df) in enumerate(tqdm(imap_ordered(partial(split_df_by_max_len, max_len=max_len, tokenizer=tokenizer, **split_kwargs), chunks, num_proc), desc=dataset['name'])):
+                new_df.to_csv(f, index=False, header=(ind == 0))
+                len_before += len(df)
+                lens.extend(new_df['len'].tolist())
+                # Time between chunks, with num_proc > 1 that is the throughput of the pool
+                metrics.observe('split_chunk_seconds', time.perf_counter() - start, dataset=name)
+                metrics.inc('split_rows_in', len(df), dataset=name)
+                metrics.inc('split_rows_out', len(new_df), dataset=name)
+                start = time.perf_counter()
+            if ind == -1:
+                # No rows, the header is still needed to read the output
+                pd.DataFrame(None, columns=columns + [c for c in ('len', 'part') if c not in columns]).to_csv(f, index=False)
+        histogram = token_length_histogram(lens, max_len)
+        stats[name] = {'len_before': len_before, 'len_after': len(lens), 'histogram': histogram}
+        logging.warning(f'{dataset["name"]}: length before vs after: {len_before} vs {len(lens)}\n' + 
+                        "Tokens per part:\n" + "\n".join(f"{b_start:>6} - {b_end:<6}: {cnt}" for b_start, b_end, cnt in histogram) + "\n")
+    return stats
+
+
+def imap_ordered(func, items, num_proc=1):
+    r''' Yields (item, func(item)) in order, with up to `num_proc` items being processed at the same time in separate processes
+    (`func` and the items have to be picklable in that case).
+    '''
+    if num_proc <= 1:
+        for item in items:
+            yield item, func(item)
+        return
+
+    with ProcessPoolExecutor(max_workers=num_proc) as executor:
+        pending = deque()
+        for item in items:
+            pending.append((item, executor.submit(func, item)))
+            if len(pending) >= num_proc:
+                item, future = pending.popleft()
+                yield item, future.result()
+        while pending:
+            item, future = pending.popleft()
+            yield item, future.result()
+
+
+def get_output_paths(config, shard=None):
+    r''' Paths of the raw data, prepared data, parse failures, the hash index and the near-duplicate index of a project. For a shard (see
+    `opengpt.sharding`) the files are in `<base_path>/<name>/shards/` and have `.shard<i>` added to the name.
+    '''
+    directory = os.path.join(config.base_path, config.name)
+    name = config.name
+    if shard is not None:
+        directory = os.path.join(directory, 'shards')
+        name = f"{config.name}.shard{shard}"
+    return {
+        'raw': os.path.join(directory, f"raw_generated_data_for_{name}.csv"),
+        'prepared': os.path.join(directory, f"prepared_generated_data_for_{name}.csv"),
+        'failures': os.path.join(directory, f"parse_failures_for_{name}.csv"),
+        'hash_index': os.path.join(directory, f"hash_index_for_{name}.sqlite"),
+        'dedup_index': os.path.join(directory, f"dedup_index_for_{name}.sqlite"),
+        }
 
-        new_data = [list(cols) + ['len', 'part']]
-        for _, row in tqdm(df.iterrows(), desc=dataset['name'], total=len(df)):
-            text = row['text']
-            tokens = tokenizer.encode(text)
 
-            for i in range(math.ceil(len(tokens) / max_len)):
-                new_text = tokenizer.decode(tokens[i*max_len:(i+1)*max_len])
-                new_data_row = [row[c] if c != 'text' else new_text for c in cols]
-                new_data_row.append(len(tokens[i*max_len:(i+1)*max_len]))
-                new_data_row.append(f'part_{i}')
-                new_data.append(new_data_row)
+def get_shard(prompt_text_hash, num_shards):
+    r''' Deterministic shard of a work item, the same on every machine.
+    '''
+    return int(prompt_text_hash[:16], 16) % num_shards
 
-        # Save
-        new_df = pd.DataFrame(new_data[1:], columns=new_data[0])
-        new_df.to_csv(os.path.join(base_path, name, 'data_split_by_length.csv'), index=False)
-        logging.warning(f'{dataset["name"]}: length before vs after: {len(df)} vs {len(new_df)}\n')
+
+def get_file_stamp(paths):
+    r''' Size and mtime of every file (None if it does not exist), changes whenever a file is written.
+    '''
+    stamp = []
+    for path in paths:
+        stat = os.stat(path) if os.path.exists(path) else None
+        stamp.append([stat.st_size, stat.st_mtime_ns] if stat is not None else None)
+    return stamp
+
+
+def load_hash_index(config, raw_data_paths, key_column, group_column, path=None):
+    r''' Creates the index of everything that was already generated for this project, i.e. the keys in all
+    `raw_data_paths` (see `HashIndex`). If `persistent_hash_index` is set in the config the index is also kept in a
+    sqlite file next to the raw data (at `path` if provided). The sqlite file is used as it is, without reading the raw
+    data, if the raw data files did not change since the index was saved with `save_hash_index`. Otherwise (e.g. rows
+    were edited or removed) it is rebuilt from the raw data.
+
+    Returns:
+        index (`HashIndex`), nrows (`List[int]`):
+            The index and the number of rows in every raw data file.
+    '''
+    stamp = get_file_stamp(raw_data_paths)
+    if getattr(config, 'persistent_hash_index', False):
+        index = HashIndex(path if path is not None else get_output_paths(config)['hash_index'])
+        nrows = index.get_meta('nrows')
+        if nrows is not None and index.get_meta('stamp') == stamp:
+            return index, nrows
+        if len(index):
+            logging.warning(f"The raw data changed since the hash index: {index.path} was saved, it will be rebuilt.")
+        index.clear()
+    else:
+        index = HashIndex()
+    nrows = []
+    for raw_data_path in raw_data_paths:
+        if os.path.exists(raw_data_path) and os.path.getsize(raw_data_path) > 0:
+            raw_data = pd.read_csv(raw_data_path, usecols=[key_column, group_column])
+            index.update(raw_data[key_column].values, groups=raw_data[group_column].values)
+            nrows.append(len(raw_data))
+        else:
+            nrows.append(0)
+    save_hash_index(index, raw_data_paths, nrows)
+    return index, nrows
+
+
+def save_hash_index(index, raw_data_paths, nrows):
+    r''' Flushes the index together with the stamp of the raw data, call it right after the raw data was flushed.
+    '''
+    index.set_meta('nrows', list(nrows))
+    index.set_meta('stamp', get_file_stamp(raw_data_paths))
+    index.flush()
 
 
 def create_dataset_no_input(config):
     r''' This does not require an input dataset to generate a new dataset, only a prompt is needed
     '''
-    prompt_db = json.load(open(config.path.prompt_db, 'rb'))
+    prompt_db = PromptStore.load(config.path.prompt_db)
     raw_data_columns = ['id', 'raw_output', 'prompt_hash']
     raw_data = pd.DataFrame(None, columns=raw_data_columns)
     raw_data_path = os.path.join(config.base_path, config.name, f"raw_generated_data_for_{config.name}.csv")
     if os.path.exists(raw_data_path):
-        raw_data = pd.read_csv(raw_data_path)
+        # Only the columns needed to continue the generation, new rows are appended to the CSV
+        raw_data = pd.read_csv(raw_data_path, usecols=['id', 'prompt_hash'])
         logging.warning(f"Loading an existing openai generated dataset found at: {raw_data_path}" + 
                         f"There are already {len(raw_data)} rows in the that dataset, the generation will continue from where last left off. " + 
                         f"The script will also do all examples that were not done in the previous run.")
 
+    raw_store = CSVAppendStore(raw_data_path, columns=raw_data_columns)
+    nexisting = len(raw_data)
 
-    teacher = getattr(teachers, f'ask_{config.teacher.name}')
+    # Its own sqlite file, the keys are not the same as in `create_dataset`
+    hash_index_path = os.path.join(config.base_path, config.name, f"hash_index_no_input_for_{config.name}.sqlite")
+    index, _ = load_hash_index(config, [raw_data_path], key_column='id', group_column='prompt_hash', path=hash_index_path)
+    teacher = teachers.get_teacher(config)
+    cache = TeacherCache.from_config(config)
     for prompt_config in config.prompts: 
-        prompts = [prompt for prompt in prompt_db if prompt['hash'] in prompt_config['hashes']] # There must be one
+        prompts = prompt_db.get_prompts(prompt_config['hashes']) # There must be one
 
         parameters = prompt_config.get('extra_parameters', {})
 
@@ -69,116 +273,586 @@ def create_dataset_no_input(config):
                 # If some examples exist already
 
 
-                start = len(raw_data[raw_data.prompt_hash == prompt['hash']])
-                for _ in tqdm(range(start, prompt_config['runs']), total=(prompt_config['runs'] - start)):
+                start = index.count(prompt['hash'])
+                for run in tqdm(range(start, prompt_config['runs']), total=(prompt_config['runs'] - start)):
                     prompt_text_template = prompt['text']
                     prompt_text = prompt_text_template.format(**parameters)
                     try:
-                        out = teacher(prompt_text, config)
-                        new_data = pd.DataFrame([[len(raw_data), out, prompt['hash']]], columns=raw_data_columns)
-                        raw_data = pd.concat([raw_data, new_data], ignore_index=True)
-
-                        if len(raw_data) % config.data_generation_checkpoint_every == 0:
+                        out = None
+                        if cache is not None:
+                            cache_key = cache.get_key(config, prompt_text, run)
+                            out = cache.get(cache_key)
+                        if out is None:
+                            out = teacher(prompt_text, config)
+                            if cache is not None:
+                                cache.put(cache_key, out)
+                        raw_data_id = nexisting + len(raw_store)
+                        raw_store.append([{'id': raw_data_id, 'raw_output': out, 'prompt_hash': prompt['hash']}])
+                        index.add(str(raw_data_id), group=prompt['hash'])
+
+                        if len(raw_store) % config.data_generation_checkpoint_every == 0:
                             logging.warning("Checkpointing the generated dataset.")
-                            raw_data.to_csv(raw_data_path, index=False)
+                            raw_store.flush()
+                            save_hash_index(index, [raw_data_path], [nexisting + len(raw_store)])
 
                     except Exception as e:
                         logging.exception(e)
                         logging.warning(f"Skipping example for prompt: {prompt['hash']}\n")
 
-    if raw_data is not None and len(raw_data) > 0:
-        raw_data.to_csv(raw_data_path, index=False)
+    raw_store.flush()
+    save_hash_index(index, [raw_data_path], [nexisting + len(raw_store)])
+    index.close()
+    if cache is not None:
+        cache.log_stats()
+        cache.close()
 
-    return raw_data
+    return raw_store.read()
 
 
-def create_dataset(config):
-    prompt_db = json.load(open(config.path.prompt_db, 'rb'))
-    raw_data_columns = ['id', 'raw_output', 'dataset', 'language', 'run', 'prompt_hash', 'prompt_text_hash', 'context']
-    raw_data = pd.DataFrame(None, columns=raw_data_columns)
-    prepared_data = None
-    raw_data_path = os.path.join(config.base_path, config.name, f"raw_generated_data_for_{config.name}.csv")
-    prepared_data_path = os.path.join(config.base_path, config.name, f"prepared_generated_data_for_{config.name}.csv")
-    if os.path.exists(raw_data_path) and os.path.exists(prepared_data_path):
-        raw_data = pd.read_csv(raw_data_path)
-        prepared_data = pd.read_csv(prepared_data_path)
-        logging.warning(f"Loading an existing openai generated dataset found at: \n{raw_data_path}\n and\n{prepared_data_path}\n" + 
-                        f"There are already {len(raw_data)} rows in the that dataset, the generation will continue from where last left off. " + 
-                        f"The script will also do all examples that were not done in the previous run.\n" + 
-                        "***Take care that if prompt_config['random_prompt'] is set to true, it can produce unwanted results.\n\n")
+def get_prompt_text_hash(prompt_text, run):
+    r''' The hash is of everything that is used to generate the output, i.e. the prompt text and the run.
+    '''
+    h = hashlib.sha256(prompt_text.encode("utf-8"))
+    h.update(str(run).encode("utf-8"))
+    return h.hexdigest()
 
-    cnt = 0
+
+_split_datasets = {}
+def iter_split_dataset(config, dataset_name, chunksize=None):
+    r''' Yields (row_ind, row) for every row of `data_split_by_length.csv` of a dataset, row is a dict. By default the
+    CSV is read once and reused until `clear_split_datasets` (it is read again if the file changes), with `chunksize` it
+    is streamed in chunks instead, so the memory does not depend on the size of the dataset but the file is read on every call.
+    '''
+    path = os.path.join(config.base_path, dataset_name, 'data_split_by_length.csv')
+    if chunksize:
+        chunks = pd.read_csv(path, chunksize=chunksize)
+    else:
+        stat = os.stat(path)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        key = os.path.abspath(path)
+        if key not in _split_datasets or _split_datasets[key][0] != stamp:
+            _split_datasets[key] = (stamp, pd.read_csv(path))
+        chunks = [_split_datasets[key][1]]
+    for df in chunks:
+        columns = list(df.columns)
+        # itertuples does not build a Series for every row like iterrows
+        for row_ind, *values in df.itertuples(index=True, name=None):
+            yield row_ind, dict(zip(columns, values))
+
+
+def get_prompt_rng(config):
+    r''' The generator that picks the prompts with `random_prompt`. Every worker (and a sequential run, and the planner)
+    has to pick the same prompts, otherwise the shards would not match. The work items are created while the teacher
+    runs, so the prompts are picked with their own generator and not with `random` (retries use it too).
+    '''
+    return random.Random(getattr(config, 'seed', 11))
+
+
+def clear_split_datasets():
+    r''' Frees the datasets kept by `iter_split_dataset`.
+    '''
+    _split_datasets.clear()
+
+
+def get_work_items(config, prompt_db, done_hashes=None, rng=None):
+    r''' Enumerates all the (prompt_config, run, language, dataset row, prompt) combinations that have to
+    be sent to the teacher. The order is the same as the one used by the sequential generation, so the
+    output of `create_dataset` is deterministic irrelevant of the concurrency.
+
+    Args:
+        config:
+            The general config.
+        prompt_db (`PromptStore` or `List[dict]`):
+            The prompt database (loaded prompts.json).
+        done_hashes (`set` or `HashIndex`, optional):
+            Hashes of prompt texts that were already generated, these will be skipped.
+        rng (`random.Random`, optional):
+            Used to pick the prompts with `random_prompt`, by default the `random` module.
+
+    Yields:
+        work_item (`dict`):
+            Every item has the prompt_config, prompt, run, language, dataset_name, row_ind, row, context,
+            prompt_text and prompt_text_hash. The items are created as they are consumed, so with
+            `dataset_chunksize` only one chunk of a dataset is in memory at a time.
+    '''
+    done_hashes = done_hashes if done_hashes is not None else set()
+    rng = rng if rng is not None else random
+    if not isinstance(prompt_db, PromptStore):
+        prompt_db = PromptStore(prompts=prompt_db)
+    seen = set() # The same prompt text can come up more than once (e.g. duplicated rows)
     for prompt_config in config.prompts:
-        prompts = [prompt for prompt in prompt_db if prompt['hash'] in prompt_config['hashes']] # There must be one
-        teacher = getattr(teachers, f'ask_{config.teacher.name}')
+        prompts = prompt_db.get_prompts(prompt_config['hashes']) # There must be one
+        # Fail now and not in the middle of the generation if a prompt needs a field that is not there
+        available_fields = set(DEFAULT_FIELDS) | set(prompt_config.get('extra_parameters', {})) | set(prompt_config.get('extra_data_columns', []))
+        for prompt in prompts:
+            prompt_db.validate(prompt['hash'], available_fields)
 
         for run in range(prompt_config.get('runs', 1)):
-            parameters = prompt_config.get('extra_parameters', {})
+            parameters = dict(prompt_config.get('extra_parameters', {}))
             extra_data_columns = prompt_config.get('extra_data_columns', [])
 
             for language in prompt_config.get('languages', ['English']):
                 parameters['language'] = language
-                logging.warning(f"\nStarting prompts: {prompt_config['hashes']}\nRun: {run}\nLanguage: {language}")
                 for dataset_name in prompt_config['datasets']:
-                    df = pd.read_csv(os.path.join(config.base_path, dataset_name, 'data_split_by_length.csv'))
-                    for row_ind, row in tqdm(df.iterrows(), desc=dataset_name, total=len(df)):
+                    for row_ind, row in iter_split_dataset(config, dataset_name, chunksize=getattr(config, 'dataset_chunksize', None)):
                         # Set the context from the current row
                         parameters['context'] = row['text']
                         for col in extra_data_columns:
                             parameters[col] = row[col]
+                        # Same as len(text.split(" ")), without creating the list
+                        long_enough = str(row['text']).count(" ") + 1 > config.teacher.min_len
                         if prompt_config.get('random_prompt', False):
                             # This means for each example in the dataset we randomly select a prompt to be used, if False
                             #every example will run through every prompt
-                            selected_prompts = [random.choice(prompts)]
+                            selected_prompts = [rng.choice(prompts)]
                         else:
                             selected_prompts = prompts # Use all prompts sequentially
                         for prompt in selected_prompts:
-                            prompt_text_template = prompt['text']
-                            # Every prompt has its own parser
-                            parser = getattr(parsers, prompt['parser'])
-                            if len(str(row['text']).split(" ")) > config.teacher.min_len:
-                                prompt_text = prompt_text_template.format(**parameters)
-                                # The hash is of everything that is used to generate the output
-                                h = hashlib.sha256(prompt_text.encode("utf-8"))
-                                h.update(str(run).encode("utf-8"))
-                                h = h.hexdigest()
+                            if long_enough:
+                                prompt_text = prompt['text'].format(**parameters)
+                                h = get_prompt_text_hash(prompt_text, run)
 
                                 # Only get the output if this was not done already
-                                if h not in raw_data.prompt_text_hash.values:
-                                    # Get output from OpenAI and parse using parser, the parser will append the parsed data onto the prepared_data CSV.
-                                    try:
-                                        openai_output = teacher(prompt_text, config)
-                                        prepared_data = parser(data=openai_output, prepared_data=prepared_data, prompt_config=prompt_config, config=config, row=row, 
-                                                               raw_data_id=len(raw_data), prompt_text=prompt_text) # ID is length of raw_data
-
-                                        # Concat the current output to the data dataframe, only if not None
-                                        if prepared_data is not None and len(prepared_data) > 0:
-                                            new_data = pd.DataFrame([[len(raw_data), openai_output, dataset_name, language, run, prompt['hash'], h, parameters['context']]], 
-                                                                    columns=raw_data_columns)
-                                            raw_data = pd.concat([raw_data, new_data], ignore_index=True)
-                                        if len(raw_data) % config.data_generation_checkpoint_every == 0:
-                                            logging.warning("Checkpointing the generated dataset.")
-                                            raw_data.to_csv(raw_data_path, index=False)
-                                            prepared_data.to_csv(prepared_data_path, index=False)
-                                    except Exception as e:
-                                        logging.exception(e)
-                                        logging.warning(f"Skipping example at position: {row_ind} for dataset: {dataset_name}\n")
+                                if h not in done_hashes and h not in seen:
+                                    seen.add(h)
+                                    yield {
+                                        'prompt_config': prompt_config,
+                                        'prompt': prompt,
+                                        'run': run,
+                                        'language': language,
+                                        'dataset_name': dataset_name,
+                                        'row_ind': row_ind,
+                                        'row': row,
+                                        'context': parameters['context'],
+                                        'prompt_text': prompt_text,
+                                        'prompt_text_hash': h,
+                                        }
+
+
+def _count_work_items(work_items):
+    r''' Counts the work items in the metrics as they are created, the total is not known up front.
+    '''
+    for work_item in work_items:
+        metrics.inc('work_items_total')
+        yield work_item
+
+
+def dispatch_to_teacher(work_items, teacher, config, max_in_flight=1, cache=None):
+    r''' Sends the work items to the teacher keeping at most `max_in_flight` requests in flight. The results are
+    yielded in the same order as `work_items`, no matter in which order the teacher answers.
+
+    Args:
+        work_items (`Iterable[dict]`):
+            Items as returned by `get_work_items`, only the `prompt_text` (and `run` for the cache) is used here.
+        teacher (`Callable`):
+            Function with the signature `teacher(prompt_text, config)`.
+        config:
+            The general config, it is passed to the teacher.
+        max_in_flight (`int`):
+            How many teacher calls can be running at the same time, if 1 everything is done sequentially.
+        cache (`TeacherCache`, optional):
+            Responses found in the cache are not sent to the teacher, new responses are added to the cache.
+
+    Yields:
+        (work_item, output, exception):
+            Exception is None if the call was successful, otherwise output is None.
+    '''
+    executor = ThreadPoolExecutor(max_workers=max_in_flight) if max_in_flight > 1 else None
+    # (work_item, kind, value), kind is one of cached/done/error/future
+    pending = deque()
+    nfutures = 0
+
+    def _submit(work_item):
+        if cache is not None:
+            work_item['cache_key'] = cache.get_key(config, work_item['prompt_text'], work_item.get('run', 0))
+            out = cache.get(work_item['cache_key'])
+            if out is not None:
+                return work_item, 'cached', out
+        if executor is not None:
+            return work_item, 'future', executor.submit(teacher, work_item['prompt_text'], config)
+        try:
+            return work_item, 'done', teacher(work_item['prompt_text'], config)
+        except Exception as e:
+            return work_item, 'error', e
+
+    def _pop():
+        work_item, kind, value = pending.popleft()
+        if kind == 'future':
+            try:
+                value = value.result()
+                kind = 'done'
+            except Exception as e:
+                value = e
+                kind = 'error'
+        if kind == 'error':
+            return work_item, None, value
+        if kind == 'done' and cache is not None:
+            cache.put(work_item['cache_key'], value)
+        return work_item, value, None
+
+    try:
+        for work_item in work_items:
+            pending.append(_submit(work_item))
+            nfutures += pending[-1][1] == 'future'
+            metrics.set('teacher_in_flight', nfutures)
+            # Yield everything that is ready or we have to wait for, to keep at most max_in_flight requests in flight
+            while pending and (pending[0][1] != 'future' or nfutures >= max_in_flight):
+                nfutures -= pending[0][1] == 'future'
+                yield _pop()
+        while pending:
+            metrics.set('teacher_in_flight', len(pending))
+            yield _pop()
+    finally:
+        metrics.set('teacher_in_flight', 0)
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+
+PARSE_FAILURE_COLUMNS = ['prompt_text_hash', 'prompt_hash', 'dataset', 'parser', 'reason', 'text']
+def parse_output(output, prompt, prompt_config, config, row, raw_data_id, prompt_text, raise_parse_errors=False):
+    r''' Runs the parser of the prompt on one teacher output.
+
+    Args:
+        raise_parse_errors (`bool`):
+            Raise the `ParseError` of the parser (after it is counted), instead of returning it as a failure.
+
+    Returns:
+        new_data (`List[dict]`):
+            The parsed records.
+        failures (`List[dict]`):
+            Reason and text for everything that could not be parsed.
+    '''
+    # Every prompt has its own parser
+    parser = getattr(parsers, prompt['parser'])
+    failures = []
+    with metrics.timer('parse_seconds', parser=prompt['parser']):
+        try:
+            new_data = parsers.run_parser(parser, data=output, prompt_config=prompt_config, config=config, row=row,
+                                          raw_data_id=raw_data_id, prompt_text=prompt_text, failures=failures)
+        except parsers.ParseError as e:
+            if raise_parse_errors:
+                metrics.inc('parse_failures', parser=prompt['parser'])
+                raise
+            new_data = []
+            failures.append({'reason': str(e), 'text': output})
+    if not new_data and not failures:
+        failures.append({'reason': "Nothing was parsed", 'text': output})
+    metrics.inc('parse_successes' if new_data else 'parse_failures', parser=prompt['parser'])
+    metrics.inc('parse_skipped_parts', len(failures) - (0 if new_data else 1), parser=prompt['parser'])
+    return new_data, failures
+
+
+def create_dataset(config, teacher=None, shard=None, num_shards=1, lease=None):
+    r''' Sends every (prompt_config, run, language, dataset row, prompt) combination to the teacher and parses the
+    output into the prepared dataset. Set `teacher.concurrency` in the config to keep more than one teacher call in flight,
+    or `teacher.batch` to send everything as offline batch jobs (see `opengpt.batch_teachers`), and `dedup` to drop
+    parsed rows that are near-duplicates of rows already in the prepared data (see `opengpt.dedup`).
+
+    Args:
+        config:
+            The general config.
+        teacher (`Callable`, optional):
+            Use this teacher instead of the one defined in `config.teacher.name` (e.g. a fake teacher for testing).
+        shard (`int`, optional):
+            Generate only the work items of this shard (out of `num_shards`) into the shard files, this is
+            used by `opengpt.sharding.run_shard_worker`.
+        lease (`ShardLease`, optional):
+            Renewed while the shard is generated (best with its heartbeat running, see `run_shard_worker`) and checked
+            before every write, if the lease is lost (`ShardLeaseLost`) the generation stops without writing anything
+            else, as another worker owns the shard now.
+    '''
+    prompt_db = PromptStore.load(config.path.prompt_db)
+    raw_data_columns = ['id', 'raw_output', 'dataset', 'language', 'run', 'prompt_hash', 'prompt_text_hash', 'context']
+    paths = get_output_paths(config, shard)
+    raw_data_path, prepared_data_path = paths['raw'], paths['prepared']
+    os.makedirs(os.path.dirname(raw_data_path), exist_ok=True)
+    if not (os.path.exists(raw_data_path) and os.path.exists(prepared_data_path)):
+        for path in (raw_data_path, prepared_data_path):
+            if os.path.exists(path):
+                logging.warning(f"Removing: {path}, both the raw and prepared data are needed to continue a previous generation.")
+                os.remove(path)
+    # Everything in the raw data is done, with shards also everything in the merged dataset
+    done_paths = [raw_data_path] + ([get_output_paths(config)['raw']] if shard is not None else [])
+    # Only the keys of the raw data are read (or nothing, if the persistent index is up to date), new rows are appended to the CSVs
+    index, nrows = load_hash_index(config, done_paths, key_column='prompt_text_hash', group_column='prompt_hash', path=paths['hash_index'])
+    nexisting = nrows[0]
+    if nexisting:
+        logging.warning(f"Loading an existing openai generated dataset found at: \n{raw_data_path}\n and\n{prepared_data_path}\n" + 
+                        f"There are already {nexisting} rows in the that dataset, the generation will continue from where last left off. " + 
+                        f"The script will also do all examples that were not done in the previous run.\n" + 
+                        "***Take care that if prompt_config['random_prompt'] is set to true, it can produce unwanted results.\n\n")
+    raw_store = CSVAppendStore(raw_data_path, columns=raw_data_columns)
+    prepared_store = CSVAppendStore(prepared_data_path)
+    # Malformed teacher outputs (or parts of them) with the reason, instead of exceptions in the log
+    failure_store = CSVAppendStore(paths['failures'], columns=PARSE_FAILURE_COLUMNS)
+
+    if teacher is None:
+        teacher = InstrumentedTeacher(teachers.get_teacher(config), config)
+        # Rate limits and retries, only if they are set in the config
+        teacher = teachers.TeacherScheduler.from_config(teacher, config)
+    else:
+        teacher = InstrumentedTeacher(teacher, config)
+    max_in_flight = config.teacher.get('concurrency', 1)
+    cache = TeacherCache.from_config(config)
+    reporter = MetricsReporter.from_config(config)
+    if reporter is not None:
+        reporter.start()
+
+    # With shards only the near-duplicates within a shard are found, use `dedup.dedup_prepared_data` after merging
+    dedup_index = dedup.load_index(config, prepared_data_path, path=paths['dedup_index'], raw_data_path=raw_data_path, prompt_db=prompt_db)
+    dedup_removed = Counter()
+    rng = get_prompt_rng(config)
+    # A generator, the work items are read from the datasets only as the teacher needs them
+    work_items = get_work_items(config, prompt_db, done_hashes=index, rng=rng)
+    if shard is not None:
+        work_items = (work_item for work_item in work_items if get_shard(work_item['prompt_text_hash'], num_shards) == shard)
+    nwork_items = None
+    if config.teacher.get('longest_first', False) or config.teacher.get('batch'):
+        # Both need all the work items up front (to sort them or to split them into batch jobs)
+        work_items = list(work_items)
+        nwork_items = len(work_items)
+        metrics.inc('work_items_total', nwork_items)
+    else:
+        work_items = _count_work_items(work_items)
+    if config.teacher.get('longest_first', False):
+        # Long prompts are also the slow ones, starting them first means a shorter tail at the end of the run
+        from opengpt.planner import sort_longest_first, get_tokenizer
+        work_items = sort_longest_first(work_items, get_tokenizer(config))
+    if config.teacher.get('batch'):
+        logging.warning(f"\nThere are {nwork_items} examples to be sent to the teacher as batch jobs.\n")
+        results = batch_teachers.dispatch_batch(work_items, batch_teachers.get_batch_client(config, teacher), config,
+                                                batch_dir=os.path.join(config.base_path, config.name, 'batches'),
+                                                batch_size=config.teacher.get('batch_size', 50000),
+                                                poll_interval=config.teacher.get('batch_poll_interval', 30), cache=cache)
+    else:
+        logging.warning(f"\nSending the examples to the teacher, with up to {max_in_flight} in flight.\n")
+        results = dispatch_to_teacher(work_items, teacher, config, max_in_flight=max_in_flight, cache=cache)
+    for work_item, openai_output, e in tqdm(results, desc='Teacher', total=nwork_items):
+        if lease is not None:
+            # Raises if another worker took over the shard, nothing else may be written then
+            lease.renew()
+        metrics.inc('work_items_done')
+        prompt = work_item['prompt']
+        # Get output from OpenAI and parse using parser, the parsed rows are appended to the prepared data CSV.
+        checkpoint = False
+        try:
+            if e is not None:
+                raise e
+            raw_data_id = nexisting + len(raw_store) # ID is length of raw_data
+            try:
+                new_data, failures = parse_output(openai_output, prompt, work_item['prompt_config'], config, row=work_item['row'],
+                                                  raw_data_id=raw_data_id, prompt_text=work_item['prompt_text'], raise_parse_errors=True)
+            except parsers.ParseError as parse_error:
+                # The output is not recorded in the raw data, so it is sent to the teacher again in the next run
+                failure_store.append([{'prompt_text_hash': work_item['prompt_text_hash'], 'prompt_hash': prompt['hash'], 'dataset': work_item['dataset_name'],
+                                       'parser': prompt['parser'], 'reason': str(parse_error), 'text': openai_output}])
+                continue
+            failure_store.append([{'prompt_text_hash': work_item['prompt_text_hash'], 'prompt_hash': prompt['hash'], 'dataset': work_item['dataset_name'],
+                                   'parser': prompt['parser'], **failure} for failure in failures])
+
+            if new_data and dedup_index is not None:
+                new_data, removed = dedup.dedup_records(new_data, dedup_index, doc_ids=[f'{raw_data_id}:{i}' for i in range(len(new_data))],
+                                                        column=dedup.get_column(config, work_item['prompt_config'], prompt['parser']))
+                if removed:
+                    dedup_removed[(work_item['dataset_name'], prompt['hash'])] += len(removed)
+                    metrics.inc('dedup_removed', len(removed), dataset=work_item['dataset_name'], prompt_hash=prompt['hash'])
+            prepared_store.append(new_data)
+            # Save the current output to the raw data whenever the parser did not raise, even if nothing (or only near-duplicates)
+            # came out of it, otherwise it would be sent to the teacher again in every run
+            raw_store.append([dict(zip(raw_data_columns, [raw_data_id, openai_output, work_item['dataset_name'], work_item['language'], 
+                                                          work_item['run'], prompt['hash'], work_item['prompt_text_hash'], work_item['context']]))])
+            index.add(work_item['prompt_text_hash'], group=prompt['hash'])
+            checkpoint = len(raw_store) % config.data_generation_checkpoint_every == 0
+        except Exception as e:
+            logging.exception(e)
+            logging.warning(f"Skipping example at position: {work_item['row_ind']} for dataset: {work_item['dataset_name']}\n")
+        if checkpoint:
+            logging.warning("Checkpointing the generated dataset.")
+            if lease is not None:
+                # Outside of the try, a lost lease has to stop the generation
+                lease.check()
+            with metrics.timer('checkpoint_seconds'):
+                # Prepared first, if we crash in between the example is regenerated instead of being lost
+                prepared_store.flush()
+                raw_store.flush()
+                save_hash_index(index, done_paths, [nexisting + len(raw_store)] + nrows[1:])
+                failure_store.flush()
+                if dedup_index is not None:
+                    dedup_index.flush()
+    if hasattr(teacher, 'stats'):
+        logging.warning(f"Teacher stats: {teacher.stats()}")
+    if cache is not None:
+        cache.log_stats()
+        cache.close()
     # Final save
-    if raw_data is not None and prepared_data is not None and len(raw_data) > 0 and len(prepared_data) > 0:
-        raw_data.to_csv(raw_data_path, index=False)
-        prepared_data.to_csv(prepared_data_path, index=False)
-    return raw_data, prepared_data 
-
+    if lease is not None:
+        lease.check()
+    with metrics.timer('checkpoint_seconds'):
+        prepared_store.flush()
+        raw_store.flush()
+        save_hash_index(index, done_paths, [nexisting + len(raw_store)] + nrows[1:])
+        index.close()
+        failure_store.flush()
+        if dedup_index is not None:
+            dedup_index.close()
+            dedup.log_report(dedup_removed)
+    clear_split_datasets()
+    if reporter is not None:
+        reporter.stop()
+    if len(failure_store):
+        logging.warning(f"There were {len(failure_store)} parse failures, see: {failure_store.path}")
+    return raw_store.read(), prepared_store.read()
+
+
+def _reparse_chunk(chunk, config, prompt_db, rows):
+    r''' Parses one chunk (list of raw data records) of the raw data, used by `reparse_raw_data`.
+    '''
+    new_data, failures = [], []
+    for record in chunk:
+        prompt = prompt_db.get(record['prompt_hash'])
+        if prompt is None or not prompt.get('parser'):
+            failures.append({'prompt_text_hash': record['prompt_text_hash'], 'prompt_hash': record['prompt_hash'], 'dataset': record['dataset'],
+                             'parser': None, 'reason': "The prompt or its parser is not in the prompt database", 'text': record['raw_output']})
+            continue
+        prompt_config = _find_prompt_config(config, record['prompt_hash'], record['dataset'])
+        context = record['context'] if isinstance(record['context'], str) else ''
+        row = rows.get((record['dataset'], context), {'text': context})
+        records, record_failures = parse_output(record['raw_output'], prompt, prompt_config, config, row=row,
+                                                raw_data_id=record['id'], prompt_text=None)
+        new_data.extend(records)
+        failures.extend({'prompt_text_hash': record['prompt_text_hash'], 'prompt_hash': record['prompt_hash'], 'dataset': record['dataset'],
+                         'parser': prompt['parser'], **failure} for failure in record_failures)
+    return new_data, failures
+
+
+def _find_prompt_config(config, prompt_hash, dataset_name):
+    r''' The prompt_config that was used to generate with this prompt on this dataset, empty if there is none (anymore).
+    '''
+    candidates = [prompt_config for prompt_config in config.prompts if prompt_hash in prompt_config['hashes']]
+    for prompt_config in candidates:
+        if dataset_name in prompt_config.get('datasets', []):
+            return prompt_config
+    return candidates[0] if candidates else {}
+
+
+def reparse_raw_data(config, chunksize=1000, num_proc=1):
+    r''' Rebuilds the prepared data from the raw teacher outputs, without calling the teacher. Useful when a parser
+    is fixed or the special tokens change. The raw CSV is read in chunks, every row is parsed with the parser of its prompt
+    (from the prompt database) in `num_proc` processes, and the output replaces `prepared_generated_data_for_<name>.csv`
+    once everything is done. Parse failures go to `reparse_failures_for_<name>.csv`.
+
+    Rows of the raw data are given to the parsers as `{'text': context}`, plus the `reference_column_to_append` columns
+    looked up in the datasets if a prompt_config uses them. `prompt_text` is not stored in the raw data, so it is None.
+
+    Args:
+        config:
+            The general config.
+        chunksize (`int`):
+            Rows of the raw data parsed at a time in one process.
+        num_proc (`int`):
+            Number of processes used for parsing.
+
+    Returns:
+        stats (`dict`):
+            Number of raw rows, prepared records and parse failures.
+    '''
+    prompt_db = dict(PromptStore.load(config.path.prompt_db).by_hash)
+    raw_data_path = os.path.join(config.base_path, config.name, f"raw_generated_data_for_{config.name}.csv")
+    prepared_data_path = os.path.join(config.base_path, config.name, f"prepared_generated_data_for_{config.name}.csv")
+    failures_path = os.path.join(config.base_path, config.name, f"reparse_failures_for_{config.name}.csv")
 
-def create_labels(examples, config, tokenizer):
+    # Only the columns needed by the parsers are taken from the datasets, and only if some prompt_config needs them
+    rows = {}
+    for prompt_config in config.prompts:
+        ref_col = prompt_config.get('reference_column_to_append', None)
+        if not ref_col:
+            continue
+        for dataset_name in prompt_config['datasets']:
+            df = pd.read_csv(os.path.join(config.base_path, dataset_name, 'data_split_by_length.csv'), usecols=['text', ref_col])
+            for text, value in df[['text', ref_col]].values:
+                rows.setdefault((dataset_name, text), {'text': text})[ref_col] = value
+
+    tmp_paths = [prepared_data_path + '.tmp', failures_path + '.tmp']
+    for path in tmp_paths:
+        if os.path.exists(path):
+            os.remove(path)
+    prepared_store = CSVAppendStore(tmp_paths[0], fsync=False)
+    failure_store = CSVAppendStore(tmp_paths[1], columns=PARSE_FAILURE_COLUMNS, fsync=False)
+
+    def chunks():
+        columns = ['id', 'raw_output', 'dataset', 'prompt_hash', 'prompt_text_hash', 'context']
+        for df in pd.read_csv(raw_data_path, usecols=columns, chunksize=chunksize):
+            yield df.to_dict('records')
+
+    nraw = 0
+    process = partial(_reparse_chunk, config=config, prompt_db=prompt_db, rows=rows)
+    for chunk, (new_data, failures) in tqdm(imap_ordered(process, chunks(), num_proc), desc='Reparsing chunks'):
+        nraw += len(chunk)
+        prepared_store.append(new_data)
+        failure_store.append(failures)
+        prepared_store.flush()
+        failure_store.flush()
+
+    stats = {'raw_rows': nraw, 'prepared_rows': len(prepared_store), 'failures': len(failure_store)}
+    if len(prepared_store) == 0:
+        logging.warning(f"Nothing was parsed, the prepared data at: {prepared_data_path} is not changed.")
+    else:
+        os.replace(tmp_paths[0], prepared_data_path)
+        logging.warning(f"Prepared data with {stats['prepared_rows']} rows rebuilt from {nraw} raw rows: {prepared_data_path}")
+    if len(failure_store) > 0:
+        os.replace(tmp_paths[1], failures_path)
+        logging.warning(f"There were {stats['failures']} parse failures, see: {failures_path}")
+    elif os.path.exists(failures_path):
+        os.remove(failures_path)
+    for path in tmp_paths:
+        if os.path.exists(path):
+            os.remove(path)
+    return stats
+
+
+def create_labels(examples, config, tokenizer, return_arrays=False):
     r''' This is used with a prepared HF dataset that is already tokenized. It will add labels
     so that only the AI generated parts (answers) will be trained on.
+
+    Everything is done on one flat NumPy array for the whole batch: every `<|user|>` token switches to ignoring,
+    every `<|ai|>` token switches to training, and the state is carried forward with a cumulative max. The output
+    is the same as going token by token.
+
+    Args:
+        return_arrays (`bool`):
+            If True the labels are NumPy arrays (can be used directly by HF datasets/Arrow), otherwise lists.
     '''
-    
     user_token_id = tokenizer.vocab[config.special_tokens.user]
     ai_token_id = tokenizer.vocab[config.special_tokens.ai]
     # Everything written by an AI will be used for training, and everything by a user will be ignored
 
+    lengths = [len(ids) for ids in examples['input_ids']]
+    offsets = np.cumsum(lengths)[:-1]
+    if sum(lengths) == 0:
+        examples['labels'] = [np.zeros(0, dtype=np.int64) if return_arrays else [] for _ in lengths]
+        return examples
+    input_ids = np.concatenate([np.asarray(ids, dtype=np.int64) for ids in examples['input_ids']])
+
+    # 1 - ignore, 0 - train, -1 - keep whatever was before. Every example starts with ignore.
+    state = np.full(len(input_ids), -1, dtype=np.int8)
+    state[np.concatenate([[0], offsets])[np.array(lengths) > 0]] = 1
+    state[input_ids == user_token_id] = 1
+    state[input_ids == ai_token_id] = 0
+    last_set = np.maximum.accumulate(np.where(state >= 0, np.arange(len(state)), 0))
+    ignore = state[last_set] == 1
+
+    labels = np.where(ignore, config.train.ignore_index, input_ids)
+    labels = np.split(labels, offsets)
+    examples['labels'] = labels if return_arrays else [l.tolist() for l in labels]
+    return examples
+
+
+def _create_labels_python(examples, config, tokenizer):
+    r''' The token by token version of `create_labels`, kept as a reference for testing/benchmarking.
+    '''
+    user_token_id = tokenizer.vocab[config.special_tokens.user]
+    ai_token_id = tokenizer.vocab[config.special_tokens.ai]
+
     examples['labels'] = []
     for i in range(len(examples['input_ids'])):
         labels = []
@@ -197,40 +871,110 @@ def create_labels(examples, config, tokenizer):
     return examples
 
 
-def pack_examples(examples, block_size, packing_type='partial'):
+def pack_examples(examples, block_size, packing_type='partial', add_position_ids=False):
     r''' Used with a prepared HF dataset, will pack/group examples. Use with care, can mess up many things
     if the input is not formated properly (requires the <|eod|> token).
     
-    packing_type: partial/full/no 
+    packing_type: partial/full/best_fit/no 
+        partial - consecutive examples are concatenated while they fit into block_size
+        full - everything is concatenated and split into block_size chunks (examples can be split)
+        best_fit - whole examples are packed into block_size bins using best-fit-decreasing, this
+            minimizes padding without splitting any example. The order of examples is changed.
+
+    add_position_ids: if True two more columns are added:
+        position_ids - restart from 0 at the start of every original example (and every block), so that
+            packed examples do not continue each others positions
+        segment_ids - 1, 2, 3... for the 1st, 2nd, 3rd... example in a block
+        The DataCollatorWithPadding will pass the position_ids to the model, and can use them to stop
+        attention between packed examples.
     '''
+    _key = list(examples.keys())[0] # Take whichever key
+    # Lengths of the original examples that make up every packed example, used for position_ids
+    segments = []
     # Concatenate all texts.
     if packing_type == 'partial':
         result = {k:[] for k in examples.keys()}
-        _key = list(examples.keys())[0] # Take whichever key
         new_example = {k:[] for k in examples.keys()}
+        new_segments = []
 
         for ind in range(len(examples[_key])):
             # Trim long sequences to block_size, this is required for partial packing
-            example = {k:v[ind][0:block_size] for k,v in examples.items()}
+            example = {k:list(v[ind][0:block_size]) for k,v in examples.items()}
             if len(new_example[_key]) + len(example[_key]) > block_size:
-                result = {k:result[k] + [v] for k,v in new_example.items()}
+                for k, v in new_example.items():
+                    result[k].append(v)
+                segments.append(new_segments)
                 new_example = example 
+                new_segments = [len(example[_key])]
             else:
-                new_example = {k:new_example[k] + v for k,v in example.items()}
+                for k, v in example.items():
+                    new_example[k].extend(v)
+                new_segments.append(len(example[_key]))
         #  Add the last example if there is something to add  
         if len(new_example[_key]) > 0:   
-            result = {k:result[k] + [v] for k,v in new_example.items()}
+            for k, v in new_example.items():
+                result[k].append(v)
+            segments.append(new_segments)
     elif packing_type == 'full':
         # Full packing
-        concatenated_examples = {k: sum(examples[k], []) for k in examples.keys()}
-        total_length = len(concatenated_examples[list(examples.keys())[0]])
+        concatenated_examples = {k: list(itertools.chain.from_iterable(examples[k])) for k in examples.keys()}
+        total_length = len(concatenated_examples[_key])
         total_length = (total_length // block_size) * block_size
         # Split by chunks of max_len.
         result = {
             k: [t[i : i + block_size] for i in range(0, total_length, block_size)]
             for k, t in concatenated_examples.items()
         }
+        if add_position_ids:
+            # Where the original examples start, and where the blocks start
+            starts = set(itertools.accumulate([len(x) for x in examples[_key]], initial=0)) | set(range(0, total_length, block_size))
+            starts = sorted(start for start in starts if start < total_length) + [total_length]
+            for i in range(0, total_length, block_size):
+                block_starts = starts[bisect.bisect_left(starts, i):bisect.bisect_right(starts, i + block_size)]
+                segments.append([b - a for a, b in zip(block_starts[:-1], block_starts[1:])])
+    elif packing_type == 'best_fit':
+        bins = best_fit_decreasing([min(len(x), block_size) for x in examples[_key]], block_size)
+        result = {k: [list(itertools.chain.from_iterable(v[ind][0:block_size] for ind in b)) for b in bins] for k, v in examples.items()}
+        segments = [[min(len(examples[_key][ind]), block_size) for ind in b] for b in bins]
     else:
         # Do nothing
         result = examples
+        segments = [[len(x)] for x in examples[_key]]
+
+    if add_position_ids:
+        result = dict(result)
+        result['position_ids'] = [[position for length in lengths for position in range(length)] for lengths in segments]
+        result['segment_ids'] = [[segment for segment, length in enumerate(lengths, 1) for _ in range(length)] for lengths in segments]
     return result
+
+
+def best_fit_decreasing(lengths, capacity):
+    r''' Bin packing, every item goes (longest first) into the bin with the least free space that can still fit it.
+
+    Returns:
+        bins (`List[List[int]]`):
+            Indices of the items in every bin.
+    '''
+    bins = []
+    free = [] # Sorted list of (free_space, bin_id)
+    for ind in sorted(range(len(lengths)), key=lambda i: -lengths[i]):
+        length = lengths[ind]
+        if length == 0:
+            continue
+        position = bisect.bisect_left(free, (length, -1))
+        if position < len(free):
+            space, bin_id = free.pop(position)
+            bins[bin_id].append(ind)
+            bisect.insort(free, (space - length, bin_id))
+        else:
+            bins.append([ind])
+            bisect.insort(free, (capacity - length, len(bins) - 1))
+    return bins
+
+
+def packing_efficiency(input_ids, block_size):
+    r''' Fraction of non-pad tokens if every packed example is padded to block_size, e.g.
+    `packing_efficiency(train_dataset['input_ids'], config.train.max_seq_len)`.
+    '''
+    ntokens = sum(min(len(ids), block_size) for ids in input_ids)
+    return ntokens / max(1, len(input_ids) * block_size)
@@ -0,0 +1,317 @@
+r'''
+Near-duplicate detection for the prepared data with MinHash + LSH. Every text is turned into word n-grams (special tokens
+and punctuation removed, lowercased), the n-grams into a MinHash signature, and the signature is split into bands. Texts
+that share a band are candidates, and a candidate is a duplicate if the estimated Jaccard similarity is >= threshold.
+Checking one text is (almost) constant time, so a whole corpus is deduplicated in near-linear time.
+
+Set `dedup` in the config to remove near-duplicates while `create_dataset` runs, or use `dedup_prepared_data` for a
+dataset that already exists.
+
+Which column of a parsed record is compared depends on the parser: `text` by default, `instruction` for the
+`simple_task_parser` (its `text` is the context, the same for all tasks of a row). It can be set per parser with
+`dedup.columns` (e.g. {csv_ner_parser: 'Entity'}) or per prompt config with `dedup_column`. Records without a
+non-empty string in that column are always kept. Texts are only compared with texts from the same column.
+'''
+
+import os
+import re
+import zlib
+import sqlite3
+import logging
+from collections import Counter
+from opengpt.lazy import lazy_import
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
+MERSENNE_PRIME = (1 << 61) - 1
+MAX_HASH = (1 << 32) - 1
+# Parsers for which `text` is not what makes a record unique
+PARSER_COLUMNS = {'simple_task_parser': 'instruction'}
+special_tokens_re = re.compile(r'<\|[^|>]*\|>')
+words_re = re.compile(r'\w+')
+
+
+def get_shingles(text, ngram=3):
+    r''' Word n-grams of the normalized text.
+    '''
+    words = words_re.findall(special_tokens_re.sub(' ', str(text)).lower())
+    if len(words) < ngram:
+        return {' '.join(words)}
+    return {' '.join(words[i:i + ngram]) for i in range(len(words) - ngram + 1)}
+
+
+def get_lsh_params(num_perm, threshold):
+    r''' Number of bands and rows per band, so that the LSH threshold (1/bands)^(1/rows) is as close as possible to `threshold`.
+    '''
+    best = None
+    for rows in range(1, num_perm + 1):
+        if num_perm % rows != 0:
+            continue
+        bands = num_perm // rows
+        error = abs((1 / bands) ** (1 / rows) - threshold)
+        if best is None or error < best[0]:
+            best = (error, bands, rows)
+    return best[1], best[2]
+
+
+class MinHashIndex(object):
+    r''' LSH index of MinHash signatures. Like `HashIndex` everything is kept in memory, and optionally also in a sqlite
+    database so that the index survives between runs.
+
+    Args:
+        path (`str`, optional):
+            Where to keep the sqlite database, if None the index lives only in memory.
+        num_perm (`int`):
+            Length of the signatures.
+        threshold (`float`):
+            Texts with an estimated Jaccard similarity (of the n-grams) >= threshold are duplicates.
+        ngram (`int`):
+            Size of the word n-grams.
+        seed (`int`):
+            Seed for the hash functions, has to stay the same for a persistent index.
+    '''
+    def __init__(self, path=None, num_perm=128, threshold=0.8, ngram=3, seed=11):
+        self.path = path
+        self.num_perm = num_perm
+        self.threshold = threshold
+        self.ngram = ngram
+        self.bands, self.rows = get_lsh_params(num_perm, threshold)
+        rng = np.random.RandomState(seed)
+        self.a = rng.randint(1, MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+        self.b = rng.randint(0, MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+
+        self.signatures = {}
+        self.buckets = [{} for _ in range(self.bands)]
+        self.db = None
+        if path is not None:
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute("CREATE TABLE IF NOT EXISTS signatures (doc TEXT PRIMARY KEY, namespace TEXT, signature BLOB)")
+            if 'namespace' not in [c[1] for c in self.db.execute("PRAGMA table_info(signatures)")]:
+                # Indexes from before the namespaces have only the `text` column
+                self.db.execute("ALTER TABLE signatures ADD COLUMN namespace TEXT DEFAULT 'text'")
+            self.db.execute("CREATE TABLE IF NOT EXISTS params (num_perm INTEGER, ngram INTEGER, seed INTEGER)")
+            params = self.db.execute("SELECT num_perm, ngram, seed FROM params").fetchone()
+            if params is None:
+                self.db.execute("INSERT INTO params VALUES (?, ?, ?)", (num_perm, ngram, seed))
+                self.db.commit()
+            elif tuple(params) != (num_perm, ngram, seed):
+                raise ValueError(f"The index at: {path} was created with (num_perm, ngram, seed) = {tuple(params)}, not {(num_perm, ngram, seed)}")
+            for doc, namespace, signature in self.db.execute("SELECT doc, namespace, signature FROM signatures"):
+                self._insert(doc, np.frombuffer(signature, dtype=np.uint32), namespace)
+
+    def __len__(self):
+        return len(self.signatures)
+
+    def __contains__(self, doc):
+        return doc in self.signatures
+
+    def signature(self, text):
+        shingles = get_shingles(text, self.ngram)
+        hv = np.fromiter((zlib.crc32(s.encode('utf-8')) for s in shingles), dtype=np.uint64, count=len(shingles))
+        # The multiplication can overflow, that is fine for hashing
+        with np.errstate(over='ignore'):
+            phv = ((hv[:, None] * self.a[None, :] + self.b[None, :]) % np.uint64(MERSENNE_PRIME)) & np.uint64(MAX_HASH)
+        return phv.min(axis=0).astype(np.uint32)
+
+    def _band_keys(self, signature, namespace=''):
+        prefix = namespace.encode('utf-8') + b'\0'
+        return [prefix + signature[i * self.rows:(i + 1) * self.rows].tobytes() for i in range(self.bands)]
+
+    def _insert(self, doc, signature, namespace=''):
+        self.signatures[doc] = signature
+        for bucket, key in zip(self.buckets, self._band_keys(signature, namespace)):
+            bucket.setdefault(key, []).append(doc)
+
+    def query(self, signature, namespace=''):
+        r''' The most similar indexed doc (of the same namespace) with similarity >= threshold, or None.
+
+        Returns:
+            (doc, similarity) or None
+        '''
+        candidates = set()
+        for bucket, key in zip(self.buckets, self._band_keys(signature, namespace)):
+            candidates.update(bucket.get(key, ()))
+        best = None
+        for doc in candidates:
+            similarity = float(np.mean(self.signatures[doc] == signature))
+            if similarity >= self.threshold and (best is None or similarity > best[1]):
+                best = (doc, similarity)
+        return best
+
+    def add(self, doc, signature, namespace=''):
+        if doc in self.signatures:
+            return
+        self._insert(doc, signature, namespace)
+        if self.db is not None:
+            self.db.execute("INSERT OR IGNORE INTO signatures (doc, namespace, signature) VALUES (?, ?, ?)", (doc, namespace, signature.tobytes()))
+
+    def check_and_add(self, doc, text, namespace=''):
+        r''' Returns the doc that `text` is a near-duplicate of (None if there is none), the text is added to the index
+        only if it is not a duplicate. Texts are compared only within the same `namespace`.
+        '''
+        signature = self.signature(text)
+        duplicate = self.query(signature, namespace)
+        if duplicate is not None:
+            return duplicate[0]
+        self.add(doc, signature, namespace)
+        return None
+
+    def flush(self):
+        if self.db is not None:
+            self.db.commit()
+
+    def close(self):
+        if self.db is not None:
+            self.db.commit()
+            self.db.close()
+            self.db = None
+
+
+def get_column(config, prompt_config=None, parser=None):
+    r''' The column of the parsed records that is compared for near-duplicates, None to not deduplicate.
+    '''
+    conf = getattr(config, 'dedup', None) or {}
+    if prompt_config and 'dedup_column' in prompt_config:
+        return prompt_config['dedup_column']
+    columns = conf.get('columns') or {}
+    if parser in columns:
+        return columns[parser]
+    return PARSER_COLUMNS.get(parser, conf.get('column', 'text'))
+
+
+def get_dedup_text(record, column):
+    r''' The text of a record that is compared, None if it has none (the record is then kept).
+    '''
+    if column is None:
+        return None
+    text = record.get(column)
+    if not isinstance(text, str) or not text.strip():
+        return None
+    return text
+
+
+def get_raw_data_columns(config, raw_data_path, prompt_db=None):
+    r''' The dedup column for the records of every raw data ID, from the parser and prompt config of the raw output.
+    '''
+    from opengpt.dataset_utils import _find_prompt_config
+    from opengpt.prompt_utils import PromptStore
+
+    if not os.path.exists(raw_data_path):
+        return {}
+    prompt_db = prompt_db if prompt_db is not None else PromptStore.load(config.path.prompt_db)
+    raw_data = pd.read_csv(raw_data_path, usecols=['id', 'dataset', 'prompt_hash'])
+    columns = {}
+    for (dataset, prompt_hash), ids in raw_data.groupby(['dataset', 'prompt_hash'])['id']:
+        prompt = prompt_db.get(prompt_hash) or {}
+        column = get_column(config, _find_prompt_config(config, prompt_hash, dataset), prompt.get('parser'))
+        columns.update(dict.fromkeys(ids.tolist(), column))
+    return columns
+
+
+def load_index(config, prepared_data_path, path=None, raw_data_path=None, prompt_db=None):
+    r''' The index for `config.dedup` (num_perm, threshold, ngram, persistent), None if dedup is not set. If the
+    index is not persistent (or the sqlite file is missing) it is built from the existing prepared data, the column of
+    every prepared row is found through its raw data (see `get_column`).
+    '''
+    conf = getattr(config, 'dedup', None)
+    if not conf:
+        return None
+    has_prepared_data = os.path.exists(prepared_data_path) and os.path.getsize(prepared_data_path) > 0
+    if conf.get('persistent', False):
+        if not has_prepared_data and path is not None and os.path.exists(path):
+            # The prepared data was removed, so the index is stale
+            os.remove(path)
+    else:
+        path = None
+    index = MinHashIndex(path=path, num_perm=conf.get('num_perm', 128), threshold=conf.get('threshold', 0.8), ngram=conf.get('ngram', 3))
+    if len(index) == 0 and has_prepared_data:
+        columns = get_raw_data_columns(config, raw_data_path, prompt_db) if raw_data_path else {}
+        prepared_data = pd.read_csv(prepared_data_path)
+        counts = Counter()
+        for record in prepared_data.to_dict('records'):
+            raw_data_id = record['raw_data_id']
+            column = columns.get(raw_data_id, get_column(config))
+            text = get_dedup_text(record, column)
+            if text is not None:
+                index.add(f'{raw_data_id}:{counts[raw_data_id]}', index.signature(text), column)
+            counts[raw_data_id] += 1
+        index.flush()
+        logging.warning(f"Built the near-duplicate index from {len(prepared_data)} rows of: {prepared_data_path}")
+    return index
+
+
+def dedup_records(records, index, doc_ids, column='text'):
+    r''' Removes near-duplicates (of each other or of anything already in the index) from a list of records, records
+    without a non-empty string in `column` are kept.
+
+    Returns:
+        kept (`List[dict]`), removed (`List[dict]`):
+            The removed records have a `duplicate_of` key with the doc ID of the original.
+    '''
+    kept, removed = [], []
+    for doc, record in zip(doc_ids, records):
+        text = get_dedup_text(record, column)
+        duplicate_of = index.check_and_add(doc, text, column) if text is not None else None
+        if duplicate_of is None:
+            kept.append(record)
+        else:
+            removed.append({**record, 'duplicate_of': duplicate_of})
+    return kept, removed
+
+
+def dedup_prepared_data(config, input_path=None, output_path=None, column=None, num_perm=128, threshold=0.8, ngram=3):
+    r''' Deduplicates an existing prepared dataset, the first occurrence of every group of near-duplicates is kept. The
+    number of removed rows is reported per dataset and prompt hash (taken from the raw data through `raw_data_id`).
+
+    Args:
+        input_path (`str`, optional):
+            By default the prepared data of the project.
+        output_path (`str`, optional):
+            Where to save the deduplicated data, by default `<input_path without .csv>.dedup.csv`.
+        column (`str`, optional):
+            Compare this column for all rows, by default it depends on the parser of every row (see `get_column`).
+
+    Returns:
+        report (`pd.DataFrame`):
+            dataset, prompt_hash, rows, removed
+    '''
+    directory = os.path.join(config.base_path, config.name)
+    input_path = input_path or os.path.join(directory, f"prepared_generated_data_for_{config.name}.csv")
+    output_path = output_path or input_path[:-len('.csv')] + '.dedup.csv'
+    df = pd.read_csv(input_path)
+    raw_data_path = os.path.join(directory, f"raw_generated_data_for_{config.name}.csv")
+    columns = {}
+    if os.path.exists(raw_data_path) and 'raw_data_id' in df.columns:
+        raw_data = pd.read_csv(raw_data_path, usecols=['id', 'dataset', 'prompt_hash']).set_index('id')
+        groups = raw_data.reindex(df['raw_data_id'])[['dataset', 'prompt_hash']].values.tolist()
+        if column is None:
+            columns = get_raw_data_columns(config, raw_data_path)
+    else:
+        groups = [[None, None]] * len(df)
+
+    index = MinHashIndex(num_perm=num_perm, threshold=threshold, ngram=ngram)
+    keep = np.ones(len(df), dtype=bool)
+    for i, record in enumerate(df.to_dict('records')):
+        row_column = column or columns.get(record.get('raw_data_id'), get_column(config))
+        text = get_dedup_text(record, row_column)
+        keep[i] = text is None or index.check_and_add(str(i), text, row_column) is None
+    df[keep].to_csv(output_path, index=False)
+
+    report = pd.DataFrame(groups, columns=['dataset', 'prompt_hash'])
+    report['removed'] = ~keep
+    report = report.groupby(['dataset', 'prompt_hash'], dropna=False)['removed'].agg(rows='size', removed='sum').reset_index()
+    log_report(report)
+    logging.warning(f"Removed {int((~keep).sum())} of {len(df)} rows, the deduplicated data is at: {output_path}")
+    return report
+
+
+def log_report(report):
+    r''' Logs the removed near-duplicates, either a report from `dedup_prepared_data` or a Counter of (dataset, prompt_hash).
+    '''
+    if isinstance(report, Counter):
+        report = pd.DataFrame([{'dataset': d, 'prompt_hash': h, 'removed': n} for (d, h), n in report.items()])
+    if len(report):
+        logging.warning("Near-duplicates removed per dataset/prompt:\n" + report.to_string(index=False))
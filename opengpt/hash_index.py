@@ -0,0 +1,100 @@
+import sqlite3
+import json
+import os
+from collections import Counter
+
+
+class HashIndex(object):
+    r''' Answers "was this already generated?" in constant time. All keys are kept in memory (a set), and optionally
+    also in a sqlite database so that the index survives between runs without rebuilding it from the raw CSV.
+
+    Every key can belong to a group (e.g. the prompt_hash), so that we can also count how many outputs exist for a group.
+
+    Args:
+        path (`str`, optional):
+            Where to keep the sqlite database, if None the index lives only in memory.
+    '''
+    def __init__(self, path=None):
+        self.path = path
+        self.keys = set()
+        self.group_counts = Counter()
+        self.db = None
+
+        if path is not None:
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute("CREATE TABLE IF NOT EXISTS hashes (key TEXT PRIMARY KEY, grp TEXT)")
+            # E.g. the stamp of the raw data the index belongs to, see `load_hash_index`
+            self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            for key, group in self.db.execute("SELECT key, grp FROM hashes"):
+                self.keys.add(key)
+                self.group_counts[group] += 1
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, key, group=None):
+        r''' Add one key, returns False if it was already in the index.
+        '''
+        if key in self.keys:
+            return False
+        self.keys.add(key)
+        self.group_counts[group] += 1
+        if self.db is not None:
+            self.db.execute("INSERT OR IGNORE INTO hashes VALUES (?, ?)", (key, group))
+        return True
+
+    def update(self, keys, groups=None):
+        r''' Add many keys at once, e.g. everything from an existing raw_data CSV.
+        '''
+        if groups is None:
+            groups = [None] * len(keys)
+        new = [(str(key), None if group is None else str(group)) for key, group in zip(keys, groups) if str(key) not in self.keys]
+        for key, group in new:
+            if key not in self.keys:
+                self.keys.add(key)
+                self.group_counts[group] += 1
+        if self.db is not None and new:
+            self.db.executemany("INSERT OR IGNORE INTO hashes VALUES (?, ?)", new)
+            self.db.commit()
+
+    def clear(self):
+        self.keys = set()
+        self.group_counts = Counter()
+        if self.db is not None:
+            self.db.execute("DELETE FROM hashes")
+            self.db.execute("DELETE FROM meta")
+            self.db.commit()
+
+    def get_meta(self, key, default=None):
+        if self.db is None:
+            return default
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row is not None else default
+
+    def set_meta(self, key, value):
+        r''' Saved together with the keys on the next `flush`.
+        '''
+        if self.db is not None:
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, json.dumps(value)))
+
+    def count(self, group):
+        r''' How many keys belong to this group.
+        '''
+        return self.group_counts[group]
+
+    def flush(self):
+        r''' Make sure everything is written to disk, should be called together with saving the generated data.
+        '''
+        if self.db is not None:
+            self.db.commit()
+
+    def close(self):
+        if self.db is not None:
+            self.db.commit()
+            self.db.close()
+            self.db = None
@@ -0,0 +1,57 @@
+r'''
+Lazy imports, so that importing an opengpt module does not import pandas, openai, ... until they are really used.
+This keeps the startup of short lived workers (and of modules that need only a small part of the package) fast:
+
+    pd = lazy_import('pandas')
+    tqdm = lazy_callable('tqdm.auto', 'tqdm')
+
+Only for things that are not used at import time (e.g. as a base class), otherwise there is nothing to gain.
+'''
+
+import importlib
+import sys
+
+
+class LazyModule(object):
+    r''' Stands in for a module and imports it on the first attribute access.
+    '''
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        if self._module is None:
+            self.__dict__['_module'] = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._load(), name, value)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        return f"<lazy module '{self._name}'{' (loaded)' if self._module is not None else ''}>"
+
+
+def lazy_import(name):
+    r''' The module if it was already imported, otherwise a `LazyModule` for it.
+    '''
+    if name in sys.modules:
+        return sys.modules[name]
+    return LazyModule(name)
+
+
+def lazy_callable(module, name):
+    r''' A function that imports `module` on the first call and then calls `module.name`, e.g. for tqdm.
+    '''
+    target = []
+    def wrapper(*args, **kwargs):
+        if not target:
+            target.append(getattr(importlib.import_module(module), name))
+        return target[0](*args, **kwargs)
+    wrapper.__name__ = name
+    return wrapper
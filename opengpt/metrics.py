@@ -0,0 +1,292 @@
+r'''
+Metrics for the data generation pipeline: counters, gauges and latency histograms per stage (splitting, teacher calls,
+parsing, checkpoints), teacher tokens in/out with a cost estimate, parse success rate and the number of requests in flight.
+
+Everything is recorded in the process-wide `metrics` object. Set `metrics` in the config to get a JSON dump every
+`interval` seconds and/or a Prometheus text endpoint:
+
+    metrics:
+      json_path: './metrics.json'
+      interval: 60
+      prometheus_port: 9100
+
+and `cost_per_1k_prompt_tokens`/`cost_per_1k_output_tokens` under `teacher` for the cost estimate.
+'''
+
+import os
+import json
+import time
+import bisect
+import logging
+import threading
+from contextlib import contextmanager
+
+# Seconds, from 1ms to ~15min
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 900)
+
+
+class Histogram(object):
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1) # The last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        r''' Upper bound of the bucket where the q-quantile is.
+        '''
+        if self.count == 0:
+            return None
+        target = q * self.count
+        total = 0
+        for bound, count in zip(self.buckets + (self.max,), self.counts):
+            total += count
+            if total >= target:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {'count': self.count, 'sum': self.sum, 'mean': self.sum / self.count if self.count else None, 'max': self.max,
+                'p50': self.quantile(0.5), 'p90': self.quantile(0.9), 'p99': self.quantile(0.99),
+                'buckets': dict(zip([str(b) for b in self.buckets] + ['+Inf'], self.counts))}
+
+
+def _key(name, labels):
+    return (name, tuple(sorted(labels.items())))
+
+
+def _format_key(key):
+    name, labels = key
+    if not labels:
+        return name
+    return name + '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+
+
+class Metrics(object):
+    r''' Thread safe counters, gauges and histograms, every metric can have labels, e.g.
+    `metrics.inc('parse_failures', parser='csv_qa_parser')`.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}
+            self.gauges = {}
+            self.histograms = {}
+            self.start = time.time()
+
+    def inc(self, name, value=1, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self.gauges[_key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        r''' Observes the time spent in the block in the histogram `name` (in seconds).
+        '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def get(self, name, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            return self.counters.get(key, self.gauges.get(key))
+
+    def snapshot(self):
+        r''' Everything as a json serializable dict, plus a few derived values (parse success rate, cost, throughput).
+        '''
+        with self._lock:
+            out = {'time': time.time(), 'uptime_s': time.time() - self.start,
+                   'counters': {_format_key(k): v for k, v in self.counters.items()},
+                   'gauges': {_format_key(k): v for k, v in self.gauges.items()},
+                   'histograms': {_format_key(k): h.to_dict() for k, h in self.histograms.items()}}
+            totals = {}
+            for (name, _), value in self.counters.items():
+                totals[name] = totals.get(name, 0) + value
+        parsed = totals.get('parse_successes', 0) + totals.get('parse_failures', 0)
+        out['derived'] = {
+            'parse_success_rate': totals.get('parse_successes', 0) / parsed if parsed else None,
+            'teacher_requests_per_s': totals.get('teacher_requests', 0) / max(out['uptime_s'], 1e-9),
+            'teacher_cost': totals.get('teacher_cost', 0),
+            }
+        return out
+
+    def to_prometheus(self, prefix='opengpt_'):
+        r''' The metrics in the Prometheus text format.
+        '''
+        lines = []
+        with self._lock:
+            for kind, metrics in (('counter', self.counters), ('gauge', self.gauges)):
+                typed = set()
+                for (name, labels), value in sorted(metrics.items()):
+                    if name not in typed:
+                        lines.append(f'# TYPE {prefix}{name} {kind}')
+                        typed.add(name)
+                    lines.append(f'{prefix}{_format_key((name, labels))} {value}')
+            typed = set()
+            for (name, labels), h in sorted(self.histograms.items(), key=lambda x: x[0]):
+                if name not in typed:
+                    lines.append(f'# TYPE {prefix}{name} histogram')
+                    typed.add(name)
+                total = 0
+                for bound, count in zip([str(b) for b in h.buckets] + ['+Inf'], h.counts):
+                    total += count
+                    lines.append(f'{prefix}{_format_key((name + "_bucket", labels + (("le", bound),)))} {total}')
+                lines.append(f'{prefix}{_format_key((name + "_sum", labels))} {h.sum}')
+                lines.append(f'{prefix}{_format_key((name + "_count", labels))} {h.count}')
+        return '\n'.join(lines) + '\n'
+
+    def dump_json(self, path):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.snapshot(), f, indent=2)
+        os.replace(tmp_path, path)
+
+
+metrics = Metrics()
+
+
+class MetricsReporter(object):
+    r''' Writes `metrics.snapshot()` to `json_path` every `interval` seconds and/or serves `/metrics` in the Prometheus
+    text format on `prometheus_port`. Use as a context manager, the last dump is written on exit.
+    '''
+    def __init__(self, metrics=metrics, json_path=None, interval=60, prometheus_port=None):
+        self.metrics = metrics
+        self.json_path = json_path
+        self.interval = interval
+        self.prometheus_port = prometheus_port
+        self._stop = threading.Event()
+        self._thread = None
+        self._server = None
+
+    @classmethod
+    def from_config(cls, config):
+        r''' Uses `metrics.json_path`, `metrics.interval` and `metrics.prometheus_port` from the config, returns None if
+        none of them are set.
+        '''
+        conf = getattr(config, 'metrics', None) or {}
+        if not conf.get('json_path') and not conf.get('prometheus_port'):
+            return None
+        return cls(json_path=conf.get('json_path'), interval=conf.get('interval', 60), prometheus_port=conf.get('prometheus_port'))
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.dump()
+
+    def dump(self):
+        if self.json_path:
+            try:
+                self.metrics.dump_json(self.json_path)
+            except OSError as e:
+                logging.warning(f"Could not write the metrics to: {self.json_path}, {e}")
+
+    def start(self):
+        if self.json_path:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        if self.prometheus_port:
+            from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+            reporter = self
+
+            class Handler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    body = reporter.metrics.to_prometheus().encode('utf-8')
+                    self.send_response(200 if self.path.startswith('/metrics') else 404)
+                    self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, *args):
+                    pass
+
+            self._server = ThreadingHTTPServer(('', self.prometheus_port), Handler)
+            threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+        self.dump()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+class InstrumentedTeacher(object):
+    r''' Wraps a teacher to record the latency of every call, errors, and tokens in/out with the cost estimate. Tokens
+    are counted with tiktoken if the encoding is available, otherwise estimated as characters / 4.
+    '''
+    def __init__(self, teacher, config, metrics=metrics):
+        self.teacher = teacher
+        self.metrics = metrics
+        self.cost_in = config.teacher.get('cost_per_1k_prompt_tokens', 0) / 1000
+        self.cost_out = config.teacher.get('cost_per_1k_output_tokens', 0) / 1000
+        self._encoding = None
+        try:
+            import tiktoken
+            try:
+                self._encoding = tiktoken.encoding_for_model(config.teacher.get('model'))
+            except KeyError:
+                self._encoding = tiktoken.get_encoding('cl100k_base')
+        except Exception:
+            pass
+
+    def count_tokens(self, text):
+        if not text:
+            return 0
+        if self._encoding is not None:
+            return len(self._encoding.encode(text, disallowed_special=()))
+        return len(text) // 4
+
+    def __getattr__(self, name):
+        # stats(), generate_batch() etc. of the wrapped teacher
+        return getattr(self.teacher, name)
+
+    def __call__(self, prompt, config):
+        self.metrics.inc('teacher_requests')
+        start = time.perf_counter()
+        try:
+            out = self.teacher(prompt, config)
+        except Exception as e:
+            self.metrics.inc('teacher_errors', error=type(e).__name__)
+            raise
+        finally:
+            self.metrics.observe('teacher_request_seconds', time.perf_counter() - start)
+        ntokens_in, ntokens_out = self.count_tokens(prompt), self.count_tokens(out)
+        self.metrics.inc('teacher_prompt_tokens', ntokens_in)
+        self.metrics.inc('teacher_output_tokens', ntokens_out)
+        self.metrics.inc('teacher_cost', ntokens_in * self.cost_in + ntokens_out * self.cost_out)
+        if out is None:
+            self.metrics.inc('teacher_unfinished')
+        return out
@@ -0,0 +1,333 @@
+r'''
+Streaming training data: the prepared CSVs are read in chunks and interleaved with sampling weights, and shuffled
+with a bounded buffer, so the memory does not depend on the size of the corpus. The order depends only on the seed, so
+a restarted training can continue from a step offset without loading (or tokenizing) what was already seen:
+
+    train:
+      datasets: [a.csv, b.csv]
+      dataset_weights: [3, 1] # 3/4 of the examples come from a.csv
+      shuffle_buffer_size: 10000
+
+    train_dataset = MixedStreamDataset.from_config(config, tokenizer, start_step=0)
+
+Sources are restarted when they run out (with `cycle`), so the stream never ends and `max_steps` has to be set in the
+HF training arguments. To resume, save the position of the stream with every checkpoint and continue from it (with
+`ignore_data_skip: True`, the Trainer can not skip examples of an iterable dataset itself):
+
+    trainer.add_callback(get_state_callback(train_dataset))
+    ...
+    train_dataset = MixedStreamDataset.from_config(config, tokenizer, resume_from_checkpoint=checkpoint)
+
+The saved state has the RNG state, the row of every CSV and the shuffle buffer, so nothing before the position is read
+again. This works with `dataloader_num_workers: 0` (with more workers the dataset is iterated in other processes). The
+dataloader can fetch one batch ahead, so at most one batch can be skipped on a resume.
+
+Without a saved state, `start_step` skips a number of mixed *texts*. This is not the number of training examples when
+packing is used (one packed example holds many texts), there the state has to be used.
+'''
+
+import os
+import json
+import logging
+import torch
+from opengpt.lazy import lazy_import
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
+
+def iter_csv_texts(path, chunksize=1000, text_column='text', start=0):
+    r''' Texts from one CSV, read `chunksize` rows at a time, starting at row `start` (the rows before it are skipped by
+    the CSV reader, not parsed into texts).
+    '''
+    skiprows = range(1, start + 1) if start else None
+    for df in pd.read_csv(path, usecols=[text_column], chunksize=chunksize, skiprows=skiprows):
+        yield from df[text_column].fillna('').astype(str).tolist()
+
+
+class StreamMixer(object):
+    r''' Interleaves the streams, every example comes from source i with probability weights[i] / sum(weights), and
+    shuffles them with a buffer of `buffer_size` examples (0 to not shuffle). The position in the mixed stream can be
+    saved with `state_dict` and restored with `load_state_dict`, the sources then continue from their saved row.
+
+    Args:
+        sources (`List[Callable]`):
+            Functions `source(start)` that return a new iterator over a source from row `start` on, called again
+            (with 0) when a source is restarted.
+        weights (`List[float]`):
+            Sampling weight of every source.
+        cycle (`bool`):
+            Restart sources that run out, otherwise they are dropped (and the weights of the others renormalized)
+            and the stream ends when all are done.
+        block_size (`int`):
+            Random numbers are drawn in blocks of this size, it has to stay the same to get the same order.
+    '''
+    def __init__(self, sources, weights, seed=11, buffer_size=10000, cycle=True, block_size=1024):
+        self.sources = sources
+        self.weights = np.asarray(weights, dtype=np.float64)
+        self.buffer_size = buffer_size
+        self.cycle = cycle
+        self.block_size = block_size
+        self.rng = np.random.default_rng(seed)
+        self.iterators = [None] * len(sources)
+        self.offsets = [0] * len(sources) # Rows read from every source (since its last restart)
+        self.active = self.weights > 0
+        self.buffer = []
+        self.draining = False
+        self.ntexts = 0
+        self.choices, self.picks, self.position = None, None, block_size
+        self.block_rng_state = None
+
+    def _draw(self):
+        # The state before the block is drawn is what is saved, the block is drawn again on load
+        self.block_rng_state = self.rng.bit_generator.state
+        p = np.where(self.active, self.weights, 0)
+        self.choices = self.rng.choice(len(self.sources), size=self.block_size, p=p / p.sum())
+        self.picks = self.rng.integers(0, max(self.buffer_size, 1), size=self.block_size)
+        self.position = 0
+
+    def _next(self, source_ind):
+        if self.iterators[source_ind] is None:
+            self.iterators[source_ind] = self.sources[source_ind](self.offsets[source_ind])
+        example = next(self.iterators[source_ind], None)
+        if example is not None:
+            self.offsets[source_ind] += 1
+        return example
+
+    def state_dict(self):
+        r''' Everything needed to continue from the current position: the RNG state, the row of every source and the
+        texts in the shuffle buffer (so the state is about as big as the buffer).
+        '''
+        in_block = self.position < self.block_size
+        return {
+            'rng': self.block_rng_state if in_block else self.rng.bit_generator.state,
+            'position': self.position if in_block else self.block_size,
+            'offsets': list(self.offsets),
+            'active': self.active.tolist(),
+            'buffer': list(self.buffer),
+            'draining': self.draining,
+            'texts': self.ntexts,
+            }
+
+    def load_state_dict(self, state):
+        self.rng.bit_generator.state = state['rng']
+        self.offsets = list(state['offsets'])
+        self.active = np.asarray(state['active'], dtype=bool)
+        self.buffer = list(state['buffer'])
+        self.draining = state['draining']
+        self.ntexts = state['texts']
+        self.iterators = [None] * len(self.sources)
+        self.position = self.block_size
+        if state['position'] < self.block_size:
+            # The same block as before, `active` has not changed since it was drawn
+            self._draw()
+            self.position = state['position']
+
+    def __iter__(self):
+        while self.active.any() and not self.draining:
+            if self.position == self.block_size:
+                self._draw()
+            source_ind = self.choices[self.position]
+            pick = self.picks[self.position]
+            self.position += 1
+
+            example = self._next(source_ind)
+            if example is None:
+                if self.cycle:
+                    self.iterators[source_ind], self.offsets[source_ind] = None, 0
+                    example = self._next(source_ind)
+                    if example is None:
+                        logging.warning(f"Source: {source_ind} is empty, it will not be used")
+                        self.active[source_ind] = False
+                        self.position = self.block_size # New weights
+                        continue
+                else:
+                    self.active[source_ind] = False
+                    self.position = self.block_size
+                    continue
+
+            if self.buffer_size > 1 and len(self.buffer) < self.buffer_size:
+                self.buffer.append(example)
+                continue
+            if self.buffer_size > 1:
+                # The buffer is updated before the yield, so that a state saved at this point is consistent
+                example, self.buffer[pick] = self.buffer[pick], example
+            self.ntexts += 1
+            yield example
+
+        # Only if the sources are not cycled
+        if not self.draining:
+            self.buffer = [self.buffer[ind] for ind in self.rng.permutation(len(self.buffer))[::-1]]
+            self.draining = True
+        while self.buffer:
+            self.ntexts += 1
+            yield self.buffer.pop()
+
+
+def mix_streams(sources, weights, seed=11, buffer_size=10000, cycle=True, block_size=1024):
+    r''' The mixed and shuffled stream of the sources, see `StreamMixer`.
+
+    Yields:
+        example
+    '''
+    return iter(StreamMixer(sources, weights, seed=seed, buffer_size=buffer_size, cycle=cycle, block_size=block_size))
+
+
+class MixedStreamDataset(torch.utils.data.IterableDataset):
+    r''' Training examples from more CSVs mixed by weight (see `mix_streams`), tokenized, labeled and packed on the fly
+    in chunks of `chunksize` examples (the same as the map steps in the training notebook). Without a tokenizer the
+    items are {'text': ...}.
+
+    Args:
+        paths (`List[str]`):
+            Prepared CSVs with a `text` column.
+        weights (`List[float]`, optional):
+            Sampling weight of every CSV, by default all are the same.
+        config:
+            The train config, used for the labels and packing, required with a tokenizer.
+        tokenizer (optional):
+            HF tokenizer with the special tokens already added.
+        seed (`int`):
+            The order depends only on this (and the parameters).
+        buffer_size (`int`):
+            Size of the shuffle buffer, the memory used is this many texts.
+        start_step (`int`):
+            Number of mixed texts (not packed examples) to skip, they are read but not tokenized. With packing (which is
+            done per chunk) the skip is rounded down to a multiple of `chunksize`, so that the chunks are the same as in
+            the first run. Ignored if `state` is given.
+        state (`dict`, optional):
+            Where to continue, as returned by `state_dict` (or saved with `save_state`).
+        cycle (`bool`):
+            Restart the CSVs that run out, the stream is then endless.
+        chunksize (`int`):
+            Rows read from a CSV at a time, and examples tokenized and packed together.
+    '''
+    def __init__(self, paths, weights=None, config=None, tokenizer=None, seed=11, buffer_size=10000, start_step=0, cycle=True, chunksize=1000,
+                 state=None):
+        self.paths = list(paths)
+        self.weights = list(weights) if weights is not None else [1] * len(self.paths)
+        if len(self.weights) != len(self.paths):
+            raise ValueError(f"There are {len(self.paths)} datasets but {len(self.weights)} weights")
+        self.config = config
+        self.tokenizer = tokenizer
+        self.seed = seed
+        self.buffer_size = buffer_size
+        self.start_step = start_step
+        self.cycle = cycle
+        self.chunksize = chunksize
+        self.state = state
+        self._mixer = None
+        self._chunk_state = None # (mixer state at the start of the current chunk, examples yielded from it)
+        self.packing_type = config.train.get('packing_type', 'none') if (config is not None and tokenizer is not None) else 'none'
+
+    @classmethod
+    def from_config(cls, config, tokenizer=None, start_step=0, resume_from_checkpoint=None, **kwargs):
+        r''' Uses `train.datasets`, `train.dataset_weights`, `train.shuffle_buffer_size` and `train.seed` (or
+        `hf_training_arguments.seed`) from the config. With `resume_from_checkpoint` (a checkpoint directory) the
+        stream continues from the state saved there by the `get_state_callback` callback.
+        '''
+        train = config.train
+        seed = train.get('seed', train.get('hf_training_arguments', {}).get('seed', 11))
+        if resume_from_checkpoint is not None:
+            path = os.path.join(resume_from_checkpoint, STATE_NAME)
+            if os.path.exists(path):
+                kwargs['state'] = load_state(path)
+            else:
+                logging.warning(f"There is no stream state at: {path}, the stream starts from step: {start_step}")
+        return cls(train.datasets, weights=train.get('dataset_weights'), config=config, tokenizer=tokenizer, seed=seed,
+                   buffer_size=train.get('shuffle_buffer_size', 10000), start_step=start_step, **kwargs)
+
+    def state_dict(self):
+        r''' The position of the last example that was yielded (with packing the start of its chunk and the number of
+        examples already yielded from it), None before the iteration starts.
+        '''
+        if self._chunk_state is not None:
+            return {'mixer': self._chunk_state[0], 'examples': self._chunk_state[1]}
+        if self._mixer is not None:
+            return {'mixer': self._mixer.state_dict(), 'examples': 0}
+        return self.state
+
+    def save_state(self, path):
+        state = self.state_dict()
+        if state is not None:
+            with open(path, 'w') as f:
+                json.dump(state, f)
+
+    def texts(self):
+        r''' The mixed texts, from the saved `state` or from `start_step` on (rounded down to a chunk with packing).
+        '''
+        sources = [lambda start, path=path: iter_csv_texts(path, chunksize=self.chunksize, start=start) for path in self.paths]
+        self._mixer = StreamMixer(sources, self.weights, seed=self.seed, buffer_size=self.buffer_size, cycle=self.cycle)
+        self._chunk_state = None
+        stream = iter(self._mixer)
+        if self.state is not None:
+            self._mixer.load_state_dict(self.state['mixer'])
+            return stream
+        skip = self.start_step
+        if self.packing_type != 'none':
+            skip = skip - skip % self.chunksize
+        for _ in range(skip):
+            if next(stream, None) is None:
+                break
+        return stream
+
+    def _process(self, texts):
+        from opengpt.dataset_utils import create_labels, pack_examples
+
+        examples = {'input_ids': self.tokenizer(texts, add_special_tokens=False)['input_ids']}
+        examples = create_labels(examples, self.config, self.tokenizer)
+        examples = pack_examples(examples, self.config.train.max_seq_len, packing_type=self.packing_type,
+                                 add_position_ids=self.config.train.get('add_position_ids', False))
+        keys = [k for k in ('input_ids', 'labels', 'position_ids') if k in examples]
+        for i in range(len(examples['input_ids'])):
+            yield {k: examples[k][i] for k in keys}
+
+    def __iter__(self):
+        # With more dataloader workers every worker reads the whole stream, but processes only its share of the chunks
+        worker = torch.utils.data.get_worker_info()
+        worker_id, num_workers = (worker.id, worker.num_workers) if worker is not None else (0, 1)
+        texts = self.texts()
+        if self.tokenizer is None:
+            for i, text in enumerate(texts):
+                if i % num_workers == worker_id:
+                    yield {'text': text}
+            return
+
+        # Examples of the first chunk that were yielded before the state was saved
+        skip = self.state['examples'] if self.state is not None else 0
+        chunk_ind = 0
+        while True:
+            mixer_state = self._mixer.state_dict()
+            chunk = [text for _, text in zip(range(self.chunksize), texts)]
+            if not chunk:
+                break
+            if chunk_ind % num_workers == worker_id:
+                for i, example in enumerate(self._process(chunk)):
+                    if i >= skip:
+                        self._chunk_state = (mixer_state, i + 1)
+                        yield example
+            skip = 0
+            chunk_ind += 1
+
+
+STATE_NAME = 'mixed_stream_state.json'
+def load_state(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def get_state_callback(dataset):
+    r''' A HF `TrainerCallback` that saves the state of a `MixedStreamDataset` into every checkpoint (as
+    `mixed_stream_state.json`), see `MixedStreamDataset.from_config` for the resume.
+    '''
+    from transformers import TrainerCallback
+    from transformers.trainer_utils import PREFIX_CHECKPOINT_DIR
+
+    class MixedStreamStateCallback(TrainerCallback):
+        def on_save(self, args, state, control, **kwargs):
+            if state.is_world_process_zero:
+                checkpoint = os.path.join(args.output_dir, f"{PREFIX_CHECKPOINT_DIR}-{state.global_step}")
+                os.makedirs(checkpoint, exist_ok=True)
+                dataset.save_state(os.path.join(checkpoint, STATE_NAME))
+
+    return MixedStreamStateCallback()
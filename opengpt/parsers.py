@@ -1,56 +1,136 @@
 r'''
 Parsers are used to parse the output from a Teacher (OpenAI, Google, ...) into the right format. The purpose of the paraser is to
- parse the new output and append it to the prepared_data. Every parser will receive:
+ parse the new output into records (dicts) that will be appended to the prepared_data. Every parser will receive:
     - data: the new data output from a Teacher model
-    - prepared_data: the dataset we are creating, in other words old data that was output by a parser
     - prompt_config: the prompt_config for the current prompt as a dictionary (taken from the .yaml file)
     - config: general config, ie the whole .yaml file as a python-box (can be used as a dictionary)
     - row: the row from the original CSV that was used for context to generate the `data`, can be empty given the use-case
     - raw_data_id: the ID of the `data` in the raw_data CSV (used to store the raw output from OpenAI)
     - prompt_text: the prepared prompt that was used to generate `data`
 
-If we are running the paraser for the first time the `prepared_data` will be empty (None) and it is up to us to define how that prepared_data (e.g. CSV) should look. Every parser can have different columns depending on the use-case.
+and return a list of new records, e.g. [{'text': ..., 'raw_data_id': ...}, ...]. It is up to us to define how the records
+(i.e. the prepared_data CSV) should look. Every parser can have different columns depending on the use-case. The pipeline takes care of
+batching the records and writing them into the prepared_data.
+
+Old style parsers that also receive `prepared_data` and return it with the new data concatenated are still supported, see `run_parser`.
+
+Malformed outputs should not end in random exceptions: a parser raises `ParseError(reason)` if nothing can be parsed, and if it
+accepts a `failures` argument it appends `{'reason': ..., 'text': ...}` for every part it had to skip (e.g. one broken Q/A pair).
+Both end up in the parse failure ledger written by `create_dataset`.
 
 If the parser will output the final prepeared data that will be used for model training, it should append special tokens: config.special_tokens.[user, ai, eos, eod],
 have a look at the functions below (e.g. csv_qa_parser).
 '''
 
-import pandas as pd
-from io import StringIO
+import csv
+import inspect
 import re
-import logging
+from io import StringIO
 
-def csv_qa_parser(data, prepared_data, prompt_config, config, row, raw_data_id, prompt_text):
-    r''' Expects data in the CSV format, with the separator `;`, the dataframe has to have two columns: `Question`, `Answer`
+
+class ParseError(Exception):
+    r''' The output of the teacher could not be parsed, the message is the reason.
     '''
-    qa_pairs = None
-    df = pd.read_csv(StringIO(data), sep=';')
 
-    # Strip everything
-    df = df.applymap(lambda x: x.strip() if isinstance(x, str) else x)
 
+def run_parser(parser, data, prompt_config, config, row, raw_data_id, prompt_text, failures=None):
+    r''' Runs a parser and returns the list of new records. Parsers written for the old API (receiving the
+    `prepared_data` and returning a DataFrame) are given `prepared_data=None`, so that they return only the new rows.
+
+    Args:
+        failures (`List[dict]`, optional):
+            Passed to the parsers that accept it, the skipped parts of the output are appended here.
+    '''
+    if not isinstance(data, str) or not data.strip():
+        raise ParseError("The teacher output is empty")
+    kwargs = dict(data=data, prompt_config=prompt_config, config=config, row=row, raw_data_id=raw_data_id, prompt_text=prompt_text)
+    parameters = inspect.signature(parser).parameters
+    if 'failures' in parameters:
+        kwargs['failures'] = failures if failures is not None else []
+    if 'prepared_data' in parameters:
+        new_data = parser(prepared_data=None, **kwargs)
+        if new_data is None:
+            return []
+        return new_data.to_dict('records')
+    return parser(**kwargs)
+
+
+def _get_reference(prompt_config, row):
     ref_col = prompt_config.get('reference_column_to_append', None)
     if ref_col and row is not None and ref_col in row and row[ref_col]:
         # Means we want to append a reference at the end of each Answer
-        to_append = f"\nReferences:\n- {row[ref_col]}"
-        df['Answer'] = df['Answer'] + to_append
-    df['Question'] += f' {config.special_tokens.eos}' # Every Q/A pair is independent
-    df['Answer'] += f' {config.special_tokens.eos} {config.special_tokens.eod}'
-    qa_pairs = [f'{config.special_tokens.user} {q.strip()} {config.special_tokens.ai} {a.strip()}' for q,a in df[['Question', 'Answer']].values]
-
-    new_data = pd.DataFrame([[text, raw_data_id] for text in qa_pairs], columns=['text', 'raw_data_id'])
-    if prepared_data is None:
-        prepared_data = new_data
-    else:
-        prepared_data = pd.concat([prepared_data, new_data], ignore_index=True)
+        return f"\nReferences:\n- {row[ref_col]}"
+    return ''
 
-    return prepared_data
 
+def _read_csv(data, failures):
+    r''' Header and rows of a `;` separated CSV, rows with a different number of fields than the header are skipped.
+    '''
+    lines = [line for line in csv.reader(StringIO(data), delimiter=';') if any(x.strip() for x in line)]
+    if not lines:
+        raise ParseError("No CSV header")
+    header = [x.strip() for x in lines[0]]
+    rows = []
+    for line in lines[1:]:
+        if len(line) != len(header):
+            failures.append({'reason': f"Expected {len(header)} fields, got {len(line)}", 'text': ';'.join(line)})
+        else:
+            rows.append(line)
+    return header, rows
+
+
+def csv_qa_parser(data, prompt_config, config, row, raw_data_id, prompt_text, failures=None):
+    r''' Expects data in the CSV format, with the separator `;`, the dataframe has to have two columns: `Question`, `Answer`
+    '''
+    failures = failures if failures is not None else []
+    header, rows = _read_csv(data, failures)
+    if 'Question' not in header or 'Answer' not in header:
+        raise ParseError(f"The CSV has no Question/Answer columns, the header is: {header}")
+    q_ind, a_ind = header.index('Question'), header.index('Answer')
 
-instruction_text = re.compile(r'Instruction:?(.*?)Input:', re.DOTALL)
-input_text = re.compile(r'Input:?(.*?)Output:?', re.DOTALL)
-output_text = re.compile(r'Output:?(.*?)$', re.DOTALL)
-def task_parser(data, prepared_data, prompt_config, row, config, raw_data_id, prompt_text):
+    st = config.special_tokens
+    to_append = _get_reference(prompt_config, row)
+    new_data = []
+    for line in rows:
+        q, a = line[q_ind].strip(), line[a_ind].strip()
+        if not q or not a:
+            failures.append({'reason': "Empty question or answer", 'text': ';'.join(line)})
+            continue
+        # Every Q/A pair is independent
+        new_data.append({'text': f'{st.user} {q} {st.eos} {st.ai} {a}{to_append} {st.eos} {st.eod}', 'raw_data_id': raw_data_id})
+    return new_data
+
+
+# One scan over the whole output, the markers split it into tasks and fields. Input/Output need the colon (like the
+# old regexes), otherwise the words in a text (e.g. "the Input layer") would start a new field
+task_markers = re.compile(r'(?P<task>[1-9 \.]*Task[:\s]*)|(?P<instruction>Instruction:?)|(?P<input>Input:)|(?P<output>Output:)')
+TASK_FIELDS = ('instruction', 'input', 'output')
+def _split_tasks(data):
+    r''' Yields (fields, text) for every task, fields maps instruction/input/output to (start, end) in `data`. A marker
+    only counts if it comes after the current field, e.g. `Input` inside of an output is part of the output.
+    '''
+    fields, field, task_start = {}, None, 0
+    for m in task_markers.finditer(data):
+        kind = m.lastgroup
+        if kind == 'task':
+            if field is not None:
+                fields[field] = (fields[field][0], m.start())
+            # Text without any fields before the first task is skipped
+            if fields or (task_start > 0 and data[task_start:m.start()].strip()):
+                yield fields, data[task_start:m.start()]
+            fields, field, task_start = {}, None, m.end()
+        elif field is None or TASK_FIELDS.index(kind) > TASK_FIELDS.index(field):
+            if field is not None:
+                fields[field] = (fields[field][0], m.start())
+            field = kind
+            fields[field] = (m.end(), None)
+    if field is not None:
+        fields[field] = (fields[field][0], len(data))
+    if fields or (task_start > 0 and data[task_start:].strip()):
+        yield fields, data[task_start:]
+
+
+def task_parser(data, prompt_config, config, row, raw_data_id, prompt_text, failures=None):
     r''' This parser can be used with prompts similar to Alpaca, it expects `data` in the following format:
         Task:
         Instruction:
@@ -64,15 +144,16 @@ def task_parser(data, prepared_data, prompt_config, row, config, raw_data_id, pr
     .
     .
     .
+    A task without `Input` is treated as a task with no input.
     '''
-    tasks = re.split(r'[1-9 \.]*Task[:\s]*', str(data))
+    failures = failures if failures is not None else []
     st = config.special_tokens
     new_data = []
-    for task in tasks:
-        task = task.strip()
-        ins = re.search(instruction_text, task).group(1).strip()
-        inp = re.search(input_text, task).group(1).strip()
-        out = re.search(output_text, task).group(1).strip()
+    for fields, text in _split_tasks(data):
+        ins, inp, out = (data[slice(*fields[k])].strip() if k in fields else '' for k in TASK_FIELDS)
+        if not ins or not out:
+            failures.append({'reason': "Missing instruction" if not ins else "Missing output", 'text': text.strip()})
+            continue
 
         if inp:
             if inp.startswith('"'):
@@ -82,24 +163,17 @@ def task_parser(data, prepared_data, prompt_config, row, config, raw_data_id, pr
             if inp == '<noinput>':
                 inp = ''
             else:
-                inp = '\n' + str(inp)
+                inp = '\n' + inp
 
-        if ins and out:
-            if inp in ins:
-                new_data.append((len(prepared_data), f'{st.user} {ins} {st.eos} {st.ai} {out} {st.eos} {st.eod}', raw_data_id))
-            else:
-                new_data.append((len(prepared_data), f'{st.user} {ins}{inp} {st.eos} {st.ai} {out} {st.eos} {st.eod}', raw_data_id))
-    
-    new_data = pd.DataFrame(new_data, columns=['text', 'raw_data_id'])
-    if prepared_data is None:
-        prepared_data = new_data
-    else:
-        prepared_data = pd.concat([prepared_data, new_data], ignore_index=True)
+        if inp in ins:
+            inp = ''
+        new_data.append({'text': f'{st.user} {ins}{inp} {st.eos} {st.ai} {out} {st.eos} {st.eod}', 'raw_data_id': raw_data_id})
 
-    return prepared_data   
+    return new_data
 
 
-def simple_task_parser(data, prepared_data, prompt_config, row, config, raw_data_id, prompt_text):
+simple_task_split = re.compile(r'[1-9 \.]*Task Number[:\s]*[\d\n]*')
+def simple_task_parser(data, prompt_config, config, row, raw_data_id, prompt_text):
     r''' This parser can be used with prompts similar to Alpaca, but that only have Instructions, it expects data :
         Task Number:
         Instruction:
@@ -112,21 +186,13 @@ def simple_task_parser(data, prepared_data, prompt_config, row, config, raw_data
     .
     .
     '''
-    tasks = [x.replace("Instruction:", "").strip() for x in re.split(r'[1-9 \.]*Task Number[:\s]*[\d\n]*', str(data)) if x.strip()]
-    new_data = []
-    for task in tasks:
-        task = task.strip()
-   
-    new_data = pd.DataFrame([[[row['text']], task, raw_data_id] for task in tasks], columns=['text', 'instruction', 'raw_data_id'])
-    if prepared_data is None:
-        prepared_data = new_data
-    else:
-        prepared_data = pd.concat([prepared_data, new_data], ignore_index=True)
+    tasks = [x.replace("Instruction:", "").strip() for x in simple_task_split.split(data) if x.strip()]
 
-    return prepared_data   
+    return [{'text': [row['text']], 'instruction': task, 'raw_data_id': raw_data_id} for task in tasks]
 
 
-def medical_conversation_parser(data, prepared_data, prompt_config, config, row, raw_data_id, prompt_text):
+conversation_markers = re.compile(r'(Patient|AI-Assistant)\s*:')
+def medical_conversation_parser(data, prompt_config, config, row, raw_data_id, prompt_text):
     r''' It expects data to be in form of a conversation, like:
         Patient: <some text>
         AI-Assistant: <some text>
@@ -136,53 +202,28 @@ def medical_conversation_parser(data, prepared_data, prompt_config, config, row,
         .
     The actor names 'Patient' and 'AI-Assistant" have to match exactlty 
     '''
-    conversation = None
-
-    # Merge the extractions into one conversation
-    data = re.split(r'\s*(Patient\s*:|AI-Assistant\s*:)\s*', data)[1:]
-    if len(data) > 0:
-        conversation = ""
-        to_append = None
-
-        ref_col = prompt_config.get('reference_column_to_append', None)
-        if ref_col and ref_col in row and row[ref_col]:
-            # Means we want to append a reference at the end of each Answer
-            to_append = f"\nReferences:\n- {row[ref_col]}"
-
-        actor = None
-        for message in data:
-            message = message.strip()
-            if message in ['Patient:', 'AI-Assistant:', 'Patient', 'AI-Assistant', 'Patient :', 'AI-Assistant :']:
-                actor = message
-            elif actor is not None: #TODO: Make this nicer
-                if actor in ['Patient:', 'Patient :', 'Patient']:
-                    conversation += f'{config.special_tokens.user} {message} {config.special_tokens.eos} '
-                elif actor in ['AI-Assistant:', 'AI-Assistant :', 'AI-Assistant']:
-                    conversation += f'{config.special_tokens.ai} {message}'
-                    if to_append is not None and to_append:
-                        conversation += to_append
-                    conversation += f" {config.special_tokens.eos} "
-        if conversation:
-            conversation = conversation.strip() + f" {config.special_tokens.eod}"
-
-    new_data = pd.DataFrame([[conversation, raw_data_id]], columns=['text', 'raw_data_id'])
-    if prepared_data is None:
-        prepared_data = new_data
-    else:
-        prepared_data = pd.concat([prepared_data, new_data], ignore_index=True)
-
-    return prepared_data
-
-
-def csv_ner_parser(data, prepared_data, prompt_config, config, row, raw_data_id, prompt_text):
+    st = config.special_tokens
+    to_append = _get_reference(prompt_config, row)
+
+    # Every message is the text between two actors, the parts are joined once at the end
+    parts = []
+    markers = list(conversation_markers.finditer(data))
+    for i, m in enumerate(markers):
+        message = data[m.end():markers[i + 1].start() if i + 1 < len(markers) else len(data)].strip()
+        if m.group(1) == 'Patient':
+            parts.append(f'{st.user} {message} {st.eos} ')
+        else:
+            parts.append(f'{st.ai} {message}{to_append} {st.eos} ')
+    if not parts:
+        raise ParseError("No Patient/AI-Assistant messages found")
+
+    return [{'text': ''.join(parts).strip() + f" {st.eod}", 'raw_data_id': raw_data_id}]
+
+
+def csv_ner_parser(data, prompt_config, config, row, raw_data_id, prompt_text, failures=None):
     r''' Expects data in CSV format, using the `;` separator
     '''
-    df = pd.read_csv(StringIO(data), sep=';', engine='python')
-    df['raw_data_id'] = raw_data_id
-
-    if prepared_data is None:
-        prepared_data = df
-    else:
-        prepared_data = pd.concat([prepared_data, df], ignore_index=True)
+    failures = failures if failures is not None else []
+    header, rows = _read_csv(data, failures)
 
-    return prepared_data
\ No newline at end of file
+    return [dict(zip(header, line), raw_data_id=raw_data_id) for line in rows]
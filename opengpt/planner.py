@@ -0,0 +1,177 @@
+r'''
+Planning of the data generation: every work item of a config (prompts x runs x languages x datasets x rows, see
+`get_work_items`) is created up front from the `data_split_by_length.csv` files, the prompt tokens are counted in bulk,
+and everything that was already generated is subtracted. This gives the number of teacher calls, tokens, cost and
+time before anything is sent to the teacher:
+
+    plan = plan_work(config)
+    plan.log(concurrency=8)
+
+Time is estimated from `teacher.seconds_per_request` (if set) or from the overhead of a request plus the expected output
+length (`teacher.expected_output_len`) at `teacher.output_tokens_per_s`, and it is never less than what `rpm`/`tpm`
+allow. With `random_prompt` the prompts are picked with the same seeded generator as in `create_dataset`.
+
+Set `teacher.longest_first` in the config and `create_dataset` sends the longest prompts first, so that a few long
+requests do not keep the run going at the end while all other slots are idle.
+'''
+
+import os
+import heapq
+import logging
+from opengpt.lazy import lazy_import
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
+
+def get_tokenizer(config):
+    r''' The tiktoken encoding of the teacher model, None if tiktoken (or the encoding) is not available.
+    '''
+    try:
+        import tiktoken
+        try:
+            return tiktoken.encoding_for_model(config.teacher.get('model'))
+        except KeyError:
+            return tiktoken.get_encoding('cl100k_base')
+    except Exception:
+        return None
+
+
+def count_prompt_tokens(texts, tokenizer=None):
+    r''' Number of tokens of every text, encoded in one batch. Without a tokenizer it is estimated as characters / 4.
+    '''
+    if tokenizer is None:
+        return np.array([len(text) // 4 for text in texts], dtype=np.int64)
+    return np.array([len(ids) for ids in tokenizer.encode_batch(list(texts), disallowed_special=())], dtype=np.int64)
+
+
+def sort_longest_first(work_items, tokenizer=None):
+    r''' The work items sorted by the number of prompt tokens, longest first (the order is kept for equal lengths).
+    '''
+    ntokens = count_prompt_tokens([work_item['prompt_text'] for work_item in work_items], tokenizer)
+    return [work_items[i] for i in np.argsort(-ntokens, kind='stable')]
+
+
+def simulate_makespan(durations, concurrency):
+    r''' How long it takes to run requests with the given durations (in this order) with `concurrency` slots,
+    every request starts as soon as a slot is free.
+    '''
+    slots = [0.0] * max(1, concurrency)
+    for duration in durations:
+        heapq.heappush(slots, heapq.heappop(slots) + duration)
+    return max(slots)
+
+
+class WorkPlan(object):
+    r''' Everything `create_dataset` would send to the teacher for a config.
+
+    Args:
+        work_items (`List[dict]`):
+            What is left to do, as returned by `get_work_items`.
+        prompt_tokens (`np.ndarray`):
+            Prompt tokens of every work item.
+        ndone (`int`):
+            Number of work items that were already generated.
+        config:
+            The general config, used for the output length, cost and rate limits of the teacher.
+    '''
+    def __init__(self, work_items, prompt_tokens, ndone, config):
+        self.work_items = work_items
+        self.prompt_tokens = prompt_tokens
+        self.ndone = ndone
+        self.config = config
+
+    def __len__(self):
+        return len(self.work_items)
+
+    def durations(self):
+        r''' Estimated seconds for every request.
+        '''
+        teacher = self.config.teacher
+        if teacher.get('seconds_per_request') is not None:
+            return np.full(len(self.work_items), float(teacher.get('seconds_per_request')))
+        return (teacher.get('request_overhead_s', 1.0) + self.prompt_tokens / teacher.get('prompt_tokens_per_s', 5000) +
+                teacher.get('expected_output_len', 512) / teacher.get('output_tokens_per_s', 50))
+
+    def estimate(self, concurrency=None, longest_first=None):
+        r''' Estimated tokens, cost and time.
+
+        Args:
+            concurrency (`int`, optional):
+                Requests in flight, by default `teacher.concurrency`.
+            longest_first (`bool`, optional):
+                Schedule the longest prompts first, by default `teacher.longest_first`.
+
+        Returns:
+            estimate (`dict`)
+        '''
+        teacher = self.config.teacher
+        concurrency = concurrency or teacher.get('concurrency', 1)
+        longest_first = teacher.get('longest_first', False) if longest_first is None else longest_first
+        output_len = teacher.get('expected_output_len', 512)
+        prompt_tokens = int(self.prompt_tokens.sum())
+        output_tokens = output_len * len(self.work_items)
+        durations = self.durations()
+        if longest_first:
+            durations = durations[np.argsort(-self.prompt_tokens, kind='stable')]
+        seconds = simulate_makespan(durations, concurrency)
+        # The rate limits are a lower bound on the time, no matter the concurrency
+        if teacher.get('rpm'):
+            seconds = max(seconds, len(self.work_items) * 60 / teacher.get('rpm'))
+        if teacher.get('tpm'):
+            seconds = max(seconds, (prompt_tokens + output_tokens) * 60 / teacher.get('tpm'))
+        return {
+            'requests': len(self.work_items),
+            'already_done': self.ndone,
+            'prompt_tokens': prompt_tokens,
+            'output_tokens': output_tokens,
+            'max_prompt_tokens': int(self.prompt_tokens.max()) if len(self.prompt_tokens) else 0,
+            'cost': (prompt_tokens * teacher.get('cost_per_1k_prompt_tokens', 0) + output_tokens * teacher.get('cost_per_1k_output_tokens', 0)) / 1000,
+            'concurrency': concurrency,
+            'longest_first': longest_first,
+            'hours': seconds / 3600,
+            }
+
+    def by_group(self):
+        r''' Requests and prompt tokens per dataset, prompt hash and language.
+        '''
+        df = pd.DataFrame({'dataset': [w['dataset_name'] for w in self.work_items], 'prompt_hash': [w['prompt']['hash'] for w in self.work_items],
+                           'language': [w['language'] for w in self.work_items], 'prompt_tokens': self.prompt_tokens})
+        return df.groupby(['dataset', 'prompt_hash', 'language']).agg(requests=('prompt_tokens', 'size'), prompt_tokens=('prompt_tokens', 'sum')).reset_index()
+
+    def log(self, concurrency=None, longest_first=None):
+        estimate = self.estimate(concurrency=concurrency, longest_first=longest_first)
+        logging.warning(f"Work plan for: {self.config.name}\n" + (self.by_group().to_string(index=False) if len(self.work_items) else '') +
+                        f"\n{estimate['requests']} requests left ({estimate['already_done']} already done), {estimate['prompt_tokens']} prompt tokens " +
+                        f"(longest {estimate['max_prompt_tokens']}), ~{estimate['output_tokens']} output tokens, ~${estimate['cost']:.2f}, " +
+                        f"~{estimate['hours']:.2f}h with {estimate['concurrency']} in flight" + (" (longest first)" if estimate['longest_first'] else ''))
+        return estimate
+
+
+def plan_work(config, prompt_db=None, tokenizer=None):
+    r''' Creates the `WorkPlan` for a config, nothing is sent to the teacher and nothing is written.
+
+    Args:
+        prompt_db (`PromptStore`, optional):
+            By default loaded from `config.path.prompt_db`.
+        tokenizer (optional):
+            Anything with `encode_batch` (tiktoken), by default the encoding of the teacher model.
+
+    Returns:
+        plan (`WorkPlan`)
+    '''
+    from opengpt.dataset_utils import get_work_items, get_output_paths, get_prompt_rng
+    from opengpt.prompt_utils import PromptStore
+
+    prompt_db = prompt_db if prompt_db is not None else PromptStore.load(config.path.prompt_db)
+    paths = get_output_paths(config)
+    done_hashes = set()
+    # Same as in `create_dataset`, the raw data is used only if the prepared data is there too
+    if os.path.exists(paths['raw']) and os.path.exists(paths['prepared']):
+        done_hashes = set(pd.read_csv(paths['raw'], usecols=['prompt_text_hash'])['prompt_text_hash'])
+
+    # The same prompts as in `create_dataset` are picked with `random_prompt`
+    work_items = list(get_work_items(config, prompt_db, rng=get_prompt_rng(config)))
+    left = [work_item for work_item in work_items if work_item['prompt_text_hash'] not in done_hashes]
+    tokenizer = tokenizer if tokenizer is not None else get_tokenizer(config)
+    return WorkPlan(left, count_prompt_tokens([w['prompt_text'] for w in left], tokenizer), len(work_items) - len(left), config)
@@ -1,37 +1,185 @@
 import json
 import hashlib
 import os
+import string
 import logging
+import threading
+from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError: # Windows
+    fcntl = None
+
+# Fields that are always available when a prompt is formatted in `create_dataset`
+DEFAULT_FIELDS = ('context', 'language')
+
+
+def get_prompt_hash(text):
+    # Good enough for what we need
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:10]
+
+
+def get_template_fields(text):
+    r''' Names of the fields in a prompt template (e.g. {'context', 'language'}), raises a ValueError if the
+    template is broken or uses positional/attribute fields.
+    '''
+    fields = set()
+    for _, name, _, _ in string.Formatter().parse(text):
+        if name is None:
+            continue
+        if not name.isidentifier():
+            raise ValueError(f"Only named fields like {{context}} can be used in prompts, found: {{{name}}}")
+        fields.add(name)
+    return fields
+
+
+class PromptStore(object):
+    r''' The prompt database (a json file with a list of prompts) indexed by the prompt hash. Templates are parsed once
+    when the store is loaded, so that missing fields can be found before anything is sent to the teacher.
+
+    Use `PromptStore.load(path)` to get the store, it is cached per process and reloaded only if the file changes.
+    Writes are atomic (a temporary file is renamed over the database) and done under a file lock, so more than one
+    process can add prompts at the same time.
+
+    Args:
+        path (`str`, optional):
+            Path to the json database.
+        prompts (`List[dict]`, optional):
+            Use these prompts instead of loading them from `path`.
+    '''
+    _cache = {}
+    _cache_lock = threading.Lock()
+
+    def __init__(self, path=None, prompts=None):
+        self.path = path
+        self._stamp = None
+        if prompts is None:
+            prompts = []
+            if path is not None and os.path.exists(path):
+                logging.info(f"Loading db from: {path}")
+                self._stamp = self._file_stamp()
+                prompts = json.load(open(path, 'r'))
+        self._set_prompts(prompts)
+
+    @classmethod
+    def load(cls, path):
+        r''' The store for `path`, reused between calls in the same process as long as the file does not change.
+        '''
+        key = os.path.abspath(path)
+        with cls._cache_lock:
+            store = cls._cache.get(key)
+            if store is None or store._stamp != store._file_stamp():
+                store = cls(path)
+                cls._cache[key] = store
+        return store
+
+    def _file_stamp(self):
+        if self.path is None or not os.path.exists(self.path):
+            return None
+        stat = os.stat(self.path)
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def _set_prompts(self, prompts):
+        self.prompts = list(prompts)
+        self.by_hash = {prompt['hash']: prompt for prompt in self.prompts}
+        self.positions = {prompt['hash']: i for i, prompt in enumerate(self.prompts)}
+        self.fields = {}
+        for prompt in self.prompts:
+            try:
+                self.fields[prompt['hash']] = get_template_fields(prompt['text'])
+            except ValueError as e:
+                logging.warning(f"The prompt: {prompt['hash']} is not a valid template: {e}")
+
+    def __len__(self):
+        return len(self.prompts)
+
+    def __iter__(self):
+        return iter(self.prompts)
+
+    def __contains__(self, h):
+        return h in self.by_hash
+
+    def __getitem__(self, h):
+        return self.by_hash[h]
+
+    def get(self, h, default=None):
+        return self.by_hash.get(h, default)
+
+    def get_prompts(self, hashes):
+        r''' The prompts with the given hashes, in the order of the database.
+        '''
+        return [self.by_hash[h] for h in sorted(set(hashes), key=lambda h: self.positions.get(h, -1)) if h in self.by_hash]
+
+    def validate(self, h, available_fields=DEFAULT_FIELDS):
+        r''' Raises a ValueError if the template of prompt `h` is broken or needs fields that are not in `available_fields`.
+        '''
+        if h not in self.fields:
+            raise ValueError(f"The prompt: {h} is not in the database or is not a valid template")
+        missing = self.fields[h] - set(available_fields)
+        if missing:
+            raise ValueError(f"The prompt: {h} needs the fields: {sorted(missing)}, but only {sorted(available_fields)} are available")
+
+    @contextmanager
+    def _locked(self):
+        r''' Exclusive lock on the database file, the prompts are reloaded if someone else changed the file.
+        '''
+        lock_file = open(self.path + '.lock', 'w')
+        try:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            if self._stamp != self._file_stamp():
+                self._stamp = self._file_stamp()
+                self._set_prompts(json.load(open(self.path, 'r')) if self._stamp is not None else [])
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+            lock_file.close()
+
+    def _write(self):
+        tmp_path = f'{self.path}.tmp{os.getpid()}'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.prompts, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self._stamp = self._file_stamp()
+
+    def add_many(self, prompts, force_replace=False):
+        r''' Adds prompts (dicts with text, description and parser) with one write to disk.
+
+        Returns:
+            hashes (`List[str]`):
+                Hashes of the prompts that were added.
+        '''
+        added = []
+        with self._locked():
+            prompts_by_hash = dict(self.by_hash)
+            for prompt in prompts:
+                h = get_prompt_hash(prompt['text'])
+                get_template_fields(prompt['text'])
+                if h in prompts_by_hash and not force_replace:
+                    logging.warning(f"The prompt: {h} is already in the database. It will not be added, you can use force_replace if you really want to add it.")
+                    continue
+                if h in prompts_by_hash:
+                    logging.warning("Found an existing prompt with the same hash, it will be replaced with the new one.")
+                    # The replaced prompt goes to the end, as before
+                    del prompts_by_hash[h]
+                prompts_by_hash[h] = {'hash': h, 'text': prompt['text'], 'description': prompt['description'], 'parser': prompt['parser']}
+                added.append(h)
+            if added:
+                self._set_prompts(prompts_by_hash.values())
+                self._write()
+                logging.warning(f"Added prompts: {added}")
+        return added
+
+    def add(self, text, description, parser, force_replace=False):
+        return self.add_many([{'text': text, 'description': description, 'parser': parser}], force_replace=force_replace)
+
 
 def add_to_prompt_database(text, description, parser, database_path, force_replace=False):
-    r''' The database is a simple json file where all the prompts are saved.
+    r''' The database is a simple json file where all the prompts are saved, see `PromptStore`.
     '''
-    if os.path.exists(database_path):
-        logging.info(f"Loading db from: {database_path}")
-        db = json.load(open(database_path, 'r'))
-        hashes = set([prompt['hash'] for prompt in db])
-    else:
-        db = []
-        hashes = set()
-
-    # Good enough for what we need 
-    h = hashlib.sha256(text.encode("utf-8")).hexdigest()[:10]
-    if force_replace and h in hashes:
-        logging.warning("Found an existing prompt with the same hash, it will be replaced with the new one.")
-        # Remove the prompt with the hash as the current one
-        db = [prompt for prompt in db if prompt['hash'] != h]
-        hashes = set([prompt['hash'] for prompt in db])
-    if h not in hashes:
-        db.append({
-                  'hash': h,
-                  'text': text,
-                  'description': description,
-                  'parser': parser
-                  })
-        
-        json.dump(db, open(database_path, 'w'), indent=2)
-        logging.warning(f"Added prompt: {h}")
-    else:
-        logging.warning("The prompt is already in the database. It will not be added, you can use force_replace if you really want to add it.")
-
-    return db
\ No newline at end of file
+    store = PromptStore.load(database_path)
+    store.add(text, description, parser, force_replace=force_replace)
+    return store.prompts
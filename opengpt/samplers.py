@@ -0,0 +1,114 @@
+r'''
+Samplers that group examples of similar length, so that less compute is spent on padding when training
+without packing (packing_type: 'none'). Both work with the `DataCollatorWithPadding`, e.g.:
+
+    lengths = [len(x) for x in train_dataset['input_ids']]
+    batch_sampler = TokenBudgetBatchSampler(lengths, max_tokens=16384)
+    loader = DataLoader(train_dataset, batch_sampler=batch_sampler, collate_fn=dc)
+'''
+
+import torch
+import numpy as np
+
+
+class LengthGroupedSampler(torch.utils.data.Sampler):
+    r''' Shuffles the examples, splits them into mega-batches of `batch_size * mega_batch_mult` examples and sorts every
+    mega-batch by length. Consecutive `batch_size` indices will have similar lengths, while the order is still random.
+
+    Args:
+        lengths (`List[int]`):
+            Length of every example (number of tokens).
+        batch_size (`int`):
+            The batch size used with the sampler.
+        mega_batch_mult (`int`):
+            How many batches are sorted together, bigger means less padding but less randomness.
+        seed (`int`):
+            The order depends only on the seed and the epoch (see `set_epoch`).
+    '''
+    def __init__(self, lengths, batch_size, mega_batch_mult=50, seed=11):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.mega_batch_mult = mega_batch_mult
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __iter__(self):
+        rng = np.random.default_rng(self.seed + self.epoch)
+        indices = rng.permutation(len(self.lengths))
+        mega_batch_size = self.batch_size * self.mega_batch_mult
+        for i in range(0, len(indices), mega_batch_size):
+            mega_batch = indices[i:i + mega_batch_size]
+            # Longest first, so that an OOM shows up in the first steps
+            yield from mega_batch[np.argsort(-self.lengths[mega_batch], kind='stable')].tolist()
+
+
+class TokenBudgetBatchSampler(torch.utils.data.Sampler):
+    r''' Yields batches (lists of indices) whose padded size `len(batch) * max_len_in_batch` is at most `max_tokens`, so
+    batches of short examples have more examples than batches of long ones. The examples are shuffled and sorted by length
+    in buckets of `bucket_size` examples, and the batches are shuffled at the end.
+
+    Args:
+        lengths (`List[int]`):
+            Length of every example (number of tokens), examples longer than `max_seq_len` count as `max_seq_len`.
+        max_tokens (`int`):
+            Token budget for one batch (including padding).
+        max_seq_len (`int`, optional):
+            Should match the collator.
+        pad_to_multiple_of (`int`, optional):
+            Should match the collator, lengths are rounded up to this when computing the budget.
+        bucket_size (`int`):
+            How many examples are sorted together.
+        seed (`int`):
+            The order depends only on the seed and the epoch (see `set_epoch`).
+    '''
+    def __init__(self, lengths, max_tokens, max_seq_len=None, pad_to_multiple_of=None, bucket_size=10000, seed=11):
+        lengths = np.asarray(lengths)
+        if max_seq_len is not None:
+            lengths = np.minimum(lengths, max_seq_len)
+        if pad_to_multiple_of:
+            lengths = -(-lengths // pad_to_multiple_of) * pad_to_multiple_of
+        assert lengths.max(initial=0) <= max_tokens, "max_tokens has to be at least as big as the longest example"
+        self.lengths = lengths
+        self.max_tokens = max_tokens
+        self.bucket_size = bucket_size
+        self.seed = seed
+        self.epoch = 0
+        self._len = None
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _batches(self):
+        rng = np.random.default_rng(self.seed + self.epoch)
+        indices = rng.permutation(len(self.lengths))
+        batches = []
+        for i in range(0, len(indices), self.bucket_size):
+            bucket = indices[i:i + self.bucket_size]
+            bucket = bucket[np.argsort(self.lengths[bucket], kind='stable')]
+            batch = []
+            max_len = 0
+            for ind in bucket.tolist():
+                new_max_len = max(max_len, self.lengths[ind])
+                if batch and new_max_len * (len(batch) + 1) > self.max_tokens:
+                    batches.append(batch)
+                    batch = []
+                    new_max_len = self.lengths[ind]
+                batch.append(ind)
+                max_len = new_max_len
+            if batch:
+                batches.append(batch)
+        return [batches[i] for i in rng.permutation(len(batches))]
+
+    def __len__(self):
+        if self._len is None:
+            self._len = len(self._batches())
+        return self._len
+
+    def __iter__(self):
+        yield from self._batches()
@@ -0,0 +1,271 @@
+r'''
+Sharded generation, so that `create_dataset` can run on many machines (or processes) at the same time. Work items are
+split into `num_shards` shards by their prompt_text_hash (the same split on every machine), every shard has its own
+raw/prepared/failure files in `<base_path>/<name>/shards/`. Workers claim shards with lease files; a lease has to be
+renewed while the shard is generated (from a heartbeat thread, so long teacher calls or batch jobs do not let it expire),
+so if a worker crashes its shard is taken over by another worker once the lease
+expires (and continues where the crashed worker stopped). When all shards are done `merge_shards` creates the usual
+raw and prepared datasets.
+
+On every machine (the base_path has to be on a shared file system, and the clocks roughly in sync):
+
+    run_shard_worker(config, num_shards=16)
+
+and once all workers are done:
+
+    merge_shards(config, num_shards=16)
+'''
+
+import os
+import json
+import time
+import uuid
+import socket
+import logging
+import threading
+from opengpt.lazy import lazy_import
+from opengpt.dataset_utils import create_dataset, get_output_paths
+
+pd = lazy_import('pandas')
+
+
+class ShardLeaseLost(Exception):
+    r''' Another worker took over the shard.
+    '''
+
+
+class ShardLease(object):
+    r''' A lease on one shard, kept in a small json file with the owner and the expiry time.
+
+    Args:
+        path (`str`):
+            Path to the lease file.
+        worker_id (`str`):
+            Unique ID of the worker.
+        timeout (`float`):
+            Seconds after which a lease that was not renewed is considered dead.
+    '''
+    def __init__(self, path, worker_id, timeout=600, clock=time.time):
+        self.path = path
+        self.worker_id = worker_id
+        self.timeout = timeout
+        self.clock = clock
+        self._last_renewal = None
+        self._lock = threading.Lock()
+        self._heartbeat = None
+        self._stop = threading.Event()
+        self.lost = None # The `ShardLeaseLost` seen by the heartbeat
+
+    def _read(self):
+        try:
+            return json.load(open(self.path))
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _write(self):
+        tmp_path = f'{self.path}.{self.worker_id}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'worker': self.worker_id, 'expires': self.clock() + self.timeout}, f)
+        os.replace(tmp_path, self.path)
+        self._last_renewal = self.clock()
+
+    def acquire(self):
+        r''' Returns True if the lease was acquired, either because it did not exist or because it expired.
+        '''
+        try:
+            fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            os.close(fd)
+            self._write()
+            return True
+        except FileExistsError:
+            pass
+
+        lease = self._read()
+        if lease is not None and lease['expires'] > self.clock():
+            return False
+        if lease is None and self.clock() - os.path.getmtime(self.path) < self.timeout:
+            # Someone is just writing it
+            return False
+        logging.warning(f"Taking over the expired lease: {self.path} from worker: {lease['worker'] if lease else None}")
+        self._write()
+        # If more workers took over at the same time, the last write wins
+        time.sleep(0.1)
+        lease = self._read()
+        return lease is not None and lease['worker'] == self.worker_id
+
+    def renew(self, force=False):
+        r''' Extends the lease, called often but writes only every timeout/4 seconds. Raises `ShardLeaseLost` if
+        the lease belongs to someone else.
+        '''
+        if self.lost is not None:
+            raise self.lost
+        with self._lock:
+            if not force and self._last_renewal is not None and self.clock() - self._last_renewal < self.timeout / 4:
+                return
+            self._check()
+            self._write()
+
+    def _check(self):
+        lease = self._read()
+        if lease is None or lease['worker'] != self.worker_id:
+            self.lost = ShardLeaseLost(f"The lease: {self.path} is owned by: {lease['worker'] if lease else None}")
+            raise self.lost
+
+    def check(self):
+        r''' Raises `ShardLeaseLost` if the lease is not ours anymore, call it before writing anything for the shard.
+        '''
+        if self.lost is not None:
+            raise self.lost
+        with self._lock:
+            self._check()
+
+    def start_heartbeat(self):
+        r''' Renews the lease every timeout/4 seconds from a background thread, until `stop_heartbeat`. If the lease is
+        lost the thread stops and the next `renew`/`check` raises.
+        '''
+        def _beat():
+            while not self._stop.wait(self.timeout / 4):
+                try:
+                    self.renew(force=True)
+                except ShardLeaseLost as e:
+                    logging.warning(f"Lost the lease: {self.path}, {e}")
+                    return
+                except OSError as e:
+                    # E.g. a hiccup of the shared file system, try again on the next beat
+                    logging.warning(f"Could not renew the lease: {self.path}, {e}")
+        self._stop.clear()
+        self._heartbeat = threading.Thread(target=_beat, daemon=True)
+        self._heartbeat.start()
+
+    def stop_heartbeat(self):
+        if self._heartbeat is not None:
+            self._stop.set()
+            self._heartbeat.join()
+            self._heartbeat = None
+
+    def release(self):
+        lease = self._read()
+        if lease is not None and lease['worker'] == self.worker_id:
+            os.remove(self.path)
+
+
+def get_shard_dir(config):
+    return os.path.join(config.base_path, config.name, 'shards')
+
+
+def _done_path(config, shard):
+    return os.path.join(get_shard_dir(config), f'shard{shard}.done')
+
+
+def run_shard_worker(config, num_shards, teacher=None, worker_id=None, lease_timeout=600, wait=True, poll_interval=30):
+    r''' Claims and generates shards until all of them are done.
+
+    Args:
+        config:
+            The general config.
+        num_shards (`int`):
+            Number of shards, has to be the same for all workers.
+        teacher (`Callable`, optional):
+            Passed to `create_dataset`.
+        worker_id (`str`, optional):
+            Unique ID of this worker, by default hostname + pid + random.
+        lease_timeout (`float`):
+            Seconds without a renewal after which the shard of a worker is taken over by another one.
+        wait (`bool`):
+            If all shards that are left are leased by other workers, wait for them to finish (or to die) instead of returning.
+        poll_interval (`float`):
+            Seconds between checks when waiting.
+
+    Returns:
+        shards (`List[int]`):
+            The shards completed by this worker.
+    '''
+    worker_id = worker_id or f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}'
+    os.makedirs(get_shard_dir(config), exist_ok=True)
+    completed = []
+    while True:
+        pending = [shard for shard in range(num_shards) if not os.path.exists(_done_path(config, shard))]
+        if not pending:
+            break
+
+        claimed = False
+        for shard in pending:
+            lease = ShardLease(os.path.join(get_shard_dir(config), f'shard{shard}.lease'), worker_id, timeout=lease_timeout)
+            # The shard could have been finished since we checked
+            if os.path.exists(_done_path(config, shard)) or not lease.acquire():
+                continue
+            claimed = True
+            logging.warning(f"Worker: {worker_id} is generating shard: {shard}/{num_shards}")
+            lease.start_heartbeat()
+            try:
+                create_dataset(config, teacher=teacher, shard=shard, num_shards=num_shards, lease=lease)
+                lease.renew(force=True)
+                open(_done_path(config, shard), 'w').close()
+                completed.append(shard)
+            except ShardLeaseLost as e:
+                logging.warning(f"Stopped shard: {shard}, {e}")
+            finally:
+                lease.stop_heartbeat()
+                lease.release()
+
+        if not claimed:
+            if not wait:
+                break
+            time.sleep(poll_interval)
+    return completed
+
+
+def merge_shards(config, num_shards, force=False):
+    r''' Merges the shards into the raw and prepared datasets of the project (`raw_generated_data_for_<name>.csv`, ...).
+    Rows that are already in the merged datasets are not added again, so this can be run more than once. The IDs of the
+    new raw rows continue from the merged raw data and `raw_data_id` in the prepared data is updated accordingly.
+
+    Args:
+        force (`bool`):
+            Merge even if some shards are not done.
+
+    Returns:
+        raw_data, prepared_data (`pd.DataFrame`):
+            The merged datasets.
+    '''
+    not_done = [shard for shard in range(num_shards) if not os.path.exists(_done_path(config, shard))]
+    if not_done and not force:
+        raise ValueError(f"The shards: {not_done} are not done, use force=True to merge anyway")
+
+    paths = get_output_paths(config)
+    raw_data, prepared_data, failures = [], [], []
+    for path, out in ((paths['raw'], raw_data), (paths['prepared'], prepared_data), (paths['failures'], failures)):
+        if os.path.exists(path):
+            out.append(pd.read_csv(path))
+    done_hashes = set(raw_data[0]['prompt_text_hash']) if raw_data else set()
+    next_id = len(raw_data[0]) if raw_data else 0
+
+    for shard in range(num_shards):
+        shard_paths = get_output_paths(config, shard)
+        if not os.path.exists(shard_paths['raw']):
+            continue
+        shard_raw = pd.read_csv(shard_paths['raw'])
+        shard_raw = shard_raw[~shard_raw['prompt_text_hash'].isin(done_hashes)]
+        new_ids = dict(zip(shard_raw['id'], range(next_id, next_id + len(shard_raw))))
+        next_id += len(shard_raw)
+        done_hashes.update(shard_raw['prompt_text_hash'])
+        raw_data.append(shard_raw.assign(id=shard_raw['id'].map(new_ids)))
+
+        if os.path.exists(shard_paths['prepared']) and os.path.getsize(shard_paths['prepared']) > 0:
+            shard_prepared = pd.read_csv(shard_paths['prepared'])
+            shard_prepared = shard_prepared[shard_prepared['raw_data_id'].isin(list(new_ids))]
+            prepared_data.append(shard_prepared.assign(raw_data_id=shard_prepared['raw_data_id'].map(new_ids)))
+        if os.path.exists(shard_paths['failures']):
+            failures.append(pd.read_csv(shard_paths['failures']))
+
+    raw_data = pd.concat(raw_data, ignore_index=True) if raw_data else pd.DataFrame()
+    prepared_data = pd.concat(prepared_data, ignore_index=True) if prepared_data else pd.DataFrame()
+    # Both written next to the final files first, so the merged datasets are never half written
+    for df, path in ((raw_data, paths['raw']), (prepared_data, paths['prepared'])):
+        df.to_csv(path + '.tmp', index=False)
+    os.replace(paths['prepared'] + '.tmp', paths['prepared'])
+    os.replace(paths['raw'] + '.tmp', paths['raw'])
+    if failures:
+        pd.concat(failures, ignore_index=True).drop_duplicates().to_csv(paths['failures'], index=False)
+    logging.warning(f"Merged {num_shards} shards, there are {len(raw_data)} raw and {len(prepared_data)} prepared rows in: {paths['raw']}")
+    return raw_data, prepared_data
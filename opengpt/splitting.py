@@ -0,0 +1,97 @@
+r'''
+Token aware splitting of long texts. The texts are tokenized once, the chunks are cut at paragraph/sentence boundaries
+(when possible) under the token budget and the chunk text is sliced from the original string using character offsets,
+so nothing is ever cut in the middle of a word or a multi-byte character and no decoding is needed.
+'''
+
+import re
+from opengpt.lazy import lazy_import
+
+np = lazy_import('numpy')
+
+paragraph_boundary = re.compile(r'\n\s*\n')
+sentence_boundary = re.compile(r'(?<=[.!?])\s+|\n')
+
+
+def get_token_offsets(tokenizer, texts):
+    r''' Tokenizes the texts and returns for every text (tokens, starts), where starts[i] is the character offset
+    at which the i-th token starts. Works with tiktoken and HF fast tokenizers (offset mapping).
+    '''
+    if hasattr(tokenizer, 'encode_batch'):
+        out = []
+        for text, tokens in zip(texts, tokenizer.encode_batch(texts)):
+            token_bytes = tokenizer.decode_tokens_bytes(tokens)
+            byte_starts = np.cumsum([0] + [len(b) for b in token_bytes[:-1]]) if tokens else np.zeros(0, dtype=np.int64)
+            if text.isascii():
+                starts = byte_starts.tolist()
+            else:
+                # A token can start in the middle of a multi-byte character, in that case the
+                # character belongs to the previous token (we snap to the next character boundary)
+                char_lens = np.array([len(c.encode('utf-8')) for c in text], dtype=np.int64)
+                char_byte_starts = np.concatenate([[0], np.cumsum(char_lens)])
+                starts = np.searchsorted(char_byte_starts, byte_starts, side='left').tolist()
+            out.append((tokens, starts))
+        return out
+    else:
+        encoded = tokenizer(texts, return_offsets_mapping=True, add_special_tokens=False)
+        return [(tokens, [s for s, _ in offsets]) for tokens, offsets in zip(encoded['input_ids'], encoded['offset_mapping'])]
+
+
+def split_text_by_max_len(text, tokens, starts, max_len, overlap=0, sentence_boundaries=True, min_fill=0.5):
+    r''' Splits one text into chunks of at most `max_len` tokens.
+
+    Args:
+        text (`str`):
+            The original text.
+        tokens, starts:
+            Output of `get_token_offsets` for this text.
+        max_len (`int`):
+            Max number of tokens per chunk.
+        overlap (`int`):
+            How many tokens from the end of a chunk are repeated at the start of the next one.
+        sentence_boundaries (`bool`):
+            Cut at the last paragraph (or sentence) boundary that fits into the budget, instead of exactly at `max_len`.
+        min_fill (`float`):
+            A boundary is only used if the chunk is at least `min_fill * max_len` tokens long, otherwise we cut at `max_len`.
+
+    Returns:
+        chunks (`List[Tuple[str, int]]`):
+            The text and the number of tokens for every chunk.
+    '''
+    assert 0 <= overlap < max_len, "The overlap has to be smaller than max_len"
+    ntokens = len(tokens)
+    def char_at(t):
+        return starts[t] if t < ntokens else len(text)
+
+    paragraphs = sentences = set()
+    if sentence_boundaries and ntokens > max_len:
+        paragraphs = set(m.start() for m in paragraph_boundary.finditer(text)) | set(m.end() for m in paragraph_boundary.finditer(text))
+        sentences = set(m.start() for m in sentence_boundary.finditer(text)) | set(m.end() for m in sentence_boundary.finditer(text))
+
+    chunks = []
+    start = 0
+    while start < ntokens:
+        cut = min(start + max_len, ntokens)
+        if cut < ntokens and sentence_boundaries:
+            lowest = start + max(1, int(max_len * min_fill))
+            for boundaries in (paragraphs, sentences):
+                found = next((t for t in range(cut, lowest - 1, -1) if char_at(t) in boundaries), None)
+                if found is not None:
+                    cut = found
+                    break
+        chunks.append((text[char_at(start):char_at(cut)], cut - start))
+        if cut >= ntokens:
+            break
+        start = cut - overlap if cut - overlap > start else cut
+    return chunks
+
+
+def token_length_histogram(lengths, max_len, nbins=10):
+    r''' Histogram of tokens per chunk, used to tune `teacher.max_len`.
+
+    Returns:
+        histogram (`List[Tuple[int, int, int]]`):
+            (bin_start, bin_end, count) for every bin.
+    '''
+    counts, edges = np.histogram(lengths, bins=nbins, range=(0, max_len))
+    return [(int(edges[i]), int(edges[i + 1]), int(counts[i])) for i in range(len(counts))]
@@ -0,0 +1,128 @@
+import sqlite3
+import hashlib
+import json
+import os
+import time
+import threading
+import logging
+
+
+class TeacherCache(object):
+    r''' Content-addressed on-disk cache of teacher responses, it can be shared by all projects (it is keyed by what was
+    sent to the teacher, not by the project). When the cache gets bigger than `max_size` bytes the least recently used
+    responses are removed. The total size is kept in the database and updated in the same transaction as the
+    responses, so that more processes sharing the cache evict based on the real total.
+
+    Args:
+        path (`str`):
+            Path to the sqlite file.
+        max_size (`int`):
+            Max size of all cached responses in bytes.
+    '''
+    def __init__(self, path, max_size=10 * 2**30):
+        self.path = path
+        self.max_size = max_size
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, timeout=60)
+        self.db.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT, size INTEGER, last_access REAL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS last_access_index ON responses (last_access)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS totals (name TEXT PRIMARY KEY, value INTEGER)")
+        self.db.commit()
+        self.db.execute("BEGIN IMMEDIATE")
+        # Caches from before the totals table have only the responses
+        self.db.execute("INSERT OR IGNORE INTO totals SELECT 'size', COALESCE(SUM(size), 0) FROM responses")
+        self.db.commit()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    @classmethod
+    def from_config(cls, config):
+        r''' Uses `teacher.cache_path` and `teacher.cache_max_size_gb` from the config, returns None if there is no cache_path.
+        '''
+        if not config.teacher.get('cache_path'):
+            return None
+        return cls(config.teacher.cache_path, max_size=int(config.teacher.get('cache_max_size_gb', 10) * 2**30))
+
+    @staticmethod
+    def get_key(config, prompt_text, run=0):
+        r''' Everything that changes the output of the teacher: the teacher, model, sampling parameters, prompt and the run.
+        '''
+        key = {
+            'teacher': config.teacher.name,
+            'model': config.teacher.get('model'),
+            'sampling_params': {k: config.teacher[k] for k in sorted(config.teacher.keys()) if k in ('temperature', 'top_p', 'max_tokens')},
+            'prompt': prompt_text,
+            'run': run,
+            }
+        return hashlib.sha256(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+
+    @property
+    def size(self):
+        r''' Size of all cached responses in bytes (of all processes using the cache).
+        '''
+        with self._lock:
+            return self._size()
+
+    def _size(self):
+        return self.db.execute("SELECT value FROM totals WHERE name = 'size'").fetchone()[0]
+
+    def _add_size(self, delta):
+        self.db.execute("UPDATE totals SET value = value + ? WHERE name = 'size'", (delta,))
+
+    def get(self, key):
+        r''' Returns the cached response or None.
+        '''
+        with self._lock:
+            row = self.db.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.stats['misses'] += 1
+                return None
+            self.stats['hits'] += 1
+            self.db.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+            self.db.commit()
+            return row[0]
+
+    def put(self, key, response):
+        if response is None:
+            return
+        size = len(response.encode('utf-8'))
+        with self._lock:
+            # Takes the write lock up front, the total can not change under us until the commit
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                old = self.db.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+                self.db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)", (key, response, size, time.time()))
+                self._add_size(size - (old[0] if old else 0))
+                self._evict()
+                self.db.commit()
+            except BaseException:
+                self.db.rollback()
+                raise
+
+    def _evict(self):
+        total = self._size()
+        while total > self.max_size:
+            rows = self.db.execute("SELECT key, size FROM responses ORDER BY last_access LIMIT 100").fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                if total <= self.max_size:
+                    break
+                self.db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._add_size(-size)
+                total -= size
+                self.stats['evictions'] += 1
+
+    def __len__(self):
+        with self._lock:
+            return self.db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def log_stats(self):
+        total = self.stats['hits'] + self.stats['misses']
+        logging.warning(f"Teacher cache: {self.stats}, hit rate: {self.stats['hits'] / max(total, 1):.2%}, size: {self.size / 2**20:.1f}MB")
+
+    def close(self):
+        with self._lock:
+            self.db.commit()
+            self.db.close()
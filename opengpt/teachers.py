@@ -1,4 +1,35 @@
-import openai
+import random
+import time
+import queue
+import threading
+import logging
+from concurrent.futures import Future
+from opengpt.lazy import lazy_import
+
+openai = lazy_import('openai')
+
+TEACHERS = {}
+def register_teacher(name):
+    r''' Decorator that adds a teacher factory to the registry, `factory(config)` has to return the teacher: a callable
+    `teacher(prompt, config)` that returns the generated text (or None if the generation did not finish).
+    '''
+    def decorator(factory):
+        TEACHERS[name] = factory
+        return factory
+    return decorator
+
+
+def get_teacher(config):
+    r''' The teacher for `config.teacher.name`, either from the registry or (for backward compatibility)
+    the `ask_<name>` function from this module.
+    '''
+    name = config.teacher.name
+    if name in TEACHERS:
+        return TEACHERS[name](config)
+    if f'ask_{name}' in globals():
+        return globals()[f'ask_{name}']
+    raise ValueError(f"Unknown teacher: {name}, available teachers are: {list(TEACHERS.keys())}")
+
 
 def ask_openai(prompt, config):
     response = openai.ChatCompletion.create(
@@ -12,4 +43,350 @@ def ask_openai(prompt, config):
     if response['choices'][0]['finish_reason'] == 'stop':
         message = response['choices'][0]['message']['content']
 
-    return message
\ No newline at end of file
+    return message
+register_teacher('openai')(lambda config: ask_openai)
+
+
+def _openai_errors(*names):
+    r''' The exception classes with these names from `openai.error` (openai<1) or `openai` (openai>=1), empty if openai
+    is not installed, then only the status code of the error is used.
+    '''
+    try:
+        modules = [getattr(openai, 'error', None), openai]
+    except ImportError:
+        return ()
+    classes = (getattr(module, name, None) for module in modules for name in names)
+    # E.g. openai.Timeout in openai>=1 is the httpx timeout config, not an exception
+    return tuple(cls for cls in classes if isinstance(cls, type) and issubclass(cls, BaseException))
+
+
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+def is_retryable(e):
+    r''' Should the request that raised `e` be retried (rate limits, timeouts, overloaded servers).
+    '''
+    # APITimeoutError and APIConnectionError are from openai>=1, they have no status code
+    if isinstance(e, _openai_errors('RateLimitError', 'Timeout', 'APIConnectionError', 'APITimeoutError',
+                                    'ServiceUnavailableError', 'TryAgain')):
+        return True
+    if isinstance(e, TimeoutError):
+        return True
+    return getattr(e, 'http_status', getattr(e, 'status_code', None)) in RETRYABLE_STATUS_CODES
+
+
+def is_throttle(e):
+    return isinstance(e, _openai_errors('RateLimitError')) or getattr(e, 'http_status', getattr(e, 'status_code', None)) == 429
+
+
+class TeacherScheduler(object):
+    r''' Wraps a teacher so that it stays inside a requests-per-minute and tokens-per-minute budget, failed requests
+    are retried with jittered exponential backoff. It is thread safe, so it can be used with `teacher.concurrency` > 1.
+
+    When the teacher throttles us (429) the allowed rate is halved, and it slowly recovers with every successful request.
+
+    Args:
+        teacher (`Callable`):
+            Function with the signature `teacher(prompt, config)`.
+        rpm (`int`, optional):
+            Requests per minute, None means no limit.
+        tpm (`int`, optional):
+            Tokens per minute, None means no limit. Tokens are estimated from the prompt using `tokenizer`.
+        tokenizer (optional):
+            Anything with an `encode` method, should be the same one used with `split_csv_by_max_len`.
+        expected_output_len (`int`):
+            How many tokens we expect the teacher to output, added to the prompt length when budgeting tokens.
+        max_retries (`int`):
+            How many times to retry one prompt before giving up (the exception is then raised).
+        base_delay, max_delay (`float`):
+            Backoff parameters in seconds.
+    '''
+    def __init__(self, teacher, rpm=None, tpm=None, tokenizer=None, expected_output_len=0, max_retries=5,
+                 base_delay=1, max_delay=60, clock=time.monotonic, sleep=time.sleep):
+        self.teacher = teacher
+        self.rpm = rpm
+        self.tpm = tpm
+        self.tokenizer = tokenizer
+        self.expected_output_len = expected_output_len
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.clock = clock
+        self.sleep = sleep
+
+        self._lock = threading.Lock()
+        self._rate_factor = 1.0
+        self._last_refill = clock()
+        self._start = self._last_refill
+        # Start with full buckets
+        self._requests_available = rpm
+        self._tokens_available = tpm
+        self.counters = {'requests': 0, 'successes': 0, 'failures': 0, 'throttles': 0, 'retries': 0, 'tokens': 0}
+
+    @classmethod
+    def from_config(cls, teacher, config):
+        r''' Wrap the teacher using `rpm`, `tpm`, `max_retries` and `expected_output_len` from `config.teacher`,
+        if none of them are set the teacher is returned as is.
+        '''
+        if not any(config.teacher.get(k) is not None for k in ('rpm', 'tpm', 'max_retries')):
+            return teacher
+
+        tokenizer = None
+        if config.teacher.get('tpm') is not None:
+            import tiktoken
+            try:
+                tokenizer = tiktoken.encoding_for_model(config.teacher.model)
+            except KeyError:
+                tokenizer = tiktoken.get_encoding('cl100k_base')
+        return cls(teacher, rpm=config.teacher.get('rpm'), tpm=config.teacher.get('tpm'), tokenizer=tokenizer,
+                   expected_output_len=config.teacher.get('expected_output_len', 0),
+                   max_retries=config.teacher.get('max_retries', 5))
+
+    def estimate_tokens(self, prompt):
+        if self.tokenizer is None:
+            return self.expected_output_len
+        return len(self.tokenizer.encode(prompt)) + self.expected_output_len
+
+    def _refill(self):
+        now = self.clock()
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        if self.rpm is not None:
+            self._requests_available = min(self.rpm, self._requests_available + elapsed * self.rpm * self._rate_factor / 60)
+        if self.tpm is not None:
+            self._tokens_available = min(self.tpm, self._tokens_available + elapsed * self.tpm * self._rate_factor / 60)
+
+    def acquire(self, ntokens):
+        r''' Blocks until there is budget for one request with `ntokens` tokens.
+        '''
+        # A prompt larger than the whole budget would wait forever
+        if self.tpm is not None:
+            ntokens = min(ntokens, self.tpm)
+        while True:
+            with self._lock:
+                self._refill()
+                wait = 0
+                # The small tolerance is there because of float rounding after a wait
+                if self.rpm is not None and self._requests_available < 1 - 1e-6:
+                    wait = max(wait, (1 - self._requests_available) * 60 / (self.rpm * self._rate_factor))
+                if self.tpm is not None and self._tokens_available < ntokens - 1e-6:
+                    wait = max(wait, (ntokens - self._tokens_available) * 60 / (self.tpm * self._rate_factor))
+                if wait == 0:
+                    if self.rpm is not None:
+                        self._requests_available -= 1
+                    if self.tpm is not None:
+                        self._tokens_available -= ntokens
+                    return
+            self.sleep(wait)
+
+    def _on_throttle(self):
+        with self._lock:
+            self.counters['throttles'] += 1
+            self._rate_factor = max(0.05, self._rate_factor / 2)
+            # Empty the buckets so that all threads back off
+            if self.rpm is not None:
+                self._requests_available = min(self._requests_available, 0)
+            if self.tpm is not None:
+                self._tokens_available = min(self._tokens_available, 0)
+
+    def _on_success(self, ntokens):
+        with self._lock:
+            self.counters['successes'] += 1
+            self.counters['tokens'] += ntokens
+            self._rate_factor = min(1.0, self._rate_factor + 0.05)
+
+    def __call__(self, prompt, config):
+        ntokens = self.estimate_tokens(prompt)
+        for attempt in range(self.max_retries + 1):
+            self.acquire(ntokens)
+            with self._lock:
+                self.counters['requests'] += 1
+            try:
+                out = self.teacher(prompt, config)
+            except Exception as e:
+                if is_throttle(e):
+                    self._on_throttle()
+                if attempt >= self.max_retries or not is_retryable(e):
+                    with self._lock:
+                        self.counters['failures'] += 1
+                    raise
+                with self._lock:
+                    self.counters['retries'] += 1
+                # Full jitter
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                logging.info(f"Teacher request failed with: {repr(e)}, retrying in {delay:.1f}s")
+                self.sleep(delay)
+            else:
+                self._on_success(ntokens)
+                return out
+
+    def stats(self):
+        r''' The counters plus goodput, i.e. successful requests and tokens per minute since the scheduler was created.
+        `prompts_per_s` and `tokens_per_s` are the same numbers per second, to compare with `HFTeacher.stats()`.
+        '''
+        with self._lock:
+            minutes = max(self.clock() - self._start, 1e-9) / 60
+            stats = dict(self.counters)
+            stats['goodput_rpm'] = stats['successes'] / minutes
+            stats['goodput_tpm'] = stats['tokens'] / minutes
+            stats['prompts_per_s'] = stats['goodput_rpm'] / 60
+            stats['tokens_per_s'] = stats['goodput_tpm'] / 60
+            stats['rate_factor'] = self._rate_factor
+        return stats
+
+
+class HFTeacher(object):
+    r''' Local teacher that uses a HF transformers model, e.g. to generate data on our own models or on boxes without API access.
+
+    Calls from all threads are put in one queue and a worker thread runs them through `generate` in batches: the pending
+    prompts are sorted by length and a batch is filled until `max_batch_tokens` (padded prompt + new tokens) or
+    `max_batch_size` is reached. Prompts that arrive while a batch is running join the next one, so set `teacher.concurrency`
+    in the config to at least `max_batch_size` to keep the batches full.
+
+    Args:
+        model_name_or_path (`str`):
+            HF model name or path, used if `model`/`tokenizer` are not provided.
+        max_new_tokens (`int`):
+            Max tokens generated per prompt, if the generation does not stop before this the output is None (as with `ask_openai`).
+        max_batch_tokens (`int`):
+            Token budget of one batch: batch_size * (longest prompt + max_new_tokens).
+        max_batch_size (`int`):
+            Max number of prompts in one batch.
+        max_wait (`float`):
+            Seconds to wait for more prompts before a batch is started.
+        device (`str`, optional):
+            Where to run the model, by default cuda if available.
+        generation_kwargs (`dict`, optional):
+            Passed to `generate`, e.g. `{'do_sample': True, 'temperature': 0.7}`.
+        use_chat_template (`bool`):
+            Format prompts with the chat template of the tokenizer, if it has one.
+    '''
+    def __init__(self, model_name_or_path=None, model=None, tokenizer=None, max_new_tokens=512, max_batch_tokens=16384,
+                 max_batch_size=32, max_wait=0.05, device=None, generation_kwargs=None, use_chat_template=True):
+        import torch
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
+        if device is None:
+            device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        self.device = device
+        self.tokenizer = tokenizer if tokenizer is not None else AutoTokenizer.from_pretrained(model_name_or_path)
+        self.tokenizer.padding_side = 'left'
+        if self.tokenizer.pad_token_id is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        self.model = model if model is not None else AutoModelForCausalLM.from_pretrained(model_name_or_path)
+        self.model.to(device).eval()
+
+        self.max_new_tokens = max_new_tokens
+        self.max_batch_tokens = max_batch_tokens
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.generation_kwargs = generation_kwargs or {}
+        self.use_chat_template = use_chat_template and getattr(self.tokenizer, 'chat_template', None) is not None
+        # Chat models end a turn with their own token(s) from the generation config (an int or a list), not only with eos
+        eos_token_ids = getattr(getattr(self.model, 'generation_config', None), 'eos_token_id', None)
+        eos_token_ids = list(eos_token_ids) if isinstance(eos_token_ids, (list, tuple)) else [eos_token_ids]
+        self.eos_token_ids = [i for i in dict.fromkeys(eos_token_ids + [self.tokenizer.eos_token_id]) if i is not None]
+
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._worker = None
+        self.counters = {'prompts': 0, 'batches': 0, 'prompt_tokens': 0, 'output_tokens': 0, 'padding_tokens': 0, 'generate_s': 0.0}
+
+    @classmethod
+    def from_config(cls, config):
+        t = config.teacher
+        return cls(t.model, max_new_tokens=t.get('max_new_tokens', 512), max_batch_tokens=t.get('max_batch_tokens', 16384),
+                   max_batch_size=t.get('max_batch_size', 32), device=t.get('device'),
+                   generation_kwargs=dict(t.get('generation_kwargs', {})))
+
+    def _encode(self, prompt):
+        if self.use_chat_template:
+            return self.tokenizer.apply_chat_template([{'role': 'user', 'content': prompt}], add_generation_prompt=True)
+        return self.tokenizer(prompt)['input_ids']
+
+    def _submit(self, prompt):
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, daemon=True)
+                self._worker.start()
+        future = Future()
+        self._queue.put((self._encode(prompt), future))
+        return future
+
+    def __call__(self, prompt, config=None):
+        return self._submit(prompt).result()
+
+    def generate_batch(self, prompts):
+        r''' Generate for many prompts at once, returns the outputs in the same order.
+        '''
+        futures = [self._submit(prompt) for prompt in prompts]
+        return [future.result() for future in futures]
+
+    def _run(self):
+        pending = []
+        while True:
+            if not pending:
+                pending.append(self._queue.get())
+            # Collect everything that arrives within max_wait
+            deadline = time.monotonic() + self.max_wait
+            while len(pending) < self.max_batch_size * 4:
+                try:
+                    pending.append(self._queue.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+
+            # Longest first, the batch is filled with prompts of similar length
+            pending.sort(key=lambda x: len(x[0]), reverse=True)
+            max_len = len(pending[0][0])
+            size = max(1, min(self.max_batch_size, len(pending), self.max_batch_tokens // (max_len + self.max_new_tokens)))
+            batch, pending = pending[:size], pending[size:]
+            try:
+                outputs = self._generate([ids for ids, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+            else:
+                for (_, future), output in zip(batch, outputs):
+                    future.set_result(output)
+
+    def _generate(self, batch):
+        import torch
+
+        start = time.perf_counter()
+        inputs = self.tokenizer.pad({'input_ids': batch}, return_tensors='pt').to(self.device)
+        with torch.no_grad():
+            out = self.model.generate(**inputs, **{'max_new_tokens': self.max_new_tokens, 'pad_token_id': self.tokenizer.pad_token_id,
+                                                   'eos_token_id': self.eos_token_ids, **self.generation_kwargs})
+        new_tokens = out[:, inputs['input_ids'].shape[1]:].tolist()
+
+        outputs = []
+        noutput = 0
+        for ids in new_tokens:
+            # Same as finish_reason == 'stop', otherwise the generation was cut at max_new_tokens
+            end = next((i for i, token in enumerate(ids) if token in self.eos_token_ids), None)
+            if end is not None:
+                ids = ids[:end]
+                outputs.append(self.tokenizer.decode(ids, skip_special_tokens=True))
+            else:
+                outputs.append(None)
+            noutput += len(ids)
+
+        with self._lock:
+            self.counters['prompts'] += len(batch)
+            self.counters['batches'] += 1
+            self.counters['prompt_tokens'] += sum(len(ids) for ids in batch)
+            self.counters['padding_tokens'] += inputs['input_ids'].numel() - sum(len(ids) for ids in batch)
+            self.counters['output_tokens'] += noutput
+            self.counters['generate_s'] += time.perf_counter() - start
+        return outputs
+
+    def stats(self):
+        r''' The counters plus throughput: prompts/s and tokens/s (prompt + output tokens) over the time spent in `generate`.
+        '''
+        with self._lock:
+            stats = dict(self.counters)
+        seconds = max(stats['generate_s'], 1e-9)
+        stats['prompts_per_s'] = stats['prompts'] / seconds
+        stats['tokens_per_s'] = (stats['prompt_tokens'] + stats['output_tokens']) / seconds
+        stats['output_tokens_per_s'] = stats['output_tokens'] / seconds
+        stats['mean_batch_size'] = stats['prompts'] / max(stats['batches'], 1)
+        return stats
+register_teacher('hf')(HFTeacher.from_config)
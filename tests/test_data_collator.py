@@ -0,0 +1,42 @@
+import pytest
+import torch
+
+from opengpt.dataset_utils import pack_examples
+from opengpt.data_collator import DataCollatorWithPadding
+
+transformers = pytest.importorskip('transformers')
+
+
+def tiny_llama(attn_implementation):
+    torch.manual_seed(0)
+    config = transformers.LlamaConfig(vocab_size=64, hidden_size=32, intermediate_size=64, num_hidden_layers=2,
+                                      num_attention_heads=4, num_key_value_heads=4, max_position_embeddings=64)
+    config._attn_implementation = attn_implementation
+    return transformers.LlamaForCausalLM(config).eval()
+
+
+@pytest.mark.parametrize('attn_implementation, dtype', [('sdpa', None), ('eager', torch.float32)])
+def test_packed_segments_do_not_attend_to_each_other(attn_implementation, dtype):
+    model = tiny_llama(attn_implementation)
+    examples = {'input_ids': [[5, 6, 7, 8], [9, 10, 11], [12, 13, 14, 15, 16]]}
+    examples['labels'] = [list(x) for x in examples['input_ids']]
+    packed = pack_examples(examples, 16, packing_type='partial', add_position_ids=True)
+    collator = DataCollatorWithPadding(pad_token_id=0, ignore_index=-100, max_seq_len=16, packed_attention_mask=True,
+                                       pad_to_multiple_of=8, attention_mask_dtype=dtype)
+    batch = collator([{k: v[0] for k, v in packed.items()}])
+
+    with torch.no_grad():
+        packed_logits = model(input_ids=batch['input_ids'], attention_mask=batch['attention_mask'], position_ids=batch['position_ids']).logits[0]
+        start = 0
+        for ids in examples['input_ids']:
+            alone = model(input_ids=torch.tensor([ids])).logits[0]
+            assert torch.allclose(packed_logits[start:start + len(ids)], alone, atol=1e-5)
+            start += len(ids)
+
+
+def test_segment_ids_and_cu_seqlens():
+    packed = pack_examples({'input_ids': [[1, 2], [3, 4, 5]], 'labels': [[1, 2], [3, 4, 5]]}, 8, add_position_ids=True)
+    collator = DataCollatorWithPadding(pad_token_id=0, ignore_index=-100, max_seq_len=8, pad_to_multiple_of=8, return_segment_ids=True)
+    batch = collator([{k: v[0] for k, v in packed.items()}])
+    assert batch['segment_ids'].tolist() == [[1, 1, 2, 2, 2, 0, 0, 0]]
+    assert batch['cu_seqlens'].tolist() == [0, 2, 5]
@@ -0,0 +1,56 @@
+import random
+import threading
+import time
+
+import pytest
+
+from opengpt.dataset_utils import dispatch_to_teacher
+
+
+class SleepingTeacher(object):
+    r''' Answers after a random delay (so with concurrency the answers finish out of order) and remembers how many
+    calls were running at the same time.
+    '''
+    def __init__(self, seed=0):
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def __call__(self, prompt_text, config):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            delay = self.rng.uniform(0, 0.02)
+        try:
+            time.sleep(delay)
+            if prompt_text.endswith('7'):
+                raise ValueError(prompt_text)
+            return f'answer to {prompt_text}'
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+
+def run(max_in_flight, n=40):
+    teacher = SleepingTeacher()
+    work_items = ({'prompt_text': f'prompt {i}'} for i in range(n))
+    results = [(work_item['prompt_text'], output, None if e is None else str(e))
+               for work_item, output, e in dispatch_to_teacher(work_items, teacher, config=None, max_in_flight=max_in_flight)]
+    return results, teacher.max_in_flight
+
+
+@pytest.mark.parametrize('max_in_flight', [2, 8])
+def test_dispatch_keeps_the_order_of_the_sequential_run(max_in_flight):
+    expected, _ = run(1)
+    results, _ = run(max_in_flight)
+    assert results == expected
+    assert [r[0] for r in results] == [f'prompt {i}' for i in range(40)]
+    assert all((e is not None) == p.endswith('7') for p, _, e in results)
+
+
+def test_dispatch_bounds_the_work_in_flight():
+    _, max_in_flight = run(1)
+    assert max_in_flight == 1
+    _, max_in_flight = run(4)
+    assert 1 < max_in_flight <= 4
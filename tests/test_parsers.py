@@ -0,0 +1,27 @@
+from box import Box
+
+from opengpt.parsers import task_parser
+
+config = Box({'special_tokens': {'user': '<|user|>', 'ai': '<|ai|>', 'eos': '<|eos|>', 'eod': '<|eod|>'}})
+
+
+def parse(data):
+    failures = []
+    records = task_parser(data, prompt_config={}, config=config, row=None, raw_data_id=0, prompt_text=None, failures=failures)
+    return records, failures
+
+
+def test_task_parser_fields():
+    records, failures = parse("Task 1:\nInstruction: Translate\nInput: hola\nOutput: hello\n\n"
+                              "Task 2:\nInstruction: Say hi.\nInput: <noinput>\nOutput: Hi!")
+    assert [r['text'] for r in records] == ['<|user|> Translate\nhola <|eos|> <|ai|> hello <|eos|> <|eod|>',
+                                            '<|user|> Say hi. <|eos|> <|ai|> Hi! <|eos|> <|eod|>']
+    assert failures == []
+
+
+def test_task_parser_words_input_output_without_colon_are_text():
+    records, failures = parse("Task 1:\nInstruction: Explain the Input layer and the Output of a network.\n"
+                              "Input: <noinput>\nOutput: The Input layer takes the features.")
+    assert [r['text'] for r in records] == ['<|user|> Explain the Input layer and the Output of a network. <|eos|> '
+                                            '<|ai|> The Input layer takes the features. <|eos|> <|eod|>']
+    assert failures == []
@@ -0,0 +1,101 @@
+import types
+
+import pytest
+
+from opengpt import teachers
+from opengpt.teachers import TeacherScheduler, is_retryable, is_throttle
+
+
+class FakeClock(object):
+    r''' Time moves only when someone sleeps.
+    '''
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def clock(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class RateLimitError(Exception):
+    status_code = 429
+
+
+class FlakyTeacher(object):
+    def __init__(self, nfailures, error=RateLimitError):
+        self.nfailures = nfailures
+        self.error = error
+        self.calls = 0
+
+    def __call__(self, prompt, config):
+        self.calls += 1
+        if self.calls <= self.nfailures:
+            raise self.error('slow down')
+        return f'answer to {prompt}'
+
+
+def test_scheduler_backs_off_on_rate_limits():
+    clock = FakeClock()
+    teacher = FlakyTeacher(nfailures=3)
+    scheduler = TeacherScheduler(teacher, max_retries=5, base_delay=1, max_delay=3, clock=clock.clock, sleep=clock.sleep)
+
+    assert scheduler('hi', None) == 'answer to hi'
+    assert teacher.calls == 4
+    # Full jitter, the upper bound doubles with every attempt and is capped at max_delay
+    assert len(clock.sleeps) == 3
+    assert all(0 <= delay <= bound for delay, bound in zip(clock.sleeps, [1, 2, 3]))
+    stats = scheduler.stats()
+    assert (stats['requests'], stats['successes'], stats['retries'], stats['throttles'], stats['failures']) == (4, 1, 3, 3, 0)
+    assert stats['rate_factor'] < 1
+
+
+def test_scheduler_throttle_empties_the_budget():
+    clock = FakeClock()
+    scheduler = TeacherScheduler(FlakyTeacher(nfailures=1), rpm=60, max_retries=1, base_delay=0, clock=clock.clock, sleep=clock.sleep)
+
+    assert scheduler('hi', None) == 'answer to hi'
+    # One backoff sleep (0 with base_delay=0), then waiting for a request at the halved rate: 1 request at 30 rpm
+    assert clock.sleeps[0] == 0
+    assert sum(clock.sleeps) == pytest.approx(2)
+
+
+def test_scheduler_gives_up_after_max_retries():
+    clock = FakeClock()
+    teacher = FlakyTeacher(nfailures=10)
+    scheduler = TeacherScheduler(teacher, max_retries=2, clock=clock.clock, sleep=clock.sleep)
+
+    with pytest.raises(RateLimitError):
+        scheduler('hi', None)
+    assert teacher.calls == 3
+    assert scheduler.stats()['failures'] == 1
+
+
+def test_scheduler_does_not_retry_other_errors():
+    clock = FakeClock()
+    teacher = FlakyTeacher(nfailures=1, error=KeyError)
+    scheduler = TeacherScheduler(teacher, max_retries=3, clock=clock.clock, sleep=clock.sleep)
+
+    with pytest.raises(KeyError):
+        scheduler('hi', None)
+    assert teacher.calls == 1 and clock.sleeps == []
+
+
+def test_openai_v1_errors_are_retryable(monkeypatch):
+    # openai>=1 has the errors at the top level, connection errors and timeouts have no status code
+    class APIConnectionError(Exception):
+        pass
+    class APITimeoutError(APIConnectionError):
+        pass
+    class RateLimitError(Exception):
+        pass
+    fake_openai = types.SimpleNamespace(APIConnectionError=APIConnectionError, APITimeoutError=APITimeoutError,
+                                        RateLimitError=RateLimitError, Timeout=object)
+    monkeypatch.setattr(teachers, 'openai', fake_openai)
+
+    assert is_retryable(APITimeoutError()) and is_retryable(APIConnectionError())
+    assert is_retryable(RateLimitError()) and is_throttle(RateLimitError())
+    assert not is_retryable(ValueError()) and not is_throttle(APITimeoutError())